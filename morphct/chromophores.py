@@ -50,6 +50,9 @@ class Chromophore:
         exp(r/vrh_delocalization) when `use_vrh` is True.
     charge : int, default 0
         The charge (in units of electrons) associated with this chromophore.
+    snap_index : morphct.execute_qcc.SnapshotIndex, default None
+        The index of `snap` used to write the QCC input. If None is given, one
+        will be created, so pass an index when creating many chromophores.
 
     Attributes
     ----------
@@ -67,9 +70,16 @@ class Chromophore:
         Snapshot indices of the particles which belong to this chromophore.
     n_atoms : int
         The number of atoms in the chromophore.
-    qcc_input : str
+    qcc_input : morphct.execute_qcc.QCCGeometry
         The input for the MINDO3 quantum chemical calculation run in pySCF. See
-        https://pyscf.org/quickstart.html for more information.
+        https://pyscf.org/quickstart.html for more information. ``str`` of it
+        gives the pySCF input string.
+    qcc_fragment : morphct.execute_qcc.CappedFragment
+        The atoms of the chromophore and the hydrogens capping its broken
+        bonds, used to make the QCC inputs of its pairs. It is made from the
+        snapshot index each time it is used, so it isn't stored. It is None
+        if the chromophore has no snapshot index (e.g., once it is copied or
+        pickled).
     neighbors : list of (int, numpy.ndarray(size=3))
         Each list entry is the chromophore index of the neighbor followed by the
         relative image of that neighbor. On initialization this is an empty
@@ -114,6 +124,7 @@ class Chromophore:
         reorganization_energy=0.3064,
         vrh_delocalization=2e-10,
         charge=0,
+        snap_index=None,
     ):
         self.id = chromo_id
         if species.lower() not in ["donor", "acceptor"]:
@@ -128,7 +139,13 @@ class Chromophore:
         # Sets unwrapped_center, center, and image attributes
         self._set_center(snap, atom_ids)
 
-        self.qcc_input = eqcc.write_qcc_inp(snap, atom_ids, conversion_dict)
+        if snap_index is None:
+            snap_index = eqcc.SnapshotIndex(snap, conversion_dict)
+        # Keep the index so pair inputs can be made without the bonds
+        self._snap_index = snap_index
+        self.qcc_input = eqcc.write_qcc_inp(
+            snap, atom_ids, conversion_dict, fragment=self.qcc_fragment
+        )
 
         # Now to create a load of placeholder parameters to update later when we
         # have the full list/energy levels.
@@ -158,6 +175,21 @@ class Chromophore:
             self.id, self.species, self.n_atoms, *self.center
         )
 
+    def __getstate__(self):
+        # The snapshot index is shared by all chromophores and is much larger
+        # than one of them
+        state = self.__dict__.copy()
+        state.pop("_snap_index", None)
+        return state
+
+    @property
+    def qcc_fragment(self):
+        """CappedFragment: The capped atoms, made from the snapshot index."""
+        snap_index = getattr(self, "_snap_index", None)
+        if snap_index is None:
+            return None
+        return eqcc.CappedFragment(snap_index, self.atom_ids)
+
     def _set_center(self, snap, atom_ids):
 
         box = freud.Box.from_box(snap.configuration.box)
@@ -258,7 +290,9 @@ def get_chromo_ids_smiles(snap, smarts_str, conversion_dict=None):
     return atom_ids
 
 
-def set_neighbors_voronoi(chromo_list, snap, conversion_dict=None, d_cut=10):
+def set_neighbors_voronoi(
+    chromo_list, snap, conversion_dict=None, d_cut=10, snap_index=None
+):
     """Set the chromophore neighbors using voronoi analysis.
 
     See https://freud.readthedocs.io/en/latest/modules/locality.html#freud.locality.Voronoi
@@ -278,22 +312,29 @@ def set_neighbors_voronoi(chromo_list, snap, conversion_dict=None, d_cut=10):
         element names.
     d_cut : float, default 10
         The distance cutoff for neighbors.
+    snap_index : morphct.execute_qcc.SnapshotIndex, default None
+        The index of `snap` used to write the QCC inputs. If None is given, one
+        will be created.
 
     Returns
     -------
-    qcc_pairs : list of ((int,int), str)
+    qcc_pairs : morphct.execute_qcc.QCCPairs
         The information needed for calculating the pair energies. The first part
         of each entry is the pair indices followed by the input for the MINDO3
         quantum chemical calculation run in pySCF for the chromophore pairs.
+        Only the pair indices and images are stored and the inputs are written
+        when they are needed.
         See https://pyscf.org/quickstart.html for more information.
     """
+    if snap_index is None:
+        snap_index = eqcc.SnapshotIndex(snap, conversion_dict)
     voronoi = freud.locality.Voronoi()
     freudbox = freud.box.Box(*snap.configuration.box)
     centers = [chromo.center for chromo in chromo_list]
     voronoi.compute((freudbox, centers))
 
     box = snap.configuration.box[:3]
-    qcc_pairs = []
+    qcc_pairs = eqcc.QCCPairs(chromo_list, snap_index)
     neighbors = []
     for (i, j) in voronoi.nlist:
         if i == j:
@@ -319,7 +360,6 @@ def set_neighbors_voronoi(chromo_list, snap, conversion_dict=None, d_cut=10):
                 continue
 
             rel_image = images[imin]
-            j_shift = centers[imin] - chromo_j.unwrapped_center
             chromo_i.neighbors.append([j, rel_image])
             chromo_i.neighbors_delta_e.append(None)
             chromo_i.neighbors_ti.append(None)
@@ -327,10 +367,7 @@ def set_neighbors_voronoi(chromo_list, snap, conversion_dict=None, d_cut=10):
             chromo_j.neighbors_delta_e.append(None)
             chromo_j.neighbors_ti.append(None)
             neighbors.append((i, j))
-            qcc_input = eqcc.write_qcc_pair_input(
-                snap, chromo_i, chromo_j, j_shift, conversion_dict
-            )
-            qcc_pairs.append(((i, j), qcc_input))
+            qcc_pairs.append((i, j), rel_image)
     return qcc_pairs
 
 
@@ -1,25 +1,144 @@
+from contextlib import ExitStack, contextmanager
+import copy
+import functools
+import hashlib
+import itertools
 import multiprocessing as mp
 from multiprocessing import get_context
+import os
+import queue
+import signal
+import sqlite3
+import time
 
 import ele
 import numpy as np
 import pyscf
 from pyscf.semiempirical import MINDO3
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from threadpoolctl import threadpool_limits
 
 from morphct import helper_functions as hf
 from morphct import transfer_integrals as ti
 
 
-def get_homolumo(molstr, charge=0, verbose=0, tol=1e-6):
+class QCCGeometry:
+    """The atoms of a quantum chemical calculation input.
+
+    Storing the atomic numbers and positions as arrays is much more compact
+    than a pySCF input string, and the molecule can be built from them
+    without formatting or parsing any text.
+
+    Parameters
+    ----------
+    numbers : numpy.ndarray of int
+        The atomic number of each atom.
+    positions : numpy.ndarray, shape (n, 3)
+        The positions of the atoms in Angstroms.
+
+    Attributes
+    ----------
+    numbers : numpy.ndarray of numpy.uint8
+        The atomic number of each atom.
+    positions : numpy.ndarray of float, shape (n, 3)
+        The positions of the atoms in Angstroms.
+    """
+
+    __slots__ = ("numbers", "positions")
+
+    def __init__(self, numbers, positions):
+        self.numbers = np.asarray(numbers, dtype=np.uint8)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __repr__(self):
+        return f"QCCGeometry: {len(self)} atoms"
+
+    def __str__(self):
+        return self.to_string()
+
+    @property
+    def symbols(self):
+        """list of str: The element symbol of each atom."""
+        return [_get_symbol(i) for i in self.numbers]
+
+    @classmethod
+    def from_string(cls, qcc_input):
+        """Create a geometry from a pySCF input string.
+
+        Parameters
+        ----------
+        qcc_input : str
+            Input string for pySCF containing elements and positions in
+            Angstroms (e.g., "C 0.0 0.0 0.0; H 1.54 0.0 0.0")
+
+        Returns
+        -------
+        QCCGeometry
+        """
+        atoms = [atom.split() for atom in qcc_input.split(";") if atom.strip()]
+        numbers = [
+            ele.element_from_symbol(atom[0]).atomic_number for atom in atoms
+        ]
+        positions = np.array([atom[1:] for atom in atoms], dtype=float)
+        return cls(numbers, positions)
+
+    def to_string(self):
+        """Write the geometry as a pySCF input string.
+
+        Returns
+        -------
+        str
+            Input string for pySCF containing elements and positions in
+            Angstroms (e.g., "C 0.0 0.0 0.0; H 1.54 0.0 0.0")
+        """
+        return " ".join(
+            f"{atom} {x} {y} {z};"
+            for atom, (x, y, z) in zip(self.symbols, self.positions)
+        )
+
+    def to_pyscf(self):
+        """Get the geometry in the list format used for pySCF atoms.
+
+        Returns
+        -------
+        list of (int, list of float)
+            The atomic number and position of each atom.
+        """
+        return list(zip(self.numbers.tolist(), self.positions.tolist()))
+
+
+_symbols = {}
+
+
+def _get_symbol(number):
+    if number not in _symbols:
+        _symbols[number] = ele.element_from_atomic_number(int(number)).symbol
+    return _symbols[number]
+
+
+def _as_geometry(qcc_input):
+    if isinstance(qcc_input, QCCGeometry):
+        return qcc_input
+    return QCCGeometry.from_string(qcc_input)
+
+
+def get_homolumo(
+    molstr, charge=0, verbose=0, tol=1e-6, dm0=None, return_dm=False
+):
     """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies in eV using MINDO3.
 
     See https://pyscf.org/quickstart.html for more information.
 
     Parameters
     ----------
-    molstr : str
-        Input string for pySCF containing elements and positions in Angstroms
-        (e.g., "C 0.0 0.0 0.0; H 1.54 0.0 0.0")
+    molstr : QCCGeometry or str
+        The atoms of the molecule, or an input string for pySCF containing
+        elements and positions in Angstroms (e.g., "C 0.0 0.0 0.0; H 1.54 0.0
+        0.0")
     charge : int, default 0
         If the molecule which we are calculating the energies of has a charge,
         it can be specified.
@@ -28,401 +147,2708 @@ def get_homolumo(molstr, charge=0, verbose=0, tol=1e-6):
         4 will show convergence.
     tol : float, default 1e-6
         Tolerance of the MINDO convergence.
+    dm0 : numpy.ndarray, default None
+        Initial guess of the density matrix. If None is given, pySCF's default
+        guess is used.
+    return_dm : bool, default False
+        Whether to also return the converged density matrix.
 
     Returns
     -------
     numpy.ndarray
         Array containing HOMO-1, HOMO, LUMO, LUMO+1 energies in eV
+    numpy.ndarray
+        The density matrix, if `return_dm` is True.
     """
+    energies, dm, converged = _get_homolumo(molstr, charge, verbose, tol, dm0)
+    if return_dm:
+        return energies, dm
+    return energies
+
+
+def _get_homolumo(molstr, charge=0, verbose=0, tol=1e-6, dm0=None):
+    """Get the energies, density matrix and convergence of a MINDO3 SCF."""
+    if isinstance(molstr, QCCGeometry):
+        molstr = molstr.to_pyscf()
     mol = pyscf.M(atom=molstr, charge=charge)
-    mf = MINDO3(mol).run(verbose=verbose, conv_tol=tol)
+    mf = MINDO3(mol).run(dm0, verbose=verbose, conv_tol=tol)
     occ = mf.get_occ()
     i_lumo = np.argmax(occ < 1)
     energies = mf.mo_energy[i_lumo - 2 : i_lumo + 2]
     energies *= 27.2114  # convert Eh to eV
-    return energies
+    return energies, mf.make_rdm1(), mf.converged
 
 
-def singles_homolumo(chromo_list, filename=None, nprocs=None):
-    """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies for all single chromophores.
+def _get_homolumo_retries(qcc_input, charge, dm0=None, retries=0, tol=1e-6):
+    """Get the energies, retrying with a looser tolerance if not converged.
 
-    Parameters
-    ----------
-    chromo_list : list of Chromophore
-        Chromophores to calculate energies of. Each Chromophore must have
-        qcc_input attribute set.
-    filename : str, default None
-        Path to file where singles energies will be saved. If None, energies
-        will not be saved.
-    nprocs : int, default None
-        Number of processes passed to multiprocessing.Pool. 
-       
+    The first retry starts from pySCF's default guess if a guess was given,
+    and the others from the density matrix of the previous attempt. Each
+    retry loosens the tolerance by a factor of 10.
 
-    Returns
-    -------
-    data : numpy.ndarray
-        Array of energies where each row corresponds to the MO energies of each
-        chromophore in the list.
+    Returns the energies and density matrix of the last attempt, a failure
+    message which is None if it converged, and the number of attempts.
     """
-    if nprocs is None:
-        nprocs = mp.cpu_count()
-    with get_context("spawn").Pool(processes=nprocs) as p:
-        data = p.map(
-            _worker_wrapper, [(i.qcc_input, i.charge) for i in chromo_list]
+    for attempt in range(retries + 1):
+        energies, dm, converged = _get_homolumo(
+            qcc_input, charge, tol=tol, dm0=dm0
         )
+        if converged:
+            return energies, dm, None, attempt + 1
+        dm0 = None if attempt == 0 and dm0 is not None else dm
+        tol *= 10
+    failure = f"not converged after {retries + 1} attempts"
+    return energies, dm, failure, retries + 1
 
-    data = np.stack(data)
-    if filename is not None:
-        np.savetxt(filename, data)
-    return data
 
-def dimer_homolumo(qcc_pairs, chromo_list, filename=None, nprocs=None):
-    """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies for all chromophore pairs.
+# The database connection of each (process, cache file), see QCCCache
+_cache_connections = {}
+
+
+class QCCCache:
+    """Persistent cache of the energies from quantum chemical calculations.
+
+    The energies are stored in an SQLite database keyed by a hash of the
+    quantized geometry, charge, method, and convergence tolerance, so an input
+    which has already been calculated (e.g., when the same frame is analyzed
+    with a different neighbor cutoff) is not calculated again. Once there are
+    more than `max_entries` results, the least recently used are removed.
+
+    Each process opens one connection to the database, which all of its
+    caches of the same file share until `close` is called. The number of
+    results is counted once, when this cache first adds results, and then
+    kept up to date as it adds and removes them.
 
     Parameters
     ----------
-    qcc_pairs : list of ((int, int), str)
-        Each list item contains a tuple with the indices of the pair and the
-        qcc input string.
-        qcc_pairs is returned by `morphct.chromophores.set_neighbors_voronoi`
-    chromo_list : list of Chromophore
-        List of chromphores to calculate dimer energies.
-    filename : str, default None
-        Path to file where the pair energies will be saved. If None, energies
-        will not be saved.
-    nprocs : int, default None
-        Number of processes passed to multiprocessing.Pool.
-        
-
-    Returns
-    -------
-    dimer_data : list of ((int, int), numpy.ndarray)
-        Each list item contains the indices of the pair and an array of its MO
-        energies.
+    filename : path
+        Path to the SQLite database. It is created if it doesn't exist.
+    max_entries : int, default 1000000
+        The maximum number of results to keep.
+    decimals : int, default 5
+        The number of decimal places the positions (in Angstroms) are rounded
+        to before hashing.
     """
-    if nprocs is None:
-        nprocs = mp.cpu_count()
 
-    with get_context("spawn").Pool(processes=nprocs) as p:
-        args = [
-            (qcc_input, chromo_list[i].charge + chromo_list[j].charge)
-            for (i,j), qcc_input in qcc_pairs
-        ]
-        data = p.map(_worker_wrapper, args)
-
-    dimer_data = [i for i in zip([pair for pair, qcc_input in qcc_pairs], data)]
-    if filename is not None:
-        with open(filename, "w") as f:
-            f.writelines(
-                f"{pair[0]} {pair[1]} {en[0]} {en[1]} {en[2]} {en[3]}\n"
-                for pair, en in dimer_data
+    def __init__(self, filename, max_entries=1000000, decimals=5):
+        self.filename = os.fspath(filename)
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self._n_results = None
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, energies BLOB, last_used INTEGER)"
+            )
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS last_used ON results (last_used)"
             )
-    return dimer_data
 
+    def __len__(self):
+        return self._count()
 
+    def __getstate__(self):
+        # The count is only valid in the process which keeps it
+        return dict(self.__dict__, _n_results=None)
 
-def get_dimerdata(filename):
-    """Read in the saved data created by `dimer_homolumo`.
+    def _connect(self):
+        key = (os.getpid(), self.filename)
+        if key not in _cache_connections:
+            # Wait for other processes using the same cache
+            _cache_connections[key] = sqlite3.connect(self.filename, timeout=60)
+        return _cache_connections[key]
 
-    Parameters
-    ----------
-    filename : str
-        Path to file where the dimer energies were saved.
+    def _count(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM results"
+        ).fetchone()[0]
 
-    Returns
-    -------
-    dimer_data : list of ((int, int), numpy.ndarray)
-        Each list item contains the indices of the pair and an array of its MO
-        energies.
-    """
-    dimer_data = []
-    with open(filename, "r") as f:
-        for i in f.readlines():
-            a, b, c, d, e, f = i.split()
-            dimer_data.append(
-                ((int(a), int(b)), (float(c), float(d), float(e), float(f)))
+    def close(self):
+        """Close this process's connection to the database.
+
+        Caches of the same file which are used afterwards open a new one.
+        """
+        con = _cache_connections.pop((os.getpid(), self.filename), None)
+        if con is not None:
+            con.close()
+        self._n_results = None
+
+    def get_key(self, qcc_input, charge=0, method="MINDO3", tol=1e-6):
+        """Get the cache key of a quantum chemical calculation.
+
+        Parameters
+        ----------
+        qcc_input : QCCGeometry or str
+            The atoms of the molecule, or an input string for pySCF containing
+            elements and positions in Angstroms. Both give the same key for
+            the same atoms.
+        charge : int, default 0
+            The charge of the molecule.
+        method : str, default "MINDO3"
+            The name of the quantum chemical method.
+        tol : float, default 1e-6
+            Tolerance of the convergence.
+
+        Returns
+        -------
+        str
+            The hash of the inputs.
+        """
+        qcc_input = _as_geometry(qcc_input)
+        # Adding 0.0 turns -0.0 into 0.0
+        positions = np.round(qcc_input.positions, self.decimals) + 0.0
+        geometry = ";".join(
+            f"{atom} {x:.{self.decimals}f} {y:.{self.decimals}f} "
+            f"{z:.{self.decimals}f}"
+            for atom, (x, y, z) in zip(qcc_input.symbols, positions)
+        )
+        key = f"{method};{int(charge)};{float(tol)!r};{geometry}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, keys):
+        """Look up the energies of several inputs.
+
+        Parameters
+        ----------
+        keys : list of str
+            The cache keys of the inputs (see `get_key`).
+
+        Returns
+        -------
+        list of numpy.ndarray
+            The energies of each input, or None if it is not in the cache.
+        """
+        found = {}
+        with self._connect() as con:
+            # Stay under SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                query = (
+                    "SELECT key, energies FROM results WHERE key IN "
+                    f"({','.join('?' * len(chunk))})"
+                )
+                found.update(con.execute(query, chunk).fetchall())
+            now = time.time_ns()
+            con.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
             )
-    return dimer_data
+        return [
+            np.frombuffer(found[key]).copy() if key in found else None
+            for key in keys
+        ]
 
+    def put(self, results):
+        """Add energies to the cache.
 
-def get_singlesdata(filename):
-    """Read in the saved data created by `singles_homolumo`.
+        Parameters
+        ----------
+        results : dict
+            The energies (numpy.ndarray) of each cache key.
+        """
+        now = time.time_ns()
+        rows = [
+            (np.asarray(val, dtype=float).tobytes(), now, key)
+            for key, val in results.items()
+        ]
+        if self._n_results is None:
+            self._n_results = self._count()
+        with self._connect() as con:
+            # Only the rows which are new change the number of results
+            n_new = con.executemany(
+                "INSERT OR IGNORE INTO results (energies, last_used, key) "
+                "VALUES (?, ?, ?)",
+                rows,
+            ).rowcount
+            if n_new < len(rows):
+                con.executemany(
+                    "UPDATE results SET energies = ?, last_used = ? "
+                    "WHERE key = ?",
+                    rows,
+                )
+            self._n_results += n_new
+            if self._n_results > self.max_entries:
+                self._n_results -= con.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results "
+                    "ORDER BY last_used LIMIT ?)",
+                    (self._n_results - self.max_entries,),
+                ).rowcount
+
+
+class QCCExecutor:
+    """A pool of worker processes for quantum chemical calculations.
+
+    Each worker process imports pySCF when it starts, which takes a noticeable
+    fraction of the time for small systems. The same executor can be used for
+    the singles and dimers of many frames so the workers are only started
+    once. It can be used as a context manager, otherwise call `close` when it
+    is no longer needed.
+
+    Each worker limits pySCF (OpenMP) and BLAS to `threads_per_proc`
+    threads when it starts (including workers which are restarted), so the
+    workers don't compete for the CPUs. Small inputs are fastest with one
+    thread in each of many processes, while large inputs (e.g., dimers of
+    large small molecule acceptors) gain from threads. The split is fixed
+    for the life of the pool, so an executor used for inputs of very
+    different sizes should be sized for the largest of them.
 
     Parameters
     ----------
-    filename : str
-        Path to file where the singles energies were saved.
+    nprocs : int, default None
+        Number of worker processes. If None is given, the number of CPUs
+        divided by `threads_per_proc` is used.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses. If None is given and
+        `nprocs` is given, the CPUs are split between the processes;
+        otherwise it is chosen from `n_basis`.
+    n_basis : int, default 0
+        Number of basis functions of the largest input, used to choose the
+        number of threads when neither `nprocs` nor `threads_per_proc` is
+        given.
+    timeout : float, default None
+        Wall-clock time limit in seconds of each calculation. A calculation
+        which runs longer is stopped and recorded as a failure. If its worker
+        doesn't return within `timeout` more seconds (at least 5 and at most
+        60), e.g. because it was killed by the out-of-memory killer, only
+        that worker is stopped and replaced, and the calculation is recorded
+        as a failure. If None is given, calculations aren't limited, and a
+        killed worker makes the run hang.
+    retries : int, default 2
+        Number of times an SCF which doesn't converge is run again, each time
+        with a 10 times looser tolerance and a different initial guess. If
+        the last attempt doesn't converge, its energies are used and it is
+        recorded as a failure. Only results which converged at the first
+        attempt are added to a cache.
+    max_restarts : int, default 10
+        Number of workers which can be lost in one run (see `timeout`)
+        before it is stopped with a RuntimeError, so that workers which keep
+        crashing don't make it run forever.
 
-    Returns
-    -------
-    numpy.ndarray
-        Array of energies where each row corresponds to the MO energies of each
-        chromophore in the list.
+    Attributes
+    ----------
+    nprocs : int
+        Number of worker processes.
+    threads_per_proc : int
+        Number of threads each worker process uses.
+    timeout : float
+        Wall-clock time limit in seconds of each calculation.
+    retries : int
+        Number of retries of an SCF which doesn't converge.
+    max_restarts : int
+        Number of workers which can be lost in one run.
+
+    Examples
+    --------
+    >>> with QCCExecutor(nprocs=4, threads_per_proc=2) as executor:
+    ...     for system in systems:
+    ...         system.compute_energies(qcc_kwargs={"executor": executor})
     """
-    return np.loadtxt(filename)
 
+    def __init__(
+        self,
+        nprocs=None,
+        threads_per_proc=None,
+        n_basis=0,
+        timeout=None,
+        retries=2,
+        max_restarts=10,
+    ):
+        self.nprocs, self.threads_per_proc = get_qcc_threads(
+            nprocs, threads_per_proc, n_basis
+        )
+        self.timeout = timeout
+        self.retries = retries
+        self.max_restarts = max_restarts
+        ctx = get_context("spawn")
+        # With a timeout, the workers report the start of each task so the
+        # worker of a lost task can be found
+        self._started = None if timeout is None else ctx.SimpleQueue()
+        self._lost = False
+        self._pool = ctx.Pool(
+            processes=self.nprocs,
+            initializer=_init_worker,
+            initargs=(
+                self.threads_per_proc,
+                self.timeout,
+                self.retries,
+                self._started,
+            ),
+        )
 
-def set_energyvalues(chromo_list, s_filename, d_filename):
-    """Set the energy attributes of the Chromophore objects in chromo_list.
+    def __enter__(self):
+        return self
 
-    Run singles_homolumo and dimer_homolumo first to get the energy files.
-    Energy values set by this function:
-        homo_1, homo, lumo, lumo_1, neighbors_delta_e, neighbors_ti
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
+            self._pool.join()
 
-    Parameters
-    ----------
-    chromo_list : list of Chromophore
-        Set the energy values of the chromphores in this list.
-    s_filename : str
-        Path to file where the singles energies were saved.
-    d_filename : str
-        Path to file where the pair energies were saved.
-    """
-    s_data = get_singlesdata(s_filename)
-    d_data = get_dimerdata(d_filename)
+    def imap_unordered(self, tasks):
+        """Run the tasks, yielding the results as they finish."""
+        if self.timeout is None:
+            return self._pool.imap_unordered(_indexed_worker, tasks)
+        return self._imap_with_deadlines(tasks)
 
-    for i, chromo in enumerate(chromo_list):
-        chromo.homo_1, chromo.homo, chromo.lumo, chromo.lumo_1 = s_data[i]
+    def _imap_with_deadlines(self, tasks):
+        """Run the tasks, giving up on those whose worker doesn't return.
 
-    for (i, j), (homo_1, homo, lumo, lumo_1) in d_data:
-        ichromo = chromo_list[i]
-        jchromo = chromo_list[j]
-        ineighborind = [i for i, img in ichromo.neighbors].index(j)
-        jneighborind = [i for i, img in jchromo.neighbors].index(i)
-        deltaE = ti.calculate_delta_E(ichromo, jchromo)
-        ichromo.neighbors_delta_e[ineighborind] = deltaE
-        jchromo.neighbors_delta_e[jneighborind] = -deltaE
+        Only one task per worker is submitted at a time, and each task's
+        deadline is counted from when its worker reports that it started.
+        The worker of a task which misses its deadline is killed, and the
+        pool replaces it without stopping the other workers.
+        """
+        tasks = iter(tasks)
+        results = queue.SimpleQueue()
+        # The task, deadline and worker pid of each running task
+        running = {}
+        restarts = 0
+        wait = self.timeout + min(max(self.timeout, 5), 60)
 
-        assert ichromo.species == jchromo.species
-        if ichromo.species == "donor":
-            transint = ti.calculate_ti(homo - homo_1, deltaE)
+        def submit(task):
+            def put_error(error, i=task[0]):
+                results.put((i, None, None, None, repr(error), False))
+
+            self._pool.apply_async(
+                _indexed_worker,
+                (task,),
+                callback=results.put,
+                error_callback=put_error,
+            )
+            # Tasks which never start have a deadline too
+            running[task[0]] = [task, time.monotonic() + wait, None]
+
+        def fill():
+            for task in itertools.islice(tasks, self.nprocs - len(running)):
+                submit(task)
+
+        def update_started():
+            while not self._started.empty():
+                i, pid, start = self._started.get()
+                if i in running:
+                    running[i][1:] = (
+                        time.monotonic() + start + wait - time.time(),
+                        pid,
+                    )
+
+        fill()
+        while running:
+            update_started()
+            deadline = min(deadline for _, deadline, _ in running.values())
+            try:
+                result = results.get(
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+            except queue.Empty:
+                update_started()
+                now = time.monotonic()
+                for i, (task, deadline, pid) in list(running.items()):
+                    if deadline > now:
+                        continue
+                    del running[i]
+                    self._lost = True
+                    restarts += 1
+                    if restarts > self.max_restarts:
+                        raise RuntimeError(
+                            f"{restarts} workers were lost, more than "
+                            f"max_restarts={self.max_restarts}."
+                        )
+                    if pid is not None:
+                        # The worker may already be dead, e.g. if it ran out
+                        # of memory
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    yield i, None, None, None, "the worker was lost", False
+                fill()
+                continue
+            # The results of tasks which were given up on are ignored
+            if result[0] not in running:
+                continue
+            del running[result[0]]
+            yield result
+            fill()
+
+    def close(self):
+        """Wait for the running tasks and stop the worker processes."""
+        if self._lost:
+            # The results of lost tasks never arrive, so the pool can't be
+            # closed
+            self._pool.terminate()
         else:
-            transint = ti.calculate_ti(lumo - lumo_1, deltaE)
-        ichromo.neighbors_ti[ineighborind] = transint
-        jchromo.neighbors_ti[jneighborind] = transint
+            self._pool.close()
+        self._pool.join()
 
 
-def write_qcc_inp(snap, atom_ids, conversion_dict=None):
-    """Write a quantum chemical input string.
+_thread_env_vars = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+)
 
-    Input string for pySCF containing elements and positions in Angstroms
-    (e.g., "C 0.0 0.0 0.0; H 1.54 0.0 0.0")
-    See https://pyscf.org/quickstart.html for more information.
+
+def get_qcc_threads(nprocs=None, threads_per_proc=None, n_basis=0):
+    """Split the CPUs into worker processes and threads for QCC.
+
+    If neither is given, inputs with fewer than 256 basis functions get one
+    thread per process, and larger inputs get one more power of two threads
+    for each doubling in size (e.g., 2 threads for 512 basis functions).
 
     Parameters
     ----------
-    snap : gsd.hoomd.Snapshot
-        Atomistic simulation snapshot from a GSD file. It is expected that the
-        lengths in this file have been converted to Angstroms.
-    atom_ids : numpy.ndarray of int
-        Snapshot indices of the particles to include in the input string.
-    conversion_dict : dictionary, default None
-        A dictionary that maps the atom type to its element. e.g., `{'c3': C}`.
-        An instance that maps AMBER types to their element can be found in
-        `amber_dict`. If None is given, assume the particles already have
-        element names.
+    nprocs : int, default None
+        Number of worker processes. If None is given, the number of CPUs
+        divided by `threads_per_proc` is used.
+    threads_per_proc : int, default None
+        Number of threads per process. If None is given and `nprocs` is
+        given, the number of CPUs divided by `nprocs` is used; otherwise it is
+        chosen from `n_basis`.
+    n_basis : int, default 0
+        Number of basis functions of the largest input.
 
     Returns
     -------
-    str
-        The input for the MINDO3 quantum chemical calculation run in pySCF.
+    nprocs : int
+        Number of worker processes.
+    threads_per_proc : int
+        Number of threads per process.
     """
-    atoms = []
-    positions = []
+    ncpus = mp.cpu_count()
+    if threads_per_proc is None:
+        if nprocs is not None:
+            threads_per_proc = ncpus // nprocs
+        else:
+            threads_per_proc = 2 ** int(np.log2(max(n_basis, 256) / 256))
+        threads_per_proc = min(max(threads_per_proc, 1), ncpus)
+    if nprocs is None:
+        nprocs = max(ncpus // threads_per_proc, 1)
+    return nprocs, threads_per_proc
 
-    box = snap.configuration.box[:3]
-    unwrapped_pos = snap.particles.position + snap.particles.image * box
 
-    for i in atom_ids:
-        if conversion_dict is not None:
-            element = conversion_dict[
-                snap.particles.types[snap.particles.typeid[i]]
-            ]
-        else:
-            element = ele.element_from_symbol(
-                snap.particles.types[snap.particles.typeid[i]]
-            )
-        atoms.append(element.symbol)
-        positions.append(unwrapped_pos[i])
-
-    # To determine where to add hydrogens, check the bonds that go to
-    # particles outside of the ids provided
-    for i, j in snap.bonds.group:
-        if i in atom_ids and j not in atom_ids:
-            if conversion_dict is not None:
-                element = conversion_dict[
-                    snap.particles.types[snap.particles.typeid[j]]
-                ]
-            else:
-                element = ele.element_from_symbol(
-                    snap.particles.types[snap.particles.typeid[j]]
-                )
-            # If it's already a Hydrogen, just add it
-            if element.atomic_number == 1:
-                atoms.append(element.symbol)
-                positions.append(unwrapped_pos[j])
-            # If it's not a hydrogen, use the existing bond vector to
-            # determine the direction and scale it to a more reasonable
-            # length for C-H bond
-            else:
-                # Average sp3 C-H bond is 1.094 Angstrom
-                v = unwrapped_pos[j] - unwrapped_pos[i]
-                unit_vec = v / np.linalg.norm(v)
-                new_pos = unit_vec * 1.094 + unwrapped_pos[i]
-                atoms.append("H")
-                positions.append(new_pos)
+def _get_cache(cache):
+    if cache is None or isinstance(cache, QCCCache):
+        return cache
+    return QCCCache(cache)
 
-        # Same as above but j->i instead of i->j
-        elif j in atom_ids and i not in atom_ids:
-            if conversion_dict is not None:
-                element = conversion_dict[
-                    snap.particles.types[snap.particles.typeid[i]]
-                ]
-            else:
-                element = ele.element_from_symbol(
-                    snap.particles.types[snap.particles.typeid[i]]
-                )
-            if element.atomic_number == 1:
-                atoms.append(element.symbol)
-                positions.append(unwrapped_pos[i])
 
-            else:
-                v = unwrapped_pos[i] - unwrapped_pos[j]
-                unit_vec = v / np.linalg.norm(v)
-                new_pos = unit_vec * 1.094 + unwrapped_pos[j]
-                atoms.append("H")
-                positions.append(new_pos)
+def _get_n_ao(numbers):
+    """Get the number of MINDO3 orbitals of each atom.
 
-    # Shift center to origin
-    positions = np.stack(positions)
-    positions -= np.mean(positions, axis=0)
-    qcc_input = " ".join(
-        [f"{atom} {x} {y} {z};" for atom, (x, y, z) in zip(atoms, positions)]
-    )
-    return qcc_input
+    MINDO3 uses one s orbital for hydrogen and one s and three p orbitals for
+    the other elements.
+    """
+    return np.where(numbers > 2, 4, 1)
 
 
-def write_qcc_pair_input(
-    snap, chromo_i, chromo_j, j_shift, conversion_dict=None
-    ):
-    """Write a quantum chemical input string for chromophore pairs.
+def _get_n_basis(qcc_input):
+    """Estimate the number of basis functions (i.e., the cost) of an input."""
+    if isinstance(qcc_input, _PairTask):
+        return qcc_input.n_basis
+    return int(np.sum(_get_n_ao(_as_geometry(qcc_input).numbers)))
+
+
+def _align(positions, reference):
+    """Find the rotation of centered reference positions onto positions.
+
+    The rotation may include a reflection, which doesn't change the energies.
+
+    Returns the rotation matrix R, such that positions ~ reference @ R.T, and
+    the RMSD of the alignment.
+    """
+    u, s, vt = np.linalg.svd(reference.T @ positions)
+    rotation = (u @ vt).T
+    diff = positions - reference @ rotation.T
+    return rotation, np.sqrt(np.mean(np.sum(diff ** 2, axis=1)))
+
+
+def _rotate_dm(dm, numbers, rotation):
+    """Rotate a MINDO3 density matrix with its molecule."""
+    n_ao = _get_n_ao(numbers)
+    ao_loc = np.concatenate(([0], np.cumsum(n_ao)))
+    u = np.eye(len(dm))
+    # The p orbitals of each atom rotate like its coordinates
+    for start in ao_loc[:-1][n_ao == 4] + 1:
+        u[start : start + 3, start : start + 3] = rotation
+    return u @ dm @ u.T
 
-    Pair input requires taking periodic images into account.
-    Input string for pySCF containing elements and positions in Angstroms
-    (e.g., "C 0.0 0.0 0.0; H 1.54 0.0 0.0")
-    See https://pyscf.org/quickstart.html for more information.
+
+def find_duplicates(geometries, tol=0.01, labels=None):
+    """Find geometries which are the same up to a rigid-body motion.
+
+    Each geometry is centered and compared to the representatives found so
+    far which have the same atoms (in the same order), the same label, and
+    the same principal extents rounded to 0.1 Angstrom. It is a duplicate of
+    the first one it can be aligned to with an RMSD below `tol`. Geometries
+    whose extents round differently aren't compared, so a few duplicates may
+    be missed, but a geometry is never matched above the tolerance.
 
     Parameters
     ----------
-    snap : gsd.hoomd.Snapshot
-        Atomistic simulation snapshot from a GSD file. It is expected that the
-        lengths in this file have been converted to Angstroms.
-    chromo_i : Chromophore
-        One of the chromophores to be written.
-    chromo_j : Chromophore
-        One of the chromophores to be written.
-    j_shift : numpy.ndarray(3)
-        Vector to shift chromo_j.
-        (chromo_j minimum image center - unwrapped center)
-    conversion_dict : dictionary, default None
-        A dictionary that maps the atom type to its element. e.g., `{'c3': C}`.
-        An instance that maps AMBER types to their element can be found in
-        `amber_dict`. If None is given, assume the particles already have
-        element names.
+    geometries : iterable of QCCGeometry
+        The geometries to compare. Only the centered positions of the
+        representatives are kept, so this can be a generator.
+    tol : float, default 0.01
+        The largest RMSD of a duplicate in Angstroms.
+    labels : list of hashable, default None
+        Geometries with different labels (e.g., their charge) are never
+        duplicates.
 
     Returns
     -------
-    str
-        The input for the MINDO3 quantum chemical calculation run in pySCF.
+    reps : numpy.ndarray of int
+        The index of the representative of each geometry, which is its own
+        index for representatives.
+    rotations : numpy.ndarray of float
+        The rotation (with an optional reflection) of each geometry from its
+        representative, shape (n, 3, 3).
     """
-    box = snap.configuration.box[:3]
-    unwrapped_pos = snap.particles.position + snap.particles.image * box
+    reps = []
+    rotations = []
+    groups = {}
+    for n, geometry in enumerate(geometries):
+        positions = geometry.positions - geometry.positions.mean(axis=0)
+        extents = np.sqrt(
+            np.abs(np.linalg.eigvalsh(positions.T @ positions / len(geometry)))
+        )
+        # Adding 0.0 turns -0.0 into 0.0
+        key = (
+            geometry.numbers.tobytes(),
+            None if labels is None else labels[n],
+            tuple(np.round(extents, 1) + 0.0),
+        )
+        group = groups.setdefault(key, [])
+        for rep, reference in group:
+            rotation, rmsd = _align(positions, reference)
+            if rmsd < tol:
+                reps.append(rep)
+                rotations.append(rotation)
+                break
+        else:
+            group.append((n, positions))
+            reps.append(n)
+            rotations.append(np.eye(3))
+    return np.array(reps, dtype=int), np.array(rotations).reshape(-1, 3, 3)
 
-    # chromophore i is shifted into 0,0,0 image
-    positions = [
-        i + chromo_i.image * box for i in unwrapped_pos[chromo_i.atom_ids]
-    ]
-    # shift chromophore j's unwrapped positions
-    positions += [i for i in unwrapped_pos[chromo_j.atom_ids] + j_shift]
-
-    atom_ids = np.concatenate((chromo_i.atom_ids, chromo_j.atom_ids))
-    typeids = snap.particles.typeid[atom_ids]
-    if conversion_dict is not None:
-        atoms = [
-            conversion_dict[snap.particles.types[i]].symbol for i in typeids
-        ]
-    else:
-        atoms = [
-            ele.element_from_symbol(snap.particles.types[i]).symbol for i in typeids
-        ]
 
-    # To determine where to add hydrogens, check the bonds that go to
-    # particles outside of the ids provided
-    for i, j in snap.bonds.group:
-        if i in atom_ids and j not in atom_ids:
-            # If bond is to chromophore j, additional shifting might be needed
-            if i in chromo_j.atom_ids:
-                shift = j_shift
-            else:
-                shift = chromo_i.image * box
-            if conversion_dict is not None:
-                element = conversion_dict[
-                    snap.particles.types[snap.particles.typeid[j]]
-                ]
-            else:
-                element = ele.element_from_symbol(
-                    snap.particles.types[snap.particles.typeid[j]]
-                )
-            # If it's already a Hydrogen, just add it
-            if element.atomic_number == 1:
-                atoms.append(element.symbol)
-                positions.append(unwrapped_pos[j] + shift)
-            # If it's not a hydrogen, use the existing bond vector to
-            # determine the direction and scale it to a more reasonable
-            # length for C-H bond
-            else:
-                # Average sp3 C-H bond is 1.094 Angstrom
-                v = unwrapped_pos[j] - unwrapped_pos[i]
-                unit_vec = v / np.linalg.norm(v)
-                new_pos = unit_vec * 1.094 + unwrapped_pos[i] + shift
-                atoms.append("H")
-                positions.append(new_pos)
+def _get_geometry(qcc_input):
+    if isinstance(qcc_input, _PairTask):
+        return qcc_input.get_writer()()
+    return _as_geometry(qcc_input)
 
-        # Same as above but j->i instead of i->j
-        elif j in atom_ids and i not in atom_ids:
-            if j in chromo_j.atom_ids:
-                shift = j_shift
-            else:
-                shift = chromo_i.image * box
-            if conversion_dict is not None:
-                element = conversion_dict[
-                    snap.particles.types[snap.particles.typeid[i]]
-                ]
-            else:
-                element = ele.element_from_symbol(
-                    snap.particles.types[snap.particles.typeid[i]]
-                )
 
+def _get_extents(positions):
+    """Get the principal extents of positions, rounded to 0.1 Angstrom."""
+    positions = positions - positions.mean(axis=0)
+    extents = np.sqrt(
+        np.abs(np.linalg.eigvalsh(positions.T @ positions / len(positions)))
+    )
+    # Adding 0.0 turns -0.0 into 0.0
+    return tuple(np.round(extents, 1) + 0.0)
+
+
+def _run_qcc_dedup(args, dedup_tol, callback=None, **kwargs):
+    """Run only one of each group of duplicate args (see `find_duplicates`).
+
+    Pairs are first grouped by the atoms and extents of their fragments and
+    the distance between them, which doesn't need the pair to be written.
+    Only the pairs which share a group are written (in this process) and
+    compared, so the inputs of unique pairs are never built here.
+
+    The results of the representative of each group are given to all of its
+    members, and its density matrix is rotated into the frame of each member.
+    """
+
+    def get_label(qcc_input, charge):
+        if isinstance(qcc_input, _PairTask):
+            projection = qcc_input.get_projection()
+            if projection is not None:
+                return charge, projection[0]
+        return charge, "MINDO3"
+
+    extents = {}
+
+    def get_bucket(n):
+        qcc_input, charge = args[n]
+        if not isinstance(qcc_input, _PairTask):
+            return None
+        frag_i, frag_j, _, _, i_shift, j_shift = qcc_input.get_writer().args
+        for frag in (frag_i, frag_j):
+            # The fragments are shared by all pairs of a chromophore
+            if id(frag) not in extents:
+                extents[id(frag)] = _get_extents(frag.positions)
+        distance = np.linalg.norm(
+            frag_j.positions.mean(axis=0) + j_shift
+            - frag_i.positions.mean(axis=0) - i_shift
+        )
+        return (
+            get_label(qcc_input, charge),
+            frag_i.numbers.tobytes(),
+            frag_j.numbers.tobytes(),
+            extents[id(frag_i)],
+            extents[id(frag_j)],
+            np.round(distance, 1) + 0.0,
+        )
+
+    buckets = {}
+    for n in range(len(args)):
+        buckets.setdefault(get_bucket(n), []).append(n)
+    # Pairs alone in their bucket have no duplicates
+    compare = np.array(
+        sorted(
+            n for key, inds in buckets.items()
+            if key is None or len(inds) > 1 for n in inds
+        ),
+        dtype=int,
+    )
+
+    numbers = {}
+
+    def get_geometries():
+        for n in compare:
+            geometry = _get_geometry(args[n][0])
+            numbers[n] = geometry.numbers
+            yield geometry
+
+    reps = np.arange(len(args))
+    rotations = np.tile(np.eye(3), (len(args), 1, 1))
+    compare_reps, rotations[compare] = find_duplicates(
+        get_geometries(), dedup_tol, [get_label(*args[n]) for n in compare]
+    )
+    reps[compare] = compare[compare_reps]
+    unique = np.flatnonzero(reps == np.arange(len(args)))
+    members = {rep: np.flatnonzero(reps == rep) for rep in unique}
+
+    def broadcast(k, energies, dm):
+        if callback is None:
+            return
+        for i in members[unique[k]]:
+            if dm is not None and i != unique[k]:
+                callback(i, energies, _rotate_dm(dm, numbers[i], rotations[i]))
+            else:
+                callback(i, energies, dm)
+
+    failures = kwargs.pop("failures", None)
+    unique_failures = {}
+    data = _run_qcc(
+        [args[i] for i in unique],
+        callback=broadcast,
+        failures=unique_failures,
+        **kwargs,
+    )
+    if failures is not None:
+        for k, failure in unique_failures.items():
+            failures.update((i, failure) for i in members[unique[k]])
+    return [data[np.searchsorted(unique, rep)] for rep in reps]
+
+
+def _run_qcc(
+    args,
+    nprocs=None,
+    cache=None,
+    callback=None,
+    executor=None,
+    threads_per_proc=None,
+    keep_dm=False,
+    failures=None,
+):
+    """Get the energies of (qcc_input, charge) args, skipping cached ones.
+
+    If given, callback(i, energies, dm) is called with each result as soon as
+    it is available, in any order. The density matrix dm is only returned by
+    the workers if keep_dm is True, otherwise (and for cached results) it is
+    None.
+
+    Pair inputs given as a _PairTask are written by the worker, which also
+    looks them up in the cache, so these inputs are never all in memory. The
+    worker also makes their initial guess, if the task has the density
+    matrices of its chromophores, or projects their orbitals instead of
+    running the SCF, if it is a projection task.
+
+    The most expensive inputs are started first, so the workers aren't left
+    waiting on a few large calculations at the end. If no executor is given,
+    one with nprocs workers and threads_per_proc threads is used for this
+    run.
+
+    If failures is a dict, the reason each input failed (see QCCExecutor) is
+    added to it, keyed by its index. The energies of inputs which failed
+    without a result are NaN, and callback isn't called for them.
+    """
+    cache = _get_cache(cache)
+    data = [None] * len(args)
+    keys = [None] * len(args)
+    if cache is not None:
+        written = [
+            i for i, (qcc_input, charge) in enumerate(args)
+            if not isinstance(qcc_input, _PairTask)
+        ]
+        for i in written:
+            keys[i] = cache.get_key(*args[i])
+        for i, energies in zip(written, cache.get([keys[i] for i in written])):
+            data[i] = energies
+    todo = []
+    for i, energies in enumerate(data):
+        if energies is None:
+            todo.append(i)
+        elif callback is not None:
+            callback(i, energies, None)
+    if not todo:
+        return data
+    n_basis = {i: _get_n_basis(args[i][0]) for i in todo}
+    todo.sort(key=n_basis.get, reverse=True)
+
+    def get_task(i):
+        qcc_input, charge = args[i]
+        if isinstance(qcc_input, _PairTask):
+            return (
+                i,
+                qcc_input.get_writer(),
+                charge,
+                cache,
+                qcc_input.get_dm0(),
+                keep_dm,
+                qcc_input.get_projection(),
+            )
+        return i, qcc_input, charge, None, None, keep_dm, None
+
+    with ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(
+                QCCExecutor(nprocs, threads_per_proc, n_basis[todo[0]])
+            )
+        # The tasks are generated one at a time as the pool takes them
+        tasks = (get_task(i) for i in todo)
+        results = executor.imap_unordered(tasks)
+        for i, key, energies, dm, failure, cacheable in results:
+            if failure is not None and failures is not None:
+                failures[i] = failure
+            if energies is None:
+                data[i] = np.full(4, np.nan)
+                continue
+            data[i] = energies
+            if keys[i] is not None:
+                key = keys[i]
+            # Cache hits and failed or retried results aren't cacheable
+            if cache is not None and key is not None and cacheable:
+                cache.put({key: energies})
+            if callback is not None:
+                callback(i, energies, dm)
+    return data
+
+
+def _get_fingerprint(qcc_input, charge):
+    """Get a short hash of an input, which is written with its energies.
+
+    Pair inputs are hashed from their shifted fragments, so they don't have
+    to be written.
+    """
+    h = hashlib.sha256(str(charge).encode())
+    if isinstance(qcc_input, _PairTask):
+        h.update(b"pair" if qcc_input.charges is None else b"projection")
+        frag_i, frag_j, atom_ids_i, atom_ids_j, i_shift, j_shift = (
+            qcc_input.get_writer().args
+        )
+        arrays = (
+            frag_i.numbers,
+            frag_i.positions + i_shift,
+            frag_j.numbers,
+            frag_j.positions + j_shift,
+            np.asarray(atom_ids_i, dtype=np.int64),
+            np.asarray(atom_ids_j, dtype=np.int64),
+        )
+    else:
+        geometry = _as_geometry(qcc_input)
+        arrays = (geometry.numbers, geometry.positions)
+    for array in arrays:
+        if array.dtype.kind == "f":
+            # Adding 0.0 turns -0.0 into 0.0
+            array = np.round(array, 4) + 0.0
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()[:16]
+
+
+def _read_energies(filename, inds, args):
+    """Read the energies of the inputs written to a file.
+
+    Only the lines of the given inds whose fingerprint matches their input in
+    args are kept, so energies of other inputs with the same indices (e.g.,
+    from another frame) are never reused. Lines which weren't completely
+    written (e.g., if the run was killed) are skipped.
+    """
+    n_inds = len(inds[0]) if inds else 0
+    lines = {}
+    with open(filename, "r") as f:
+        for line in f:
+            values, _, fingerprint = line.partition("#")
+            values = values.split()
+            if not line.endswith("\n") or len(values) != n_inds + 4:
+                continue
+            try:
+                ind = tuple(int(i) for i in values[:n_inds])
+                energies = np.array(values[n_inds:], dtype=float)
+            except ValueError:
+                continue
+            lines[ind] = (energies, fingerprint.strip())
+    results = {}
+    for ind, arg in zip(inds, args):
+        if ind in lines and lines[ind][1] == _get_fingerprint(*arg):
+            results[ind] = lines[ind][0]
+    return results
+
+
+def _energy_line(inds, energies, fingerprint):
+    values = [str(i) for i in inds] + [str(en) for en in energies]
+    return " ".join(values) + f" # {fingerprint}\n"
+
+
+def _run_qcc_checkpointed(
+    groups,
+    nprocs=None,
+    cache=None,
+    executor=None,
+    threads_per_proc=None,
+    dedup_tol=None,
+    failures=None,
+    known_energies=None,
+):
+    """Get the energies of groups of args, writing each to file as it finishes.
+
+    Each group is (inds, args, filename, resume, dms). Each line of a group's
+    file contains the indices of an input, its energies, and a fingerprint of
+    the input in a comment. If resume is True, the inputs which already have
+    a complete line with the same fingerprint in the file are not run again.
+    If dms is a dict, the density matrices of the inputs which are calculated
+    are added to it, keyed by their indices.
+
+    If known_energies is given, it is a dict of energies keyed by the indices
+    of their inputs. These inputs aren't run again, and their energies are
+    used (and written to file) instead.
+
+    The inputs of all of the groups are run together. If dedup_tol is given,
+    only one of each group of duplicate inputs is run (see `find_duplicates`).
+    If failures is a list, an (inds, reason) tuple is added to it for each
+    input which failed (see QCCExecutor). Inputs which failed without a
+    result aren't written.
+
+    Returns the list of energies of each group.
+    """
+    results = []
+    todo = []
+    files = []
+    with ExitStack() as stack:
+        for n, (inds, args, filename, resume, dms) in enumerate(groups):
+            done = {}
+            if resume and filename is not None and os.path.exists(filename):
+                done = _read_energies(filename, inds, args)
+            if known_energies is not None:
+                done.update(
+                    (ind, known_energies[ind])
+                    for ind in inds
+                    if ind in known_energies
+                )
+            results.append(done)
+            todo += [(n, i) for i, ind in enumerate(inds) if ind not in done]
+
+            if filename is None:
+                files.append(None)
+                continue
+            # Rewrite only the complete results for these inputs, then append
+            # the new results as they come in
+            tmp_filename = f"{filename}.tmp"
+            with open(tmp_filename, "w") as f:
+                f.writelines(
+                    _energy_line(ind, done[ind], _get_fingerprint(*arg))
+                    for ind, arg in zip(inds, args)
+                    if ind in done
+                )
+            os.replace(tmp_filename, filename)
+            files.append(stack.enter_context(open(filename, "a")))
+
+        def write(k, energies, dm):
+            n, i = todo[k]
+            inds, args, filename, resume, dms = groups[n]
+            if files[n] is not None:
+                fingerprint = _get_fingerprint(*args[i])
+                files[n].write(_energy_line(inds[i], energies, fingerprint))
+                files[n].flush()
+            if dms is not None and dm is not None:
+                dms[inds[i]] = dm
+
+        run = _run_qcc
+        if dedup_tol is not None:
+            run = functools.partial(_run_qcc_dedup, dedup_tol=dedup_tol)
+        run_failures = {}
+        data = run(
+            [groups[n][1][i] for n, i in todo],
+            nprocs=nprocs,
+            cache=cache,
+            callback=write,
+            executor=executor,
+            threads_per_proc=threads_per_proc,
+            keep_dm=any(group[4] is not None for group in groups),
+            failures=run_failures,
+        )
+    if failures is not None:
+        for k, failure in sorted(run_failures.items()):
+            n, i = todo[k]
+            failures.append((groups[n][0][i], failure))
+    for (n, i), energies in zip(todo, data):
+        results[n][groups[n][0][i]] = energies
+    return [
+        [done[ind] for ind in inds] for done, (inds, *_) in zip(results, groups)
+    ]
+
+
+def _singles_args(chromo_list):
+    inds = [(i,) for i in range(len(chromo_list))]
+    args = [(chromo.qcc_input, chromo.charge) for chromo in chromo_list]
+    return inds, args
+
+
+def _dimer_args(qcc_pairs, chromo_list, dms=None, projection=False):
+    if isinstance(qcc_pairs, QCCPairs):
+        pairs = list(qcc_pairs.pairs)
+        qcc_inputs = [
+            _PairTask(
+                qcc_pairs.writer,
+                i,
+                j,
+                image,
+                dms,
+                (chromo_list[i].charge, chromo_list[j].charge)
+                if projection
+                else None,
+            )
+            for (i, j), image in zip(pairs, qcc_pairs.images)
+        ]
+    elif projection:
+        raise ValueError(
+            "Projected transfer integrals need the pairs as a QCCPairs."
+        )
+    else:
+        pairs = [tuple(pair) for pair, qcc_input in qcc_pairs]
+        qcc_inputs = [qcc_input for pair, qcc_input in qcc_pairs]
+    args = [
+        (qcc_input, chromo_list[i].charge + chromo_list[j].charge)
+        for (i, j), qcc_input in zip(pairs, qcc_inputs)
+    ]
+    return pairs, args
+
+
+def singles_homolumo(
+    chromo_list,
+    filename=None,
+    nprocs=None,
+    cache=None,
+    resume=False,
+    executor=None,
+    threads_per_proc=None,
+    dms=None,
+    dedup_tol=None,
+    failures=None,
+):
+    """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies for all single chromophores.
+
+    Parameters
+    ----------
+    chromo_list : list of Chromophore
+        Chromophores to calculate energies of. Each Chromophore must have
+        qcc_input attribute set.
+    filename : str, default None
+        Path to file where singles energies will be saved. Each line contains
+        the chromophore index, its energies, and a fingerprint of its input in
+        a comment (``i e0 e1 e2 e3 # <fingerprint>``), and is written as soon
+        as the calculation finishes, so the lines are in no particular order.
+        Earlier versions wrote only the energies in chromophore order;
+        `get_singlesdata` reads both. If None, energies will not be saved.
+    nprocs : int, default None
+        Number of processes passed to multiprocessing.Pool. 
+    cache : QCCCache or path, default None
+        A cache (or the path to one) of previously calculated energies. Only
+        the inputs not found in the cache are calculated, and their results
+        are added to it. If None is given, no cache is used.
+    resume : bool, default False
+        Whether to keep the energies already in `filename` (e.g., from a run
+        which was interrupted) and only calculate the missing ones. Lines
+        whose input fingerprint doesn't match the chromophore's current input
+        are calculated again.
+    executor : QCCExecutor, default None
+        The worker processes to run the calculations in. If None is given, a
+        pool of `nprocs` processes is started for this call.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses, if no executor is given.
+        If None is given, the processes and threads are chosen from the size
+        of the largest input (see `get_qcc_threads`).
+    dms : dict, default None
+        If given, the converged density matrix of each chromophore which is
+        calculated is added to it, keyed by the chromophore index. These can
+        be passed to `dimer_homolumo` as the initial guess of the pairs.
+        Energies read from the cache or from `filename` have no density
+        matrix.
+    dedup_tol : float, default None
+        If given, inputs which are the same up to a rigid-body motion, within
+        this RMSD in Angstroms, are only calculated once (see
+        `find_duplicates`).
+    failures : list, default None
+        If given, an (indices, reason) tuple is added to it for each input
+        which failed (see `QCCExecutor`). The energies of inputs which failed
+        without a result are NaN, and they aren't written to the file, so
+        they are calculated again on resume.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Array of energies where each row corresponds to the MO energies of each
+        chromophore in the list.
+    """
+    inds, args = _singles_args(chromo_list)
+    single_dms = {} if dms is not None else None
+    (data,) = _run_qcc_checkpointed(
+        [(inds, args, filename, resume, single_dms)],
+        nprocs,
+        cache,
+        executor,
+        threads_per_proc,
+        dedup_tol,
+        failures,
+    )
+    if dms is not None:
+        dms.update((i, dm) for (i,), dm in single_dms.items())
+
+    data = np.stack(data)
+    return data
+
+def dimer_homolumo(
+    qcc_pairs,
+    chromo_list,
+    filename=None,
+    nprocs=None,
+    cache=None,
+    resume=False,
+    executor=None,
+    threads_per_proc=None,
+    dms=None,
+    dedup_tol=None,
+    failures=None,
+):
+    """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies for all chromophore pairs.
+
+    Parameters
+    ----------
+    qcc_pairs : QCCPairs or list of ((int, int), QCCGeometry)
+        Each item contains a tuple with the indices of the pair and the qcc
+        input.
+        qcc_pairs is returned by `morphct.chromophores.set_neighbors_voronoi`
+        If QCCPairs is given, each input is written by the process which
+        calculates it.
+    chromo_list : list of Chromophore
+        List of chromphores to calculate dimer energies.
+    filename : str, default None
+        Path to file where the pair energies will be saved. Each line contains
+        the pair indices, their energies, and a fingerprint of the pair input
+        in a comment (``i j e0 e1 e2 e3 # <fingerprint>``), and is written as
+        soon as the calculation finishes. If None, energies will not be saved.
+    nprocs : int, default None
+        Number of processes passed to multiprocessing.Pool.
+    cache : QCCCache or path, default None
+        A cache (or the path to one) of previously calculated energies. Only
+        the inputs not found in the cache are calculated, and their results
+        are added to it. If None is given, no cache is used.
+    resume : bool, default False
+        Whether to keep the energies already in `filename` (e.g., from a run
+        which was interrupted) and only calculate the missing pairs. Pairs in
+        the file which aren't in `qcc_pairs`, or whose input fingerprint
+        doesn't match, are removed.
+    executor : QCCExecutor, default None
+        The worker processes to run the calculations in. If None is given, a
+        pool of `nprocs` processes is started for this call.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses, if no executor is given.
+        If None is given, the processes and threads are chosen from the size
+        of the largest input (see `get_qcc_threads`).
+    dms : dict, default None
+        The density matrices of the chromophores keyed by their index (e.g.,
+        from `singles_homolumo`). If both chromophores of a pair have one,
+        the pair calculation starts from their block-diagonal combination,
+        which needs far fewer SCF iterations than pySCF's default guess.
+        Only used if `qcc_pairs` is a QCCPairs.
+    dedup_tol : float, default None
+        If given, inputs which are the same up to a rigid-body motion, within
+        this RMSD in Angstroms, are only calculated once (see
+        `find_duplicates`). Pairs whose chromophores have the same shapes and
+        distance are written in this process to be compared, and one pair of
+        each group of duplicates is kept in memory.
+    failures : list, default None
+        If given, an (indices, reason) tuple is added to it for each input
+        which failed (see `QCCExecutor`). The energies of inputs which failed
+        without a result are NaN, and they aren't written to the file, so
+        they are calculated again on resume.
+
+    Returns
+    -------
+    dimer_data : list of ((int, int), numpy.ndarray)
+        Each list item contains the indices of the pair and an array of its MO
+        energies.
+    """
+    pairs, args = _dimer_args(qcc_pairs, chromo_list, dms)
+    (data,) = _run_qcc_checkpointed(
+        [(pairs, args, filename, resume, None)],
+        nprocs,
+        cache,
+        executor,
+        threads_per_proc,
+        dedup_tol,
+        failures,
+    )
+    dimer_data = [i for i in zip(pairs, data)]
+    return dimer_data
+
+
+def dimer_projection(
+    qcc_pairs,
+    chromo_list,
+    filename=None,
+    nprocs=None,
+    cache=None,
+    resume=False,
+    executor=None,
+    threads_per_proc=None,
+    dms=None,
+    dedup_tol=None,
+    failures=None,
+):
+    """Get the transfer integrals of all chromophore pairs by projection.
+
+    Instead of running an SCF of each pair and splitting its energy levels
+    (see `dimer_homolumo`), the HOMO and LUMO of the two chromophores are
+    projected onto the Fock matrix of the pair, which is built once from the
+    density matrices of the chromophores. This is much cheaper than the pair
+    SCF, and the transfer integrals of pairs which barely interact go to zero
+    instead of being left with the noise of the level splitting.
+
+    Parameters
+    ----------
+    qcc_pairs : QCCPairs
+        The pairs returned by `morphct.chromophores.set_neighbors_voronoi`.
+    chromo_list : list of Chromophore
+        List of chromphores to calculate the transfer integrals of.
+    filename : str, default None
+        Path to file where the transfer integrals will be saved. Each line
+        contains the pair indices and its results, and is written as soon as
+        the calculation finishes. If None, results will not be saved.
+    nprocs : int, default None
+        Number of processes passed to multiprocessing.Pool.
+    cache : QCCCache or path, default None
+        A cache (or the path to one) of previously calculated results. Only
+        the pairs not found in the cache are calculated, and their results
+        are added to it. If None is given, no cache is used.
+    resume : bool, default False
+        Whether to keep the results already in `filename` (e.g., from a run
+        which was interrupted) and only calculate the missing pairs. Lines
+        whose input fingerprint doesn't match are calculated again.
+    executor : QCCExecutor, default None
+        The worker processes to run the calculations in. If None is given, a
+        pool of `nprocs` processes is started for this call.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses, if no executor is given.
+        If None is given, the processes and threads are chosen from the size
+        of the largest input (see `get_qcc_threads`).
+    dms : dict, default None
+        The density matrices of the chromophores keyed by their index (e.g.,
+        from `singles_homolumo`). The SCF of a chromophore without one is run
+        again for each of its pairs.
+    dedup_tol : float, default None
+        If given, inputs which are the same up to a rigid-body motion, within
+        this RMSD in Angstroms, are only calculated once (see
+        `find_duplicates`). Pairs whose chromophores have the same shapes and
+        distance are written in this process to be compared, and one pair of
+        each group of duplicates is kept in memory.
+    failures : list, default None
+        If given, an (indices, reason) tuple is added to it for each input
+        which failed (see `QCCExecutor`). The energies of inputs which failed
+        without a result are NaN, and they aren't written to the file, so
+        they are calculated again on resume.
+
+    Returns
+    -------
+    dimer_data : list of ((int, int), numpy.ndarray)
+        Each list item contains the indices of the pair and an array of its
+        HOMO and LUMO transfer integrals and the differences of its HOMO and
+        LUMO site energies, in eV.
+
+    Raises
+    ------
+    ValueError
+        If `qcc_pairs` isn't a QCCPairs.
+    """
+    pairs, args = _dimer_args(qcc_pairs, chromo_list, dms, projection=True)
+    (data,) = _run_qcc_checkpointed(
+        [(pairs, args, filename, resume, None)],
+        nprocs,
+        cache,
+        executor,
+        threads_per_proc,
+        dedup_tol,
+        failures,
+    )
+    dimer_data = [i for i in zip(pairs, data)]
+    return dimer_data
+
+
+def singles_dimer_homolumo(
+    chromo_list,
+    qcc_pairs,
+    s_filename=None,
+    d_filename=None,
+    nprocs=None,
+    cache=None,
+    resume=False,
+    executor=None,
+    threads_per_proc=None,
+    warm_start=False,
+    ti_method="splitting",
+    dedup_tol=None,
+    surrogate_kwargs=None,
+    failures=None,
+):
+    """Get the HOMO-1, HOMO, LUMO, LUMO+1 energies of chromophores and pairs.
+
+    The singles and dimers are run together, starting with the most expensive
+    inputs, so the workers aren't left idle while the last few calculations of
+    `singles_homolumo` or `dimer_homolumo` finish.
+
+    With `warm_start`, or if the transfer integrals are projected or
+    predicted, the singles are run first instead and the density matrices of
+    the chromophores are used for their pairs.
+
+    Parameters
+    ----------
+    chromo_list : list of Chromophore
+        Chromophores to calculate energies of. Each Chromophore must have
+        qcc_input attribute set.
+    qcc_pairs : QCCPairs or list of ((int, int), QCCGeometry)
+        Each item contains a tuple with the indices of the pair and the qcc
+        input.
+        qcc_pairs is returned by `morphct.chromophores.set_neighbors_voronoi`
+    s_filename : str, default None
+        Path to file where singles energies will be saved (see
+        `singles_homolumo`). If None, energies will not be saved.
+    d_filename : str, default None
+        Path to file where the pair energies will be saved (see
+        `dimer_homolumo`). If None, energies will not be saved.
+    nprocs : int, default None
+        Number of processes passed to multiprocessing.Pool.
+    cache : QCCCache or path, default None
+        A cache (or the path to one) of previously calculated energies. Only
+        the inputs not found in the cache are calculated, and their results
+        are added to it. If None is given, no cache is used.
+    resume : bool, default False
+        Whether to keep the energies already in `s_filename` and `d_filename`
+        (e.g., from a run which was interrupted) and only calculate the
+        missing ones. Lines whose input fingerprint doesn't match are
+        calculated again.
+    executor : QCCExecutor, default None
+        The worker processes to run the calculations in. If None is given, a
+        pool of `nprocs` processes is started for this call.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses, if no executor is given.
+        If None is given, the processes and threads are chosen from the size
+        of the largest input (see `get_qcc_threads`).
+    warm_start : bool, default False
+        Whether to start the pair calculations from the density matrices of
+        their chromophores (see `dimer_homolumo`). Only used if `qcc_pairs`
+        is a QCCPairs.
+    ti_method : str, default "splitting"
+        How the pairs are calculated. "splitting" gets the MO energies of
+        each pair (see `dimer_homolumo`), "projection" gets the transfer
+        integrals by projecting the orbitals of the chromophores (see
+        `dimer_projection`), and "surrogate" calculates a sample of the pairs
+        and predicts the MO energies of the rest (see `dimer_surrogate`).
+    dedup_tol : float, default None
+        If given, inputs which are the same up to a rigid-body motion, within
+        this RMSD in Angstroms, are only calculated once (see
+        `find_duplicates`). Pairs whose chromophores have the same shapes and
+        distance are written in this process to be compared, and one pair of
+        each group of duplicates is kept in memory.
+    surrogate_kwargs : dict, default None
+        Keyword arguments passed to `dimer_surrogate` (e.g., `max_std`), if
+        `ti_method` is "surrogate".
+    failures : list, default None
+        If given, an (indices, reason) tuple is added to it for each input
+        which failed (see `QCCExecutor`). The energies of inputs which failed
+        without a result are NaN, and they aren't written to the file, so
+        they are calculated again on resume.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Array of energies where each row corresponds to the MO energies of each
+        chromophore in the list.
+    dimer_data : list of ((int, int), numpy.ndarray)
+        Each list item contains the indices of the pair and an array of its MO
+        energies, or of its projected transfer integrals.
+
+    Raises
+    ------
+    ValueError
+        If `ti_method` isn't "splitting", "projection" or "surrogate".
+    """
+    if ti_method not in ("splitting", "projection", "surrogate"):
+        raise ValueError(
+            "ti_method must be 'splitting', 'projection' or 'surrogate', not "
+            f"{ti_method!r}"
+        )
+    projection = ti_method == "projection"
+    inds, args = _singles_args(chromo_list)
+    if not warm_start and ti_method == "splitting":
+        pairs, pair_args = _dimer_args(qcc_pairs, chromo_list)
+        data, pair_data = _run_qcc_checkpointed(
+            [
+                (inds, args, s_filename, resume, None),
+                (pairs, pair_args, d_filename, resume, None),
+            ],
+            nprocs,
+            cache,
+            executor,
+            threads_per_proc,
+            dedup_tol,
+            failures,
+        )
+        return np.stack(data), list(zip(pairs, pair_data))
+
+    with ExitStack() as stack:
+        pair_split = None
+        if executor is None:
+            # Use one pool for both the singles and the pairs, unless the
+            # pairs need more threads in each process than the singles
+            pairs, pair_args = _dimer_args(
+                qcc_pairs, chromo_list, projection=projection
+            )
+            singles_split, pair_split = [
+                get_qcc_threads(
+                    nprocs,
+                    threads_per_proc,
+                    max((_get_n_basis(q) for q, c in inputs), default=0),
+                )
+                for inputs in (args, pair_args)
+            ]
+            executor = stack.enter_context(QCCExecutor(*singles_split))
+        dms = {}
+        data = singles_homolumo(
+            chromo_list,
+            s_filename,
+            cache=cache,
+            resume=resume,
+            executor=executor,
+            dms=dms,
+            dedup_tol=dedup_tol,
+            failures=failures,
+        )
+        if pair_split is not None and pair_split != singles_split:
+            stack.close()
+            executor = stack.enter_context(QCCExecutor(*pair_split))
+        kwargs = {}
+        if ti_method == "surrogate":
+            dimer_func = functools.partial(dimer_surrogate, singles_data=data)
+            kwargs = surrogate_kwargs or {}
+        elif projection:
+            dimer_func = dimer_projection
+        else:
+            dimer_func = dimer_homolumo
+        dimer_data = dimer_func(
+            qcc_pairs,
+            chromo_list,
+            filename=d_filename,
+            cache=cache,
+            resume=resume,
+            executor=executor,
+            dms=dms,
+            dedup_tol=dedup_tol,
+            failures=failures,
+            **kwargs,
+        )
+    return data, dimer_data
+
+
+def get_dimerdata(filename):
+    """Read in the saved data created by `dimer_homolumo`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to file where the dimer energies were saved.
+
+    Returns
+    -------
+    dimer_data : list of ((int, int), numpy.ndarray)
+        Each list item contains the indices of the pair and an array of its MO
+        energies.
+    """
+    dimer_data = []
+    with open(filename, "r") as f:
+        for i in f.readlines():
+            # Newer files have a fingerprint of the input in a comment
+            values = i.partition("#")[0].split()
+            if not values:
+                continue
+            a, b, c, d, e, f = values
+            dimer_data.append(
+                ((int(a), int(b)), (float(c), float(d), float(e), float(f)))
+            )
+    return dimer_data
+
+
+def get_singlesdata(filename):
+    """Read in the saved data created by `singles_homolumo`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to file where the singles energies were saved.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of energies where each row corresponds to the MO energies of each
+        chromophore in the list.
+
+    Raises
+    ------
+    ValueError
+        If the chromophore indices in the file aren't exactly 0 to n-1.
+    """
+    data = np.loadtxt(filename, ndmin=2)
+    if data.shape[1] == 4:
+        # Older files only have the energies in chromophore order
+        return data
+    # Lines contain the chromophore index and energies in any order
+    inds = data[:, 0].astype(int)
+    if not np.array_equal(np.sort(inds), np.arange(len(data))):
+        missing = np.setdiff1d(np.arange(inds.max(initial=-1) + 1), inds)
+        raise ValueError(
+            f"The chromophore indices in {filename} must be 0 to "
+            f"{len(data) - 1} with each appearing once. Missing indices: "
+            f"{missing.tolist()}. Rerun the singles calculation to complete "
+            "the file."
+        )
+    energies = np.empty((len(data), 4))
+    energies[inds] = data[:, 1:]
+    return energies
+
+
+def set_energyvalues(
+    chromo_list,
+    s_filename,
+    d_filename,
+    skipped_pairs=None,
+    ti_method="splitting",
+):
+    """Set the energy attributes of the Chromophore objects in chromo_list.
+
+    Run singles_homolumo and dimer_homolumo (or dimer_projection) first to get
+    the energy files.
+    Energy values set by this function:
+        homo_1, homo, lumo, lumo_1, neighbors_delta_e, neighbors_ti
+
+    Parameters
+    ----------
+    chromo_list : list of Chromophore
+        Set the energy values of the chromphores in this list.
+    s_filename : str
+        Path to file where the singles energies were saved.
+    d_filename : str
+        Path to file where the pair energies were saved.
+    skipped_pairs : list of (int, int), default None
+        Pairs which weren't calculated (see `screen_pairs`). Their transfer
+        integral is set to zero.
+    ti_method : str, default "splitting"
+        How `d_filename` was calculated. If "projection", it contains the
+        transfer integrals from `dimer_projection` rather than MO energies.
+        The files of "splitting" and "surrogate" (see `dimer_surrogate`)
+        have the same format.
+    """
+    s_data = get_singlesdata(s_filename)
+    d_data = get_dimerdata(d_filename)
+
+    for i, chromo in enumerate(chromo_list):
+        chromo.homo_1, chromo.homo, chromo.lumo, chromo.lumo_1 = s_data[i]
+
+    if skipped_pairs is not None:
+        for i, j in skipped_pairs:
+            ichromo = chromo_list[i]
+            jchromo = chromo_list[j]
+            ineighborind = [i for i, img in ichromo.neighbors].index(j)
+            jneighborind = [i for i, img in jchromo.neighbors].index(i)
+            deltaE = ti.calculate_delta_E(ichromo, jchromo)
+            ichromo.neighbors_delta_e[ineighborind] = deltaE
+            jchromo.neighbors_delta_e[jneighborind] = -deltaE
+            ichromo.neighbors_ti[ineighborind] = 0
+            jchromo.neighbors_ti[jneighborind] = 0
+
+    for (i, j), values in d_data:
+        ichromo = chromo_list[i]
+        jchromo = chromo_list[j]
+        ineighborind = [i for i, img in ichromo.neighbors].index(j)
+        jneighborind = [i for i, img in jchromo.neighbors].index(i)
+        deltaE = ti.calculate_delta_E(ichromo, jchromo)
+        ichromo.neighbors_delta_e[ineighborind] = deltaE
+        jchromo.neighbors_delta_e[jneighborind] = -deltaE
+
+        assert ichromo.species == jchromo.species
+        if ti_method == "projection":
+            j_homo, j_lumo, de_homo, de_lumo = values
+            if ichromo.species == "donor":
+                transint = abs(j_homo)
+            else:
+                transint = abs(j_lumo)
+        else:
+            homo_1, homo, lumo, lumo_1 = values
+            if ichromo.species == "donor":
+                transint = ti.calculate_ti(homo - homo_1, deltaE)
+            else:
+                transint = ti.calculate_ti(lumo - lumo_1, deltaE)
+        ichromo.neighbors_ti[ineighborind] = transint
+        jchromo.neighbors_ti[jneighborind] = transint
+
+
+class SnapshotIndex:
+    """Geometry and topology lookups of a snapshot for writing QCC inputs.
+
+    Writing a QCC input needs the unwrapped positions and elements of the
+    chromophore's atoms and the bonds which leave the chromophore (to cap them
+    with hydrogens). Computing these once per snapshot means each input only
+    has to look at its own atoms rather than the whole snapshot.
+
+    Parameters
+    ----------
+    snap : gsd.hoomd.Snapshot
+        Atomistic simulation snapshot from a GSD file. It is expected that the
+        lengths in this file have been converted to Angstroms.
+    conversion_dict : dictionary, default None
+        A dictionary that maps the atom type to its element. e.g., `{'c3': C}`.
+        An instance that maps AMBER types to their element can be found in
+        `amber_dict`. If None is given, assume the particles already have
+        element names.
+
+    Attributes
+    ----------
+    box : numpy.ndarray, shape (3,)
+        The lengths of the box vectors.
+    unwrapped_pos : numpy.ndarray, shape (N, 3)
+        The unwrapped positions of the particles.
+    bond_indptr : numpy.ndarray of int, shape (N+1,)
+        Index pointer array into `bond_ids` and `bond_partners` for each
+        particle.
+    bond_ids : numpy.ndarray of int
+        The index in the snapshot bonds of each bond of each particle.
+    bond_partners : numpy.ndarray of int
+        The other particle of each bond of each particle.
+    """
+
+    def __init__(self, snap, conversion_dict=None):
+        self.types = snap.particles.types
+        self.typeid = snap.particles.typeid
+        self.conversion_dict = conversion_dict
+        self._elements = {}
+
+        self.box = snap.configuration.box[:3]
+        self.unwrapped_pos = (
+            snap.particles.position + snap.particles.image * self.box
+        )
+
+        # Store the bonds of each particle in CSR format
+        bonds = np.asarray(snap.bonds.group, dtype=int).reshape(-1, 2)
+        rows = np.concatenate((bonds[:, 0], bonds[:, 1]))
+        partners = np.concatenate((bonds[:, 1], bonds[:, 0]))
+        bond_ids = np.tile(np.arange(len(bonds)), 2)
+        order = np.argsort(rows, kind="stable")
+        counts = np.bincount(rows, minlength=snap.particles.N)
+        self.bond_indptr = np.concatenate(([0], np.cumsum(counts)))
+        self.bond_ids = bond_ids[order]
+        self.bond_partners = partners[order]
+
+    def get_element(self, i):
+        """Get the element of a particle.
+
+        Parameters
+        ----------
+        i : int
+            Snapshot index of the particle.
+
+        Returns
+        -------
+        ele.element.Element
+            The element of the particle.
+        """
+        typeid = self.typeid[i]
+        if typeid not in self._elements:
+            if self.conversion_dict is not None:
+                element = self.conversion_dict[self.types[typeid]]
+            else:
+                element = ele.element_from_symbol(self.types[typeid])
+            self._elements[typeid] = element
+        return self._elements[typeid]
+
+    def get_symbols(self, atom_ids):
+        """Get the element symbols of some particles.
+
+        Parameters
+        ----------
+        atom_ids : numpy.ndarray of int
+            Snapshot indices of the particles.
+
+        Returns
+        -------
+        list of str
+            The element symbol of each particle.
+        """
+        return [self.get_element(i).symbol for i in atom_ids]
+
+    def get_boundary_bonds(self, atom_ids):
+        """Get the bonds from a group of particles to particles outside it.
+
+        Parameters
+        ----------
+        atom_ids : numpy.ndarray of int
+            Snapshot indices of the particles in the group.
+
+        Returns
+        -------
+        numpy.ndarray of int, numpy.ndarray of int, numpy.ndarray of int
+            The particle inside and the particle outside the group, and the
+            index in the snapshot bonds, of each bond. The bonds are in the
+            order they are in the snapshot.
+        """
+        atom_ids = np.asarray(atom_ids, dtype=int)
+        starts = self.bond_indptr[atom_ids]
+        degrees = self.bond_indptr[atom_ids + 1] - starts
+        offsets = np.cumsum(degrees) - degrees
+        edges = np.repeat(starts - offsets, degrees) + np.arange(degrees.sum())
+        inside = np.repeat(atom_ids, degrees)
+        outside = self.bond_partners[edges]
+        leaving = ~np.isin(outside, atom_ids)
+        # np.unique sorts the bonds and removes any repeats
+        bond_ids, first = np.unique(
+            self.bond_ids[edges][leaving], return_index=True
+        )
+        return inside[leaving][first], outside[leaving][first], bond_ids
+
+
+class CappedFragment:
+    """The atoms of a chromophore with hydrogen caps on its broken bonds.
+
+    The positions are unwrapped and not centered, so the fragments of two
+    chromophores can be shifted and joined into a pair input without walking
+    the bonds again.
+
+    Parameters
+    ----------
+    snap_index : SnapshotIndex
+        The index of the snapshot.
+    atom_ids : numpy.ndarray of int
+        Snapshot indices of the particles in the chromophore.
+
+    Attributes
+    ----------
+    n_atoms : int
+        The number of atoms (not including caps).
+    numbers : numpy.ndarray of numpy.uint8
+        The atomic number of each atom followed by each cap.
+    positions : numpy.ndarray, shape (n_atoms + n_caps, 3)
+        The unwrapped positions of each atom followed by each cap.
+    cap_bonds : numpy.ndarray of int
+        The snapshot bond index which each cap replaces.
+    cap_partners : numpy.ndarray of int
+        The snapshot index of the particle outside the chromophore which each
+        cap replaces.
+    """
+
+    def __init__(self, snap_index, atom_ids):
+        unwrapped_pos = snap_index.unwrapped_pos
+        self.n_atoms = len(atom_ids)
+        atoms = [snap_index.get_element(i).atomic_number for i in atom_ids]
+        positions = list(unwrapped_pos[atom_ids])
+
+        # To determine where to add hydrogens, check the bonds that go to
+        # particles outside of the ids provided
+        inside, outside, bond_ids = snap_index.get_boundary_bonds(atom_ids)
+        for i, j in zip(inside, outside):
+            element = snap_index.get_element(j)
+            # If it's already a Hydrogen, just add it
             if element.atomic_number == 1:
-                atoms.append(element.symbol)
-                positions.append(unwrapped_pos[i] + shift)
+                atoms.append(1)
+                positions.append(unwrapped_pos[j])
+            # If it's not a hydrogen, use the existing bond vector to
+            # determine the direction and scale it to a more reasonable
+            # length for C-H bond
             else:
-                v = unwrapped_pos[i] - unwrapped_pos[j]
+                # Average sp3 C-H bond is 1.094 Angstrom
+                v = unwrapped_pos[j] - unwrapped_pos[i]
                 unit_vec = v / np.linalg.norm(v)
-                new_pos = unit_vec * 1.094 + unwrapped_pos[j] + shift
-                atoms.append("H")
+                new_pos = unit_vec * 1.094 + unwrapped_pos[i]
+                atoms.append(1)
                 positions.append(new_pos)
 
-    # Shift center to origin
-    positions = np.stack(positions)
+        self.numbers = np.array(atoms, dtype=np.uint8)
+        self.positions = np.stack(positions)
+        self.cap_bonds = bond_ids
+        self.cap_partners = outside
+
+
+def _centered_geometry(numbers, positions):
+    """Shift the center of the positions to the origin."""
+    positions = np.array(positions, dtype=np.float64)
     positions -= np.mean(positions, axis=0)
+    return QCCGeometry(numbers, positions)
+
+
+def write_qcc_inp(
+    snap, atom_ids, conversion_dict=None, snap_index=None, fragment=None
+):
+    """Write a quantum chemical input.
+
+    The input contains the elements and positions in Angstroms, centered at
+    the origin. See https://pyscf.org/quickstart.html for more information.
+
+    Parameters
+    ----------
+    snap : gsd.hoomd.Snapshot
+        Atomistic simulation snapshot from a GSD file. It is expected that the
+        lengths in this file have been converted to Angstroms.
+    atom_ids : numpy.ndarray of int
+        Snapshot indices of the particles to include in the input string.
+    conversion_dict : dictionary, default None
+        A dictionary that maps the atom type to its element. e.g., `{'c3': C}`.
+        An instance that maps AMBER types to their element can be found in
+        `amber_dict`. If None is given, assume the particles already have
+        element names.
+    snap_index : SnapshotIndex, default None
+        The index of `snap`. If None is given, one will be created, so pass an
+        index when writing inputs for many chromophores.
+    fragment : CappedFragment, default None
+        The capped fragment of `atom_ids`, if it has already been made.
+
+    Returns
+    -------
+    QCCGeometry
+        The input for the MINDO3 quantum chemical calculation run in pySCF.
+        `QCCGeometry.to_string` gives the pySCF input string.
+    """
+    if fragment is None:
+        if snap_index is None:
+            snap_index = SnapshotIndex(snap, conversion_dict)
+        fragment = CappedFragment(snap_index, atom_ids)
+    return _centered_geometry(fragment.numbers, fragment.positions)
+
+
+def write_qcc_pair_input(
+    snap, chromo_i, chromo_j, j_shift, conversion_dict=None, snap_index=None
+    ):
+    """Write a quantum chemical input for chromophore pairs.
+
+    Pair input requires taking periodic images into account.
+    The input contains the elements and positions in Angstroms, centered at
+    the origin. See https://pyscf.org/quickstart.html for more information.
+
+    The input is made by joining the capped fragments of the chromophores
+    (see `CappedFragment`), so if the chromophores have a `qcc_fragment`
+    (i.e., they were made with a snapshot index), only their own atoms and
+    bonds are looked at.
+
+    Parameters
+    ----------
+    snap : gsd.hoomd.Snapshot
+        Atomistic simulation snapshot from a GSD file. It is expected that the
+        lengths in this file have been converted to Angstroms.
+    chromo_i : Chromophore
+        One of the chromophores to be written.
+    chromo_j : Chromophore
+        One of the chromophores to be written.
+    j_shift : numpy.ndarray(3)
+        Vector to shift chromo_j.
+        (chromo_j minimum image center - unwrapped center)
+    conversion_dict : dictionary, default None
+        A dictionary that maps the atom type to its element. e.g., `{'c3': C}`.
+        An instance that maps AMBER types to their element can be found in
+        `amber_dict`. If None is given, assume the particles already have
+        element names.
+    snap_index : SnapshotIndex, default None
+        The index of `snap`. If None is given and the chromophores don't have
+        their fragments set, one will be created.
+
+    Returns
+    -------
+    QCCGeometry
+        The input for the MINDO3 quantum chemical calculation run in pySCF.
+        `QCCGeometry.to_string` gives the pySCF input string.
+    """
+    fragments = []
+    for chromo in [chromo_i, chromo_j]:
+        fragment = getattr(chromo, "qcc_fragment", None)
+        if fragment is None:
+            if snap_index is None:
+                snap_index = SnapshotIndex(snap, conversion_dict)
+            fragment = CappedFragment(snap_index, chromo.atom_ids)
+        fragments.append(fragment)
+    frag_i, frag_j = fragments
+
+    # chromophore i is shifted into 0,0,0 image
+    i_shift = chromo_i.image * snap.configuration.box[:3]
+    return _join_fragments(
+        frag_i, frag_j, chromo_i.atom_ids, chromo_j.atom_ids, i_shift, j_shift
+    )
+
+
+def _pair_atom_order(frag_i, frag_j, atom_ids_i, atom_ids_j):
+    """Get the atoms of a pair input from the atoms of its two fragments.
+
+    Returns the indices into the atoms of fragment i followed by the atoms of
+    fragment j.
+    """
+    # Caps on the bonds between the chromophores aren't needed. If the
+    # chromophores share atoms, a cap is taken from chromophore j.
+    keep_j = ~np.isin(frag_j.cap_partners, atom_ids_i)
+    keep_i = ~np.isin(frag_i.cap_partners, atom_ids_j)
+    keep_i &= ~np.isin(frag_i.cap_bonds, frag_j.cap_bonds[keep_j])
+    n_i = len(frag_i.numbers)
+    caps_i = np.arange(frag_i.n_atoms, n_i)[keep_i]
+    caps_j = np.arange(frag_j.n_atoms, len(frag_j.numbers))[keep_j] + n_i
+    # The caps of both chromophores are ordered by their bonds
+    cap_bonds = np.concatenate(
+        (frag_i.cap_bonds[keep_i], frag_j.cap_bonds[keep_j])
+    )
+    order = np.argsort(cap_bonds, kind="stable")
+    return np.concatenate(
+        (
+            np.arange(frag_i.n_atoms),
+            np.arange(frag_j.n_atoms) + n_i,
+            np.concatenate((caps_i, caps_j))[order],
+        )
+    )
+
+
+def _join_fragments(frag_i, frag_j, atom_ids_i, atom_ids_j, i_shift, j_shift):
+    """Write the pair input of two shifted capped fragments."""
+    inds = _pair_atom_order(frag_i, frag_j, atom_ids_i, atom_ids_j)
+    atoms = np.concatenate((frag_i.numbers, frag_j.numbers))[inds]
+    positions = np.concatenate(
+        (frag_i.positions + i_shift, frag_j.positions + j_shift)
+    )[inds]
+    return _centered_geometry(atoms, positions)
+
+
+def _pair_aos(frag_i, frag_j, atom_ids_i, atom_ids_j):
+    """Get the orbitals of a pair input from the orbitals of its fragments.
+
+    Returns the indices into the orbitals of fragment i followed by the
+    orbitals of fragment j.
+    """
+    inds = _pair_atom_order(frag_i, frag_j, atom_ids_i, atom_ids_j)
+    n_ao = _get_n_ao(np.concatenate((frag_i.numbers, frag_j.numbers)))
+    ao_loc = np.concatenate(([0], np.cumsum(n_ao)))
+    return np.concatenate(
+        [np.arange(ao_loc[k], ao_loc[k + 1]) for k in inds]
+    )
+
+
+def _pair_dm0(frag_i, frag_j, atom_ids_i, atom_ids_j, dm_i, dm_j):
+    """Make an initial guess of the pair density matrix.
+
+    The guess is the block diagonal of the density matrices of the two
+    chromophores, with the orbitals of the dropped caps removed.
+    """
+    aos = _pair_aos(frag_i, frag_j, atom_ids_i, atom_ids_j)
+    n_i = len(dm_i)
+    dm = np.zeros((n_i + len(dm_j), n_i + len(dm_j)))
+    dm[:n_i, :n_i] = dm_i
+    dm[n_i:, n_i:] = dm_j
+    return dm[np.ix_(aos, aos)]
+
+
+def _get_fock(qcc_input, charge, dm):
+    """Build the MINDO3 Fock matrix (in Hartree) of a density matrix."""
+    mol = pyscf.M(atom=qcc_input.to_pyscf(), charge=charge)
+    mf = MINDO3(mol)
+    return mf.get_hcore() + mf.get_veff(dm=dm)
+
+
+def _pair_projection(
+    frag_i, frag_j, atom_ids_i, atom_ids_j, charges, dm_i, dm_j, qcc_input
+):
+    """Get the transfer integrals of a pair from the orbitals of its fragments.
+
+    The HOMO and LUMO of each chromophore are found from its own Fock matrix,
+    mapped onto the orbitals of the pair input `qcc_input`, and projected onto
+    the Fock matrix of the pair built once from the block-diagonal density
+    matrix, so no SCF of the pair is run. MINDO3 neglects the overlap between
+    orbitals, so the orbitals of the two chromophores are orthogonal and the
+    transfer integrals are the off-diagonal elements.
+
+    If the density matrix of a chromophore is None, its SCF is run here.
+
+    Returns
+    -------
+    numpy.ndarray
+        The HOMO and LUMO transfer integrals and the differences (i minus j)
+        of the HOMO and LUMO site energies in eV.
+    """
+    orbitals = []
+    dms = []
+    for fragment, charge, dm in zip((frag_i, frag_j), charges, (dm_i, dm_j)):
+        geometry = _centered_geometry(fragment.numbers, fragment.positions)
+        if dm is None:
+            energies, dm = get_homolumo(geometry, charge=charge, return_dm=True)
+        mo_coeff = np.linalg.eigh(_get_fock(geometry, charge, dm))[1]
+        # The overlap is the identity, so the trace is the number of electrons
+        n_occ = int(round(np.trace(dm))) // 2
+        orbitals.append(mo_coeff[:, n_occ - 1 : n_occ + 1])
+        dms.append(dm)
+
+    n_i = len(dms[0])
+    mo_coeff = np.zeros((n_i + len(dms[1]), 4))
+    mo_coeff[:n_i, :2] = orbitals[0]
+    mo_coeff[n_i:, 2:] = orbitals[1]
+    # Removing the orbitals of the dropped caps leaves the frontier orbitals
+    # slightly unnormalized
+    mo_coeff = mo_coeff[_pair_aos(frag_i, frag_j, atom_ids_i, atom_ids_j)]
+    mo_coeff /= np.linalg.norm(mo_coeff, axis=0)
+
+    dm = _pair_dm0(frag_i, frag_j, atom_ids_i, atom_ids_j, *dms)
+    fock = _get_fock(qcc_input, sum(charges), dm)
+    h = mo_coeff.T @ fock @ mo_coeff * 27.2114  # convert Eh to eV
+    return np.array([h[0, 2], h[1, 3], h[0, 0] - h[2, 2], h[1, 1] - h[3, 3]])
+
+
+class _PairWriter:
+    """Write pair inputs from the capped fragments of the chromophores."""
+
+    def __init__(self, chromo_list, snap_index):
+        self.box = snap_index.box
+        self.fragments = []
+        for chromo in chromo_list:
+            fragment = getattr(chromo, "qcc_fragment", None)
+            if fragment is None:
+                fragment = CappedFragment(snap_index, chromo.atom_ids)
+            self.fragments.append(fragment)
+        self.atom_ids = [chromo.atom_ids for chromo in chromo_list]
+        self.images = [chromo.image for chromo in chromo_list]
+        self.centers = [chromo.center for chromo in chromo_list]
+        self.unwrapped_centers = [
+            chromo.unwrapped_center for chromo in chromo_list
+        ]
+        self.n_basis = [
+            _get_n_basis(QCCGeometry(fragment.numbers, fragment.positions))
+            for fragment in self.fragments
+        ]
+
+    def __call__(self, i, j, image):
+        return self.get_task(i, j, image)()
+
+    def get_task(self, i, j, image):
+        """Get a function which writes the pair input.
+
+        It only holds the fragments of the pair, so it is cheap to send to
+        a worker process.
+        """
+        # chromophore i is shifted into 0,0,0 image and chromophore j is
+        # shifted to its image closest to chromophore i
+        i_shift = self.images[i] * self.box
+        sc_center = self.centers[j] + np.array(image) * self.box
+        j_shift = sc_center - self.unwrapped_centers[j]
+        return functools.partial(
+            _join_fragments,
+            self.fragments[i],
+            self.fragments[j],
+            self.atom_ids[i],
+            self.atom_ids[j],
+            i_shift,
+            j_shift,
+        )
+
+    def get_dm0_task(self, i, j, dm_i, dm_j):
+        """Get a function which makes the initial guess of the pair."""
+        return functools.partial(
+            _pair_dm0,
+            self.fragments[i],
+            self.fragments[j],
+            self.atom_ids[i],
+            self.atom_ids[j],
+            dm_i,
+            dm_j,
+        )
+
+    def get_projection_task(self, i, j, charges, dm_i=None, dm_j=None):
+        """Get a function which projects the orbitals of the pair."""
+        return functools.partial(
+            _pair_projection,
+            self.fragments[i],
+            self.fragments[j],
+            self.atom_ids[i],
+            self.atom_ids[j],
+            charges,
+            dm_i,
+            dm_j,
+        )
+
+
+class _PairTask:
+    """The input of a pair which is written when it is needed."""
+
+    __slots__ = ("writer", "i", "j", "image", "dms", "charges")
+
+    def __init__(self, writer, i, j, image, dms=None, charges=None):
+        self.writer = writer
+        self.i = i
+        self.j = j
+        self.image = image
+        self.dms = dms
+        # Only projection tasks have the charges of the chromophores
+        self.charges = charges
+
+    @property
+    def n_basis(self):
+        """int: The number of basis functions of the pair (with all caps)."""
+        return self.writer.n_basis[self.i] + self.writer.n_basis[self.j]
+
+    def get_writer(self):
+        """Get a function which writes the input in a worker process."""
+        return self.writer.get_task(self.i, self.j, self.image)
+
+    def get_dm0(self):
+        """Get a function which makes the initial guess in a worker process.
+
+        Returns None if either chromophore has no density matrix.
+        """
+        if self.dms is None:
+            return None
+        if self.i not in self.dms or self.j not in self.dms:
+            return None
+        return self.writer.get_dm0_task(
+            self.i, self.j, self.dms[self.i], self.dms[self.j]
+        )
 
-    qcc_input = " ".join(
-        [f"{atom} {x} {y} {z};" for atom, (x, y, z) in zip(atoms, positions)]
+    def get_projection(self):
+        """Get the cache method and the function which projects the orbitals.
+
+        Returns None if this isn't a projection task.
+        """
+        if self.charges is None:
+            return None
+        dms = {} if self.dms is None else self.dms
+        dm_i, dm_j = dms.get(self.i), dms.get(self.j)
+        # The same pair input is split differently for other chromophores, and
+        # orbitals from the density matrices of the singles (which may have
+        # been warm-started or retried) can differ from those of a new SCF
+        sources = "-".join(
+            "scf" if dm is None else "singles" for dm in (dm_i, dm_j)
+        )
+        n_atoms = self.writer.fragments[self.i].n_atoms
+        method = f"MINDO3-projection-{n_atoms}-{sources}"
+        return method, self.writer.get_projection_task(
+            self.i, self.j, self.charges, dm_i, dm_j
+        )
+
+
+class QCCPairs:
+    """The QCC inputs of chromophore pairs, written when they are needed.
+
+    Only the indices and the relative periodic image of each pair are stored.
+    Each input is joined from the capped fragments of the chromophores when it
+    is accessed (see `write_qcc_pair_input`), so the inputs of all the pairs
+    are never in memory at once. `dimer_homolumo` writes each input in the
+    process which calculates it.
+
+    Indexing or iterating gives ((int, int), QCCGeometry) items, the same as a
+    list of the pair indices and their inputs.
+
+    Parameters
+    ----------
+    chromo_list : list of Chromophore
+        The chromophores which the pair indices refer to.
+    snap_index : SnapshotIndex
+        The index of the snapshot the chromophores are from.
+
+    Attributes
+    ----------
+    pairs : list of (int, int)
+        The indices of the chromophores in each pair.
+    images : list of (int, int, int)
+        The periodic image of chromophore j closest to chromophore i.
+    writer : _PairWriter
+        Writes the input of a pair from its indices and image.
+    """
+
+    def __init__(self, chromo_list, snap_index):
+        self.pairs = []
+        self.images = []
+        self.writer = _PairWriter(chromo_list, snap_index)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, n):
+        i, j = self.pairs[n]
+        return (i, j), self.writer(i, j, self.images[n])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __repr__(self):
+        return f"QCCPairs: {len(self)} pairs"
+
+    def append(self, pair, image):
+        """Add a pair.
+
+        Parameters
+        ----------
+        pair : (int, int)
+            The indices of the chromophores.
+        image : numpy.ndarray of int, shape (3,)
+            The periodic image of chromophore j closest to chromophore i.
+        """
+        i, j = pair
+        self.pairs.append((int(i), int(j)))
+        self.images.append(tuple(int(x) for x in image))
+
+    def select(self, keep):
+        """Get the pairs for which keep is True.
+
+        Parameters
+        ----------
+        keep : numpy.ndarray of bool
+            Whether to keep each pair.
+
+        Returns
+        -------
+        QCCPairs
+            The kept pairs, which share the fragments of these pairs.
+        """
+        selected = copy.copy(self)
+        selected.pairs = [p for p, k in zip(self.pairs, keep) if k]
+        selected.images = [img for img, k in zip(self.images, keep) if k]
+        return selected
+
+
+def _get_pair_shifts(qcc_pairs):
+    """Get the indices and the shifts of the chromophores of all pairs.
+
+    The shifts are the same as in the pair inputs (see _PairWriter.get_task).
+    """
+    writer = qcc_pairs.writer
+    pairs = np.asarray(qcc_pairs.pairs, dtype=int).reshape(-1, 2)
+    images = np.asarray(qcc_pairs.images, dtype=int).reshape(-1, 3)
+    i, j = pairs.T
+    chromo_images = np.asarray(writer.images)
+    centers = np.asarray(writer.centers)
+    unwrapped_centers = np.asarray(writer.unwrapped_centers)
+    i_shift = chromo_images[i] * writer.box
+    j_shift = centers[j] + images * writer.box - unwrapped_centers[j]
+    return i, j, i_shift, j_shift
+
+
+def get_pair_descriptors(qcc_pairs):
+    """Get the closest contact and relative orientation of chromophore pairs.
+
+    Only the heavy (non-hydrogen) atoms of each chromophore are used. The
+    descriptors of all of the pairs are calculated together using arrays.
+
+    Parameters
+    ----------
+    qcc_pairs : QCCPairs
+        The chromophore pairs.
+
+    Returns
+    -------
+    contacts : numpy.ndarray
+        The smallest distance in Angstroms between the heavy atoms of the two
+        chromophores of each pair.
+    alignments : numpy.ndarray
+        The absolute cosine of the angle between the planes of the two
+        chromophores of each pair (1 if they are parallel, 0 if they are
+        perpendicular). Each plane is fit to the heavy atoms.
+    """
+    heavy = _get_heavy_positions(qcc_pairs)
+    # The normal is the direction with the least spread of the atoms
+    normals = np.array(
+        [np.linalg.svd(pos - pos.mean(axis=0))[2][-1] for pos in heavy]
+    ).reshape(-1, 3)
+    i, j = np.asarray(qcc_pairs.pairs, dtype=int).reshape(-1, 2).T
+    alignments = np.abs(np.sum(normals[i] * normals[j], axis=1))
+    return _get_contacts(qcc_pairs), alignments
+
+
+def _get_heavy_positions(qcc_pairs):
+    """Get the positions of the heavy atoms of each chromophore."""
+    return [
+        fragment.positions[: fragment.n_atoms][
+            fragment.numbers[: fragment.n_atoms] > 1
+        ]
+        for fragment in qcc_pairs.writer.fragments
+    ]
+
+
+def _get_contacts(qcc_pairs):
+    """Get the closest contact of the heavy atoms of each pair."""
+    heavy = _get_heavy_positions(qcc_pairs)
+    # Pad the heavy atoms of every chromophore to the same length with NaN,
+    # so the distances of many pairs can be calculated at once
+    n_max = max(len(pos) for pos in heavy)
+    padded = np.full((len(heavy), n_max, 3), np.nan)
+    for n, pos in enumerate(heavy):
+        padded[n, : len(pos)] = pos
+
+    i, j, i_shift, j_shift = _get_pair_shifts(qcc_pairs)
+
+    contacts = np.empty(len(i))
+    chunk = max(1, 2 ** 22 // n_max ** 2)
+    for start in range(0, len(i), chunk):
+        s = slice(start, start + chunk)
+        pos_i = padded[i[s]] + i_shift[s, None]
+        pos_j = padded[j[s]] + j_shift[s, None]
+        dists = np.linalg.norm(pos_i[:, :, None] - pos_j[:, None], axis=-1)
+        contacts[s] = np.nanmin(dists.reshape(len(dists), -1), axis=1)
+    return contacts
+
+
+def screen_pairs(qcc_pairs, max_contact=10.0):
+    """Split the pairs into those to calculate and those with no coupling.
+
+    The orbitals of chromophores which have no heavy atoms within
+    `max_contact` of each other don't overlap, so the transfer integral of
+    the pair is negligible and its dimer calculation can be skipped. Only the
+    closest contact is found (see `get_pair_descriptors`), since the
+    orientation of a pair can't show that its coupling is negligible on its
+    own.
+
+    Parameters
+    ----------
+    qcc_pairs : QCCPairs
+        The chromophore pairs.
+    max_contact : float, default 10.0
+        The largest closest contact in Angstroms between the heavy atoms of a
+        pair which is calculated.
+
+    Returns
+    -------
+    kept_pairs : QCCPairs
+        The pairs to calculate.
+    skipped_pairs : list of (int, int)
+        The indices of the pairs whose transfer integral is set to zero (see
+        `set_energyvalues`).
+    """
+    keep = _get_contacts(qcc_pairs) <= max_contact
+    skipped_pairs = [
+        pair for pair, k in zip(qcc_pairs.pairs, keep) if not k
+    ]
+    return qcc_pairs.select(keep), skipped_pairs
+
+
+def _get_pair_features(qcc_pairs):
+    """Get the geometry descriptors of the pairs for the surrogate model.
+
+    The features are the closest contact and alignment (see
+    `get_pair_descriptors`), the distance between the centers of the
+    chromophores, and their smaller and larger numbers of atoms.
+    """
+    contacts, alignments = get_pair_descriptors(qcc_pairs)
+    fragments = qcc_pairs.writer.fragments
+    means = np.array(
+        [fragment.positions[: fragment.n_atoms].mean(axis=0)
+         for fragment in fragments]
+    )
+    n_atoms = np.array([fragment.n_atoms for fragment in fragments])
+    i, j, i_shift, j_shift = _get_pair_shifts(qcc_pairs)
+    separations = np.linalg.norm(
+        means[j] + j_shift - means[i] - i_shift, axis=1
+    )
+    return np.column_stack(
+        (
+            contacts,
+            alignments,
+            separations,
+            np.minimum(n_atoms[i], n_atoms[j]),
+            np.maximum(n_atoms[i], n_atoms[j]),
+        )
     )
-    return qcc_input
 
 
-def _worker_wrapper(arg):
-    qcc_input, charge = arg
-    return get_homolumo(qcc_input, charge=charge)
+class _GaussianProcess:
+    """Gaussian process regression with a squared exponential kernel.
+
+    The features and targets are standardized, and the length scale of each
+    feature and the noise are fit by maximizing the marginal likelihood. The
+    predicted standard deviation is scaled up if the leave-one-out errors of
+    the training data are larger than it predicts.
+
+    Fitting takes O(n**3) time and O(n**2) memory in the number of training
+    points, so callers should limit it (see `max_train` in `dimer_surrogate`).
+    """
+
+    def __init__(self, x, y):
+        self.x_mean = x.mean(axis=0)
+        self.x_std = x.std(axis=0)
+        self.x_std[self.x_std == 0] = 1
+        self.x = (x - self.x_mean) / self.x_std
+        self.y_mean = y.mean()
+        self.y_std = y.std() or 1.0
+        self.y = (y - self.y_mean) / self.y_std
+
+        n_features = x.shape[1]
+        # The log of the length scales and of the noise
+        bounds = [(-3, 3)] * n_features + [(-9, 0)]
+        result = minimize(
+            self._nll,
+            np.zeros(n_features + 1),
+            method="L-BFGS-B",
+            bounds=bounds,
+        )
+        self.theta = result.x
+        self._fit(self.theta)
+        k_inv = cho_solve(self.cho, np.eye(len(self.y)))
+        z = self.alpha / np.sqrt(np.diag(k_inv))
+        self.scale = max(1.0, np.sqrt(np.mean(z ** 2)))
+
+    def _kernel(self, a, b, theta):
+        # The squared distances are expanded so no (n, m, features) array of
+        # differences is made
+        a = a / np.exp(theta[:-1])
+        b = b / np.exp(theta[:-1])
+        d2 = (
+            np.sum(a ** 2, axis=1)[:, None]
+            + np.sum(b ** 2, axis=1)[None]
+            - 2 * a @ b.T
+        )
+        return np.exp(-0.5 * np.maximum(d2, 0))
+
+    def _fit(self, theta):
+        k = self._kernel(self.x, self.x, theta)
+        k[np.diag_indices_from(k)] += np.exp(theta[-1])
+        self.cho = cho_factor(k)
+        self.alpha = cho_solve(self.cho, self.y)
+
+    def _nll(self, theta):
+        try:
+            self._fit(theta)
+        except np.linalg.LinAlgError:
+            return np.inf
+        return 0.5 * self.y @ self.alpha + np.sum(np.log(np.diag(self.cho[0])))
+
+    def predict(self, x):
+        """Get the mean and standard deviation of the prediction."""
+        k = self._kernel((x - self.x_mean) / self.x_std, self.x, self.theta)
+        mean = k @ self.alpha
+        var = 1 + np.exp(self.theta[-1]) - np.sum(
+            k * cho_solve(self.cho, k.T).T, axis=1
+        )
+        std = np.sqrt(np.maximum(var, 0)) * self.scale
+        return mean * self.y_std + self.y_mean, std * self.y_std
+
+
+def dimer_surrogate(
+    qcc_pairs,
+    chromo_list,
+    singles_data,
+    filename=None,
+    train_fraction=0.2,
+    max_std=0.05,
+    max_rounds=10,
+    max_train=1000,
+    seed=0,
+    nprocs=None,
+    cache=None,
+    resume=False,
+    executor=None,
+    threads_per_proc=None,
+    dms=None,
+    dedup_tol=None,
+    predicted=None,
+    failures=None,
+):
+    """Get the energies of the pairs, predicting most of them from a model.
+
+    The energies of a random sample of the pairs are calculated (see
+    `dimer_homolumo`), and a Gaussian process is trained to predict the HOMO
+    and LUMO transfer integrals of the rest from their geometry (see
+    `get_pair_descriptors`). The pairs whose predicted standard deviation is
+    above `max_std` are calculated in batches the size of the first sample,
+    and the model is trained again, until no prediction is that uncertain or
+    `max_rounds` batches have been calculated.
+
+    The energies of the predicted pairs are split around the mean of the
+    energies of their chromophores so that `set_energyvalues` gets the
+    predicted transfer integrals from them, and the file has the same format
+    as the one from `dimer_homolumo`.
+
+    The predicted energies are not validated by any calculation. Their
+    standard deviation is only the model's own estimate, and pairs unlike
+    any calculated pair can have large errors even when it is small. Use
+    `predicted` to find these pairs, and check a sample of them with
+    `dimer_homolumo` before relying on the results.
+
+    Parameters
+    ----------
+    qcc_pairs : QCCPairs
+        The pairs returned by `morphct.chromophores.set_neighbors_voronoi`.
+    chromo_list : list of Chromophore
+        List of chromphores to calculate dimer energies.
+    singles_data : numpy.ndarray
+        The energies of the chromophores from `singles_homolumo`.
+    filename : str, default None
+        Path to file where the pair energies will be saved. The calculated
+        pairs are written as soon as they finish, and the predicted pairs are
+        written at the end. If None, energies will not be saved.
+    train_fraction : float, default 0.2
+        The fraction of the pairs in the first sample, and in each batch.
+    max_std : float, default 0.05
+        The largest standard deviation in eV of a predicted transfer integral.
+    max_rounds : int, default 10
+        The largest number of batches of uncertain pairs to calculate.
+    max_train : int, default 1000
+        The largest number of calculated pairs the model is trained on. If
+        more pairs have been calculated, a random sample of them is used, as
+        training takes O(n**3) time and O(n**2) memory.
+    seed : int, default 0
+        Seed of the random sample. Use the same seed to resume.
+    nprocs : int, default None
+        Number of processes passed to multiprocessing.Pool.
+    cache : QCCCache or path, default None
+        A cache (or the path to one) of previously calculated energies. If
+        None is given, no cache is used.
+    resume : bool, default False
+        Whether to keep the energies already in `filename` and only calculate
+        the missing ones. Lines whose input fingerprint doesn't match are
+        calculated again. If the file has every pair (i.e., the previous run
+        finished), it is used as is.
+    executor : QCCExecutor, default None
+        The worker processes to run the calculations in. If None is given, a
+        pool of `nprocs` processes is started for this call.
+    threads_per_proc : int, default None
+        Number of threads each worker process uses, if no executor is given.
+    dms : dict, default None
+        The density matrices of the chromophores, used as the initial guess
+        of the calculated pairs (see `dimer_homolumo`).
+    dedup_tol : float, default None
+        If given, duplicate pairs are only calculated once (see
+        `find_duplicates` and `dimer_homolumo`).
+    predicted : list, default None
+        If given, the indices of the pairs which were predicted are added to
+        it. Pairs whose calculation failed without a result are predicted.
+    failures : list, default None
+        If given, an (indices, reason) tuple is added to it for each pair
+        which failed (see `QCCExecutor`).
+
+    Returns
+    -------
+    dimer_data : list of ((int, int), numpy.ndarray)
+        Each list item contains the indices of the pair and an array of its
+        calculated or predicted MO energies.
+    """
+    pairs, args = _dimer_args(qcc_pairs, chromo_list, dms)
+    n_pairs = len(pairs)
+    existing = {}
+    if resume and filename is not None and os.path.exists(filename):
+        existing = _read_energies(filename, pairs, args)
+        if all(pair in existing for pair in pairs):
+            return [(pair, existing[pair]) for pair in pairs]
+
+    i, j = np.asarray(pairs, dtype=int).reshape(-1, 2).T
+    de_homo = singles_data[j, 1] - singles_data[i, 1]
+    de_lumo = singles_data[j, 2] - singles_data[i, 2]
+    features = _get_pair_features(qcc_pairs)
+    rng = np.random.default_rng(seed)
+    batch = min(max(int(np.ceil(train_fraction * n_pairs)), 2), n_pairs)
+    computed = set(rng.choice(n_pairs, batch, replace=False).tolist())
+    # Pairs calculated in later batches of an interrupted run are kept
+    computed.update(k for k, pair in enumerate(pairs) if pair in existing)
+
+    energies = {}
+    failed = set()
+    with ExitStack() as stack:
+        if executor is None:
+            n_basis = max(_get_n_basis(qcc_input) for qcc_input, _ in args)
+            executor = stack.enter_context(
+                QCCExecutor(nprocs, threads_per_proc, n_basis)
+            )
+        # The pairs read from file are kept in the first round, and only the
+        # new pairs are calculated in the later ones
+        known = existing
+        for n_round in range(max_rounds + 1):
+            todo = sorted(computed)
+            (data,) = _run_qcc_checkpointed(
+                [
+                    (
+                        [pairs[k] for k in todo],
+                        [args[k] for k in todo],
+                        filename,
+                        False,
+                        None,
+                    )
+                ],
+                cache=cache,
+                executor=executor,
+                dedup_tol=dedup_tol,
+                failures=failures,
+                known_energies=known,
+            )
+            energies = {
+                k: en for k, en in zip(todo, data) if np.all(np.isfinite(en))
+            }
+            known = {pairs[k]: energies[k] for k in energies}
+            # Pairs which failed are predicted instead
+            failed.update(k for k in todo if k not in energies)
+            computed -= failed
+            if not energies:
+                raise RuntimeError("None of the sampled pairs were calculated.")
+            rest = np.array(
+                [k for k in range(n_pairs) if k not in computed], dtype=int
+            )
+            if len(rest) == 0:
+                break
+
+            # Train on the transfer integrals, which set_energyvalues gets
+            # from the splittings and the energies of the chromophores
+            train = np.array(sorted(energies))
+            if len(train) > max_train:
+                train = np.sort(rng.choice(train, max_train, replace=False))
+            homo_1, homo, lumo, lumo_1 = np.array(
+                [energies[k] for k in train]
+            ).T
+            j_homo = [
+                ti.calculate_ti(split, de) for split, de in
+                zip(homo - homo_1, de_homo[train])
+            ]
+            j_lumo = [
+                ti.calculate_ti(split, de) for split, de in
+                zip(lumo_1 - lumo, de_lumo[train])
+            ]
+            predictions = [
+                _GaussianProcess(features[train], np.array(y)).predict(
+                    features[rest]
+                )
+                for y in (j_homo, j_lumo)
+            ]
+            std = np.maximum(predictions[0][1], predictions[1][1])
+            retry = (std > max_std) & ~np.isin(rest, list(failed))
+            uncertain = rest[retry]
+            if len(uncertain) == 0 or n_round == max_rounds:
+                break
+            order = np.argsort(-std[retry])
+            computed.update(uncertain[order][:batch].tolist())
+
+    if len(rest) > 0:
+        j_homo = np.maximum(predictions[0][0], 0)
+        j_lumo = np.maximum(predictions[1][0], 0)
+        split_homo = np.sqrt((2 * j_homo) ** 2 + de_homo[rest] ** 2)
+        split_lumo = np.sqrt((2 * j_lumo) ** 2 + de_lumo[rest] ** 2)
+        mid_homo = (singles_data[i[rest], 1] + singles_data[j[rest], 1]) / 2
+        mid_lumo = (singles_data[i[rest], 2] + singles_data[j[rest], 2]) / 2
+        for n, k in enumerate(rest):
+            energies[k] = np.array(
+                [
+                    mid_homo[n] - split_homo[n] / 2,
+                    mid_homo[n] + split_homo[n] / 2,
+                    mid_lumo[n] - split_lumo[n] / 2,
+                    mid_lumo[n] + split_lumo[n] / 2,
+                ]
+            )
+        if filename is not None:
+            with open(filename, "a") as f:
+                f.writelines(
+                    _energy_line(
+                        pairs[k], energies[k], _get_fingerprint(*args[k])
+                    )
+                    for k in rest
+                )
+        if predicted is not None:
+            predicted.extend(pairs[k] for k in rest)
+
+    dimer_data = [(pair, energies[k]) for k, pair in enumerate(pairs)]
+    return dimer_data
+
+
+# The options of the worker process, set by _init_worker
+_worker_options = {"timeout": None, "retries": 0, "started": None}
+
+
+class _QCCTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _QCCTimeout
+
+
+@contextmanager
+def _time_limit(seconds):
+    """Raise _QCCTimeout if the block runs longer than a wall-clock time."""
+    if seconds is None or not hasattr(signal, "setitimer"):
+        yield
+        return
+    handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+
+
+def _init_worker(threads_per_proc, timeout=None, retries=0, started=None):
+    # Unpickling this function makes the worker import this module (and
+    # pySCF) as soon as it starts, rather than with its first task. The
+    # thread limits are set here, rather than in the environment the pool is
+    # started in, so workers which the pool restarts get them too.
+    os.environ.update(
+        {var: str(threads_per_proc) for var in _thread_env_vars}
+    )
+    pyscf.lib.num_threads(threads_per_proc)
+    # numpy, scipy and pySCF have already loaded their BLAS libraries, so
+    # their thread counts have to be set at runtime
+    threadpool_limits(threads_per_proc, user_api="blas")
+    _worker_options.update(timeout=timeout, retries=retries, started=started)
+
+
+def _indexed_worker(arg):
+    # A failed input is returned with its reason, so the others keep going
+    timeout = _worker_options["timeout"]
+    if _worker_options["started"] is not None:
+        _worker_options["started"].put((arg[0], os.getpid(), time.time()))
+    try:
+        with _time_limit(timeout):
+            return _run_task(*arg)
+    except _QCCTimeout:
+        failure = f"timed out after {timeout} s"
+    except Exception as e:
+        failure = f"{type(e).__name__}: {e}"
+    return arg[0], None, None, None, failure, False
+
+
+def _run_task(i, qcc_input, charge, cache, dm0, keep_dm, projection):
+    """Run a task, returning (i, key, energies, dm, failure, cacheable).
+
+    Only results which converged at the first attempt (at the tolerance of
+    the cache key) are cacheable.
+    """
+    if callable(qcc_input):
+        # Pair inputs are written by the worker
+        qcc_input = qcc_input()
+    method = "MINDO3" if projection is None else projection[0]
+    key = None
+    if cache is not None:
+        key = cache.get_key(qcc_input, charge, method)
+        energies = cache.get([key])[0]
+        if energies is not None:
+            return i, None, energies, None, None, False
+    if projection is not None:
+        return i, key, projection[1](qcc_input), None, None, True
+    if callable(dm0):
+        dm0 = dm0()
+    energies, dm, failure, attempts = _get_homolumo_retries(
+        qcc_input, charge, dm0, _worker_options["retries"]
+    )
+    # Results which didn't converge, or only converged at the looser
+    # tolerance of a retry, aren't cached
+    cacheable = failure is None and attempts == 1
+    return i, key, energies, dm if keep_dm else None, failure, cacheable
@@ -196,6 +196,145 @@ def get_hop_rate(
     return k
 
 
+def get_hop_rates(
+    lambd,
+    ti,
+    delta_e,
+    prefactor,
+    temp,
+    use_vrh=False,
+    rij=0.0,
+    vrh=1.0,
+    boltz=False,
+):
+    """Get the hopping rates for arrays of neighbors at once.
+
+    Vectorized version of `get_hop_rate`: every array argument is broadcast
+    against the others so all of the rates out of a chromophore can be
+    computed in a single call.
+
+    Parameters
+    ----------
+    lambd : float
+        The reorganization energy in eV.
+    ti : numpy.ndarray of float
+        The transfer integrals between the chromophores in eV.
+    delta_e : numpy.ndarray of float
+        The energy differences between the frontier orbitals of the
+        chromophores in eV.
+    prefactor : float
+        A prefactor to the rate equation.
+    temp : float
+        The temperature in Kelvin.
+    use_vrh : bool, default False
+        Whether to use variable-range hopping.
+    rij : float or numpy.ndarray of float, default 0.0
+        The distances between the chromophores in meters. (only used with VRH)
+    vrh : float, default 1.0
+        The variable-range hopping modifier in meters. (only used with VRH)
+    boltz : bool, default False
+        Whether to apply a simple Boltzmann energy penalty.
+
+    Returns
+    -------
+    numpy.ndarray of float
+        The hopping rates in inverse seconds. Zero transfer integrals give a
+        rate of zero.
+    """
+    lambd = lambd * elem_chrg
+    ti = np.asarray(ti, dtype=float) * elem_chrg
+    delta_e = np.asarray(delta_e, dtype=float) * elem_chrg
+
+    k = prefactor * (2 * np.pi / hbar) * (ti ** 2)
+    k *= np.sqrt(1 / (4 * lambd * np.pi * k_B * temp))
+
+    if use_vrh is True:
+        k *= np.exp(-np.asarray(rij) / vrh)
+    if boltz is True:
+        # Only apply the penalty where delta_e is positive
+        penalty = np.exp(-np.clip(delta_e, 0.0, None) / (k_B * temp))
+        k *= np.where(delta_e > 0.0, penalty, 1.0)
+    else:
+        k *= np.exp(-((delta_e + lambd) ** 2) / (4 * lambd * k_B * temp))
+    # Zero transfer integrals must give a zero rate
+    k[ti == 0.0] = 0.0
+    return k
+
+
+def get_event_taus(rates, rng=None):
+    """Get the times a set of independent events would take.
+
+    Vectorized version of `get_event_tau`. Random numbers are only drawn for
+    the non-zero rates and in order, so the random stream is consumed exactly
+    as repeated calls to `get_event_tau` would consume it.
+
+    Parameters
+    ----------
+    rates : numpy.ndarray of float
+        The rates in inverse seconds.
+    rng : numpy.random.Generator, default None
+        The source of random numbers. If None is given, the global numpy random
+        state is used.
+
+    Returns
+    -------
+    numpy.ndarray of float
+        The times in seconds the events would take given their rates. Events
+        with a rate of zero are given a time of 1e99.
+    """
+    if rng is None:
+        rng = np.random
+    rates = np.asarray(rates, dtype=float)
+    taus = np.full(rates.shape, 1e99)
+    nonzero = rates != 0
+    x = rng.random(np.count_nonzero(nonzero))
+    # Ensure that we don't get exactly 0.0, which would break our logarithm
+    zeros = x == 0.0
+    while np.any(zeros):
+        x[zeros] = rng.random(np.count_nonzero(zeros))
+        zeros = x == 0.0
+    taus[nonzero] = -np.log(x) / rates[nonzero]
+    return taus
+
+
+def get_bkl_event(cum_rates, rng=None):
+    """Pick an event and the time it takes using the rejection-free method.
+
+    Rather than drawing a waiting time for every event and taking the fastest
+    (first reaction method), the Bortz-Kalos-Lebowitz (BKL or Gillespie)
+    algorithm picks the event by searching the cumulative rates and draws a
+    single waiting time from the total rate. Only two random numbers are
+    needed regardless of the number of events.
+
+    Parameters
+    ----------
+    cum_rates : numpy.ndarray of float
+        The cumulative sum of the event rates in inverse seconds.
+    rng : numpy.random.Generator, default None
+        The source of random numbers. If None is given, the global numpy random
+        state is used.
+
+    Returns
+    -------
+    int, float
+        The index of the chosen event (None if no event is possible) and the
+        time in seconds it takes. If the total rate is zero, the time is 1e99.
+    """
+    if len(cum_rates) == 0 or cum_rates[-1] == 0:
+        return None, 1e99
+    if rng is None:
+        rng = np.random
+    total = cum_rates[-1]
+    x = rng.random(2)
+    # Ensure that we don't get exactly 0.0, which would break our logarithm
+    while x[0] == 0.0:
+        x[0] = rng.random()
+    tau = -np.log(x[0]) / total
+    # side="right" skips over any events with zero rate
+    i = np.searchsorted(cum_rates, x[1] * total, side="right")
+    return min(i, len(cum_rates) - 1), tau
+
+
 def get_event_tau(
     rate,
     slowest=None,
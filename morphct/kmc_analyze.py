@@ -12,12 +12,27 @@ from scipy.sparse import lil_matrix
 from scipy.stats import linregress
 
 from morphct import helper_functions as hf
-from morphct.mobility_kmc import get_molecule_ids
+from morphct.mobility_kmc import get_molecule_ids, load_kmc_results
 
 
 plt = None
 p3 = None
 
+# The carrier data columns used by main
+_main_columns = [
+    "id",
+    "c_type",
+    "image",
+    "current_position",
+    "lifetime",
+    "current_time",
+    "n_hops",
+    "displacement",
+    "box",
+    "hole_history",
+    "electron_history",
+]
+
 
 def split_carriers(combined_data):
     """Split dictionary based on carrier type.
@@ -31,7 +46,8 @@ def split_carriers(combined_data):
     -------
     dict, dict
         combined_data split into two dicts based on carrier type:
-        hole_data and elec_data
+        hole_data and elec_data. Columns which are numpy arrays are kept as
+        arrays.
     """
     hole_inds = np.where(np.array(combined_data["c_type"]) == "hole")[0]
     elec_inds = np.where(np.array(combined_data["c_type"]) == "electron")[0]
@@ -41,6 +57,9 @@ def split_carriers(combined_data):
         if key.endswith("history"):
             hole_data[key] = val
             elec_data[key] = val
+        elif isinstance(val, np.ndarray):
+            hole_data[key] = val[hole_inds]
+            elec_data[key] = val[elec_inds]
         else:
             hole_data[key] = [val[i] for i in hole_inds]
             elec_data[key] = [val[i] for i in elec_inds]
@@ -159,7 +178,7 @@ def get_connections(chromo_list, carrier_history, box):
     ----------
     chromo_list : list of Chromophore
         The chromophores in the simulation.
-    carrier_history : scipy.sparse.lil_matrix
+    carrier_history : scipy.sparse.csr_matrix or scipy.sparse.lil_matrix
         The carrier history.
     box : numpy.ndarray, shape (3,)
         The lengths of the box vectors in Angstroms. Box is assumed to be
@@ -212,7 +231,7 @@ def plot_connections(
     ----------
     chromo_list : list of Chromophore
         The chromophores in the simulation.
-    carrier_history : scipy.sparse.lil_matrix
+    carrier_history : scipy.sparse.csr_matrix or scipy.sparse.lil_matrix
         The carrier history.
     c_type : str
         Carrier species, "electron" or "hole".
@@ -1753,7 +1772,7 @@ def plot_frequency_dist(
     ----------
     c_type : str
         The carrier type, "electron" or "hole".
-    carrier_history : scipy.sparse.lil_matrix
+    carrier_history : scipy.sparse.csr_matrix or scipy.sparse.lil_matrix
         The carrier history.
     freqcut : list of int
         The frequency cutoff for the donor and acceptor species, respectively.
@@ -1805,7 +1824,7 @@ def plot_net_frequency_dist(c_type, carrier_history, path):  # pragma: no cover
     ----------
     c_type : str
         The carrier type, "electron" or "hole".
-    carrier_history : scipy.sparse.lil_matrix
+    carrier_history : scipy.sparse.csr_matrix or scipy.sparse.lil_matrix
         The carrier history.
     path : path
         Path to directory where to save the plot.
@@ -1846,7 +1865,7 @@ def plot_discrepancy_frequency_dist(
     ----------
     c_type : str
         The carrier type, "electron" or "hole".
-    carrier_history : scipy.sparse.lil_matrix
+    carrier_history : scipy.sparse.csr_matrix or scipy.sparse.lil_matrix
         The carrier history.
     path : path
         Path to directory where to save the plot.
@@ -2025,8 +2044,9 @@ def main(
 
     Parameters
     ----------
-    combined_data : dict
-        The data for both carrier types.
+    combined_data : dict or path
+        The data for both carrier types, or the directory the results of
+        `morphct.mobility_kmc.run_kmc` were written to.
     temp : float
         Simulation temperature in Kelvin.
     chromo_list : list of Chromophore
@@ -2086,9 +2106,11 @@ def main(
     print("---------------------------------")
 
     box = snap.configuration.box[:3]
+    if not isinstance(combined_data, dict):
+        combined_data = load_kmc_results(combined_data, columns=_main_columns)
     hole_data, elec_data = split_carriers(combined_data)
     # Calculate the mobilities
-    if hole_data["id"]:
+    if len(hole_data["id"]) > 0:
         c_type = "hole"
         carrier_data = hole_data
 
@@ -2108,7 +2130,7 @@ def main(
         data_dict[f"{c_type}_mobility_err"] = mob_error
         data_dict[f"{c_type}_mobility_r_squared"] = r_squared
 
-    if elec_data["id"]:
+    if len(elec_data["id"]) > 0:
         c_type = "electron"
         carrier_data = elec_data
 
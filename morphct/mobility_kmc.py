@@ -1,5 +1,11 @@
+from collections import defaultdict
+from contextlib import ExitStack
+from functools import partial
+import glob
 import math
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
 import os
 from sys import platform
 import time
@@ -7,7 +13,7 @@ import warnings
 
 import freud
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix, lil_matrix
 
 from morphct import helper_functions as hf
 from morphct.helper_functions import v_print
@@ -21,6 +27,23 @@ except RuntimeError:
     pass
 
 
+# Algorithms available for picking each hop (see Carrier)
+kmc_engines = ("frm", "bkl")
+
+# Ways of running the KMC batches (see run_kmc)
+kmc_backends = ("serial", "process", "thread")
+
+# Carrier keyword arguments which change the hop rates (see HopGraph)
+_rate_kwargs = (
+    "use_avg_hoprates",
+    "avg_intra_rate",
+    "avg_inter_rate",
+    "boltz",
+    "use_vrh",
+    "hopping_prefactor",
+)
+
+
 class Carrier:
     """An object for tracking the progress of a charge carrier.
 
@@ -41,7 +64,8 @@ class Carrier:
     hop_limit : int, default None
        A maximum number of hops used to kill the KMC run.
     record_history : bool, default True
-        Whether to record the carrier history in the form of a sparse matrix.
+        Whether to record the carrier history in the form of a sparse matrix
+        (or of edge counts, if `hop_graph` is given).
     mol_id_dict : dict, default None
         A dictionary that maps the chromophore index to the molecule index.
 
@@ -63,6 +87,24 @@ class Carrier:
         Whether to use variable-range hopping.
     hopping_prefactor : float, default 1.0
         A prefactor to the rate equation.
+    hop_graph : HopGraph, default None
+        Precomputed hop rates. If None is given, the rates are calculated from
+        the chromophore neighbors at every hop.
+    history : numpy.ndarray of int32, default None
+        An edge counter (see `HopGraph.new_history`) into which the hops are
+        recorded. Passing the same array to many carriers accumulates their
+        histories together. Only used if `hop_graph` is given and
+        `record_history` is True. If None is given, the carrier records its
+        own history.
+    kmc_engine : str, default "frm"
+        The algorithm used to pick each hop: "frm" draws a waiting time for
+        every neighbor and takes the fastest (first reaction method), "bkl"
+        picks the neighbor by its share of the total rate and draws a single
+        waiting time from the total rate (rejection-free BKL/Gillespie
+        method). Both give the same statistics.
+    rng : numpy.random.Generator, default None
+        The source of random numbers for the hops (see `get_carrier_rng`). If
+        None is given, the global numpy random state is used.
 
     Attributes
     ----------
@@ -85,9 +127,13 @@ class Carrier:
     current_time : float
         The current time in the simulation. (Starts at 0.0.)
     hole_history : scipy.sparse.lil_matrix, shape (n x n), dtype int
-        A sparse matrix to track which chromophores a hole has occupied.
+        A sparse matrix to track which chromophores a hole has occupied. If a
+        `hop_graph` is used, this is instead a numpy.ndarray of int32 with the
+        number of hops along each edge of the graph (see `HopGraph.to_csr`).
     electron_history : scipy.sparse.lil_matrix, shape (n x n), dtype int
         A sparse matrix to track which chromophores an electron has occupied.
+        If a `hop_graph` is used, this is instead a numpy.ndarray of int32 with
+        the number of hops along each edge of the graph.
     c_type : str
         The carrier type, "electron" or "hole".
     n_hops : int
@@ -115,6 +161,13 @@ class Carrier:
         exp(r/vrh_delocalization) when `use_vrh` is True.
     hopping_prefactor : float
         A prefactor to the rate equation.
+    hop_graph : HopGraph
+        Precomputed hop rates, or None if the rates are calculated every hop.
+    kmc_engine : str
+        The algorithm used to pick each hop, "frm" or "bkl".
+    rng : numpy.random.Generator
+        The source of random numbers, or None if the global numpy random state
+        is used.
 
     Methods
     -------
@@ -140,7 +193,15 @@ class Carrier:
         boltz=False,
         use_vrh=False,
         hopping_prefactor=1.0,
+        hop_graph=None,
+        history=None,
+        kmc_engine="frm",
+        rng=None,
     ):
+        if kmc_engine not in kmc_engines:
+            raise ValueError(
+                f"kmc_engine must be one of {kmc_engines}, not {kmc_engine}"
+            )
         both_rates = avg_inter_rate is None and avg_intra_rate is None
         any_rate = avg_inter_rate is None or avg_intra_rate is None
         if use_avg_hoprates and any_rate:
@@ -174,14 +235,22 @@ class Carrier:
 
         self.hole_history = None
         self.electron_history = None
+        if record_history:
+            if hop_graph is not None:
+                # Count the hops along each edge of the graph, which is much
+                # cheaper than indexing a sparse matrix every hop
+                if history is None:
+                    history = hop_graph.new_history()
+            else:
+                history = lil_matrix((n, n), dtype=int)
+        else:
+            history = None
         if self.current_chromo.species == "donor":
             self.c_type = "hole"
-            if record_history:
-                self.hole_history = lil_matrix((n, n), dtype=int)
+            self.hole_history = history
         elif self.current_chromo.species == "acceptor":
             self.c_type = "electron"
-            if record_history:
-                self.electron_history = lil_matrix((n, n), dtype=int)
+            self.electron_history = history
 
         self.n_hops = 0
         self.box = box
@@ -203,6 +272,9 @@ class Carrier:
             self.vrh_delocalization = self.current_chromo.vrh_delocalization
 
         self.hopping_prefactor = hopping_prefactor
+        self.hop_graph = hop_graph
+        self.kmc_engine = kmc_engine
+        self.rng = rng
 
     def update_displacement(self):
         """Update the carrier displacement accounting for periodic boundary.
@@ -234,100 +306,142 @@ class Carrier:
         if self.hop_limit is not None:
             if self.n_hops + 1 > self.hop_limit:
                 return False
-        # Determine the hop times to all possible neighbors
-        hop_times = []
-        if self.use_avg_hoprates:
-            # Use the average hop values given in the parameter dict to pick a
-            # hop
-            for i, img in self.current_chromo.neighbors:
-                neighbor = chromo_list[i]
-                assert neighbor.id == i
-
-                current_mol = self.mol_id_dict[self.current_chromo.id]
-                neighbor_mol = self.mol_id_dict[neighbor.id]
-                if current_mol == neighbor_mol:
-                    hop_rate = self.avg_intra_rate
-                else:
-                    hop_rate = self.avg_inter_rate
-                hop_time = hf.get_event_tau(hop_rate)
-                # Keep track of the chromophoreid and the corresponding tau
-                hop_times.append([neighbor.id, hop_time, img])
+        # Determine the rates to all possible neighbors at once
+        if self.hop_graph is not None:
+            n_inds, rel_imgs, hop_rates = self.hop_graph.get_rates(
+                self.current_chromo.id
+            )
         else:
-            # Obtain the reorganization energy in J (from eV)
-            for i_neighbor, ti in enumerate(self.current_chromo.neighbors_ti):
-                # Ignore any hops with a NoneType transfer integral
-                if ti is None:
-                    continue
-                # index of the neighbor in the main list
-                n_ind = self.current_chromo.neighbors[i_neighbor][0]
-                delta_E_ij = self.current_chromo.neighbors_delta_e[i_neighbor]
-                # Load the specified hopping prefactor
-                prefactor = self.hopping_prefactor
-                # Get the relative image so we can update the carrier image
-                # after the hop
-                rel_img = self.current_chromo.neighbors[i_neighbor][1]
-                # All of the energies are in eV currently, so convert them to J
-                if self.use_vrh is True:
-                    neighbor_chromo = chromo_list[n_ind]
-                    neighbor_pos = neighbor_chromo.center + rel_img * self.box
-
-                    # Chromophore separation needs converting to m
-                    sep = (
-                        np.linalg.norm(
-                            self.current_chromo.center - neighbor_pos
-                        )
-                        * 1e-10
-                    )
-
-                    hop_rate = hf.get_hop_rate(
-                        self.lambda_ij,
-                        ti,
-                        delta_E_ij,
-                        prefactor,
-                        self.temp,
-                        use_vrh=True,
-                        rij=sep,
-                        vrh=self.vrh_delocalization,
-                        boltz=self.boltz,
-                    )
-                else:
-                    hop_rate = hf.get_hop_rate(
-                        self.lambda_ij,
-                        ti,
-                        delta_E_ij,
-                        prefactor,
-                        self.temp,
-                        boltz=self.boltz,
-                    )
-                hop_time = hf.get_event_tau(hop_rate)
-                # Keep track of the chromophoreid and the corresponding tau
-                hop_times.append([n_ind, hop_time, rel_img])
-        # Sort by ascending hop time
-        hop_times.sort(key=lambda x: x[1])
-        if len(hop_times) == 0:
+            n_inds, rel_imgs, hop_rates = self._get_neighbor_rates(chromo_list)
+
+        if self.kmc_engine == "bkl":
+            if self.hop_graph is not None:
+                cum_rates = self.hop_graph.get_cum_rates(
+                    self.current_chromo.id
+                )
+            else:
+                cum_rates = np.cumsum(hop_rates)
+            i_hop, hop_time = hf.get_bkl_event(cum_rates, self.rng)
+            # Only the chosen hop has a time
+            hop_times = np.full(len(hop_rates), np.nan)
+            if i_hop is not None:
+                hop_times[i_hop] = hop_time
+        else:
+            # Determine the hop times to all neighbors and take the quickest
+            hop_times = hf.get_event_taus(hop_rates, self.rng)
+            i_hop = np.argmin(hop_times) if len(hop_times) > 0 else None
+            hop_time = hop_times[i_hop] if i_hop is not None else 1e99
+
+        edge = None
+        if i_hop is None:
             # We are trapped here, so create a dummy hop with time 1E99
-            hop_times = [[self.current_chromo.id, 1e99, [0, 0, 0]]]
+            n_ind = self.current_chromo.id
+            rel_img = np.zeros(3, dtype=int)
+        else:
+            n_ind = n_inds[i_hop]
+            rel_img = rel_imgs[i_hop]
+            if self.hop_graph is not None:
+                edge = self.hop_graph.indptr[self.current_chromo.id] + i_hop
         # As long as we're not limiting by the number of hops:
         if self.hop_limit is None:
             # Ensure that the next hop does not put the carrier over its
             # lifetime
-            if (self.current_time + hop_times[0][1]) > self.lifetime:
+            if (self.current_time + hop_time) > self.lifetime:
                 # Send the termination signal to singleCoreRunKMC.py
                 return False
+
+        if verbose > 1:
+            v_print("\thop_times:", verbose, v_level=1)
+            order = np.argsort(hop_times, kind="stable")
+            hop_str = "\n".join(
+                [
+                    f"\t\t{n_inds[i]} {hop_times[i]:.2e} {rel_imgs[i]}"
+                    for i in order
+                ]
+            )
+            v_print(hop_str, verbose, v_level=1)
+            v_print(f"\tHopping to {n_ind}", verbose, v_level=1)
+
         # Move the carrier and send the contiuation signal to
         # singleCoreRunKMC.py
-        # Take the quickest hop
-        n_ind, hop_time, rel_img = hop_times[0]
+        self.perform_hop(chromo_list[n_ind], hop_time, rel_img, edge=edge)
+        return True
 
-        v_print("\thop_times:", verbose, v_level=1)
-        hop_str = "\n".join([f"\t\t{i} {j:.2e} {k}" for (i, j, k) in hop_times])
-        v_print(hop_str, verbose, v_level=1)
-        v_print(f"\tHopping to {n_ind}", verbose, v_level=1)
+    def _get_neighbor_rates(self, chromo_list):
+        """Get the hop rates from the current chromophore to its neighbors.
 
-        self.perform_hop(chromo_list[n_ind], hop_time, rel_img)
-        return True
+        Parameters
+        ----------
+        chromo_list : list of Chromophore
+            The chromophore objects in the simulation.
+
+        Returns
+        -------
+        n_inds : numpy.ndarray of int
+            The indices of the neighbors which can be hopped to.
+        rel_imgs : numpy.ndarray of int, shape (N, 3)
+            The relative images of these neighbors.
+        hop_rates : numpy.ndarray of float
+            The hop rates to these neighbors in inverse seconds.
+        """
+        chromo = self.current_chromo
+        if self.use_avg_hoprates:
+            # Use the average hop values given in the parameter dict to pick a
+            # hop
+            neighbors = chromo.neighbors
+            n_inds = np.array([i for i, img in neighbors], dtype=int)
+            rel_imgs = np.array([img for i, img in neighbors], dtype=int)
+            current_mol = self.mol_id_dict[chromo.id]
+            same_mol = np.array(
+                [self.mol_id_dict[i] == current_mol for i in n_inds],
+                dtype=bool
+            )
+            hop_rates = np.where(
+                same_mol, self.avg_intra_rate, self.avg_inter_rate
+            ).astype(float)
+            return n_inds, rel_imgs.reshape(-1, 3), hop_rates
+
+        # Ignore any hops with a NoneType transfer integral
+        valid = [i for i, ti in enumerate(chromo.neighbors_ti) if ti is not None]
+        n_inds = np.array([chromo.neighbors[i][0] for i in valid], dtype=int)
+        rel_imgs = np.array(
+            [chromo.neighbors[i][1] for i in valid], dtype=int
+        ).reshape(-1, 3)
+        tis = np.array([chromo.neighbors_ti[i] for i in valid], dtype=float)
+        delta_es = np.array(
+            [chromo.neighbors_delta_e[i] for i in valid], dtype=float
+        )
+        # All of the energies are in eV currently, they are converted to J in
+        # get_hop_rates
+        if self.use_vrh is True:
+            neighbor_pos = np.array(
+                [chromo_list[i].center for i in n_inds]
+            ).reshape(-1, 3) + rel_imgs * self.box
+            # Chromophore separation needs converting to m
+            seps = np.linalg.norm(chromo.center - neighbor_pos, axis=1) * 1e-10
+            hop_rates = hf.get_hop_rates(
+                self.lambda_ij,
+                tis,
+                delta_es,
+                self.hopping_prefactor,
+                self.temp,
+                use_vrh=True,
+                rij=seps,
+                vrh=self.vrh_delocalization,
+                boltz=self.boltz,
+            )
+        else:
+            hop_rates = hf.get_hop_rates(
+                self.lambda_ij,
+                tis,
+                delta_es,
+                self.hopping_prefactor,
+                self.temp,
+                boltz=self.boltz,
+            )
+        return n_inds, rel_imgs, hop_rates
 
-    def perform_hop(self, destination_chromo, hop_time, rel_image):
+    def perform_hop(self, destination_chromo, hop_time, rel_image, edge=None):
         """Hop the carrier from the current to the destination chromophore.
 
         Parameters
@@ -338,6 +452,9 @@ class Carrier:
             The time the hop will take in seconds.
         rel_image : numpy.ndarray
             The relative image of the destination chromophore.
+        edge : int, default None
+            The index of this hop in the hop graph. Only used if the history is
+            recorded as edge counts. If None is given, it is looked up.
         """
         init_id = self.current_chromo.id
         dest_id = destination_chromo.id
@@ -348,11 +465,377 @@ class Carrier:
         self.current_time += hop_time
         # Increment the hop counter
         self.n_hops += 1
-        # Now update the sparse history matrix
-        if self.c_type == "hole" and self.hole_history is not None:
-            self.hole_history[init_id, dest_id] += 1
-        elif self.c_type == "electron" and self.electron_history is not None:
-            self.electron_history[init_id, dest_id] += 1
+        # Now update the history
+        if self.c_type == "hole":
+            history = self.hole_history
+        else:
+            history = self.electron_history
+        if history is None:
+            return
+        if isinstance(history, np.ndarray):
+            if edge is None:
+                edge = self.hop_graph.get_edge(init_id, dest_id, rel_image)
+            if edge is not None:
+                history[edge] += 1
+        else:
+            history[init_id, dest_id] += 1
+
+
+class HopGraph:
+    """Precomputed hop rates between chromophores stored as CSR arrays.
+
+    The hop rates only depend on static quantities (the neighbor transfer
+    integrals and energy differences, the reorganization energy, the
+    temperature, and the rate options), so they can be computed once and looked
+    up for every hop of every carrier. The outgoing hops of chromophore ``i``
+    are stored in ``indices[indptr[i]:indptr[i+1]]`` (and likewise for
+    ``images`` and ``rates``).
+
+    Parameters
+    ----------
+    chromo_list : list of Chromophore
+        The chromophores in the simulation. Energy values must already be set.
+    box: numpy.ndarray
+        The lengths of the box vectors. Box is assumed to be orthogonal.
+    temp : float
+        The temperature in Kelvin.
+    mol_id_dict : dict, default None
+        A dictionary that maps the chromophore index to the molecule index.
+        Required if `use_avg_hoprates` is True.
+    use_avg_hoprates : bool, default False
+       Whether to use the average hop rates instead of calculating each hop.
+    avg_intra_rate : float, default None
+        The average intramolecular hop rate in inverse seconds.
+    avg_inter_rate : float, default None
+        The average intermolecular hop rate in inverse seconds.
+    boltz : bool, default False
+        Whether to use a Boltzmann energy penalty
+    use_vrh : bool, default False
+        Whether to use variable-range hopping.
+    hopping_prefactor : float, default 1.0
+        A prefactor to the rate equation.
+
+    Attributes
+    ----------
+    n : int
+        The number of chromophores.
+    indptr : numpy.ndarray of int, shape (n+1,)
+        Index pointer array into the edge arrays for each chromophore.
+    indices : numpy.ndarray of int
+        The chromophore index of the destination of each edge.
+    images : numpy.ndarray of int, shape (n_edges, 3)
+        The relative image of the destination of each edge.
+    rates : numpy.ndarray of float
+        The hop rate of each edge in inverse seconds.
+    cum_rates : numpy.ndarray of float
+        The cumulative hop rate of each edge within its chromophore's row.
+    total_rates : numpy.ndarray of float, shape (n,)
+        The total outgoing hop rate of each chromophore in inverse seconds.
+    box : numpy.ndarray
+        The lengths of the box vectors.
+    centers : numpy.ndarray of float, shape (n, 3)
+        The (wrapped) center of each chromophore.
+    species : numpy.ndarray of str, shape (n,)
+        The species ("donor" or "acceptor") of each chromophore.
+    mol_id_dict : dict
+        A dictionary that maps the chromophore index to the molecule index.
+
+    Methods
+    -------
+    get_rates(i)
+    get_cum_rates(i)
+    get_edge(i, j, rel_image)
+    new_history()
+    to_csr(counts)
+    to_shared_memory()
+
+    Note
+    ----
+    The rates use the reorganization energy and variable-range hopping
+    modifier of the chromophore being hopped from. Neighbors with a NoneType
+    transfer integral are not included unless `use_avg_hoprates` is True.
+    """
+
+    def __init__(
+        self,
+        chromo_list,
+        box,
+        temp,
+        mol_id_dict=None,
+        use_avg_hoprates=False,
+        avg_intra_rate=None,
+        avg_inter_rate=None,
+        boltz=False,
+        use_vrh=False,
+        hopping_prefactor=1.0,
+    ):
+        if use_avg_hoprates and (
+            avg_inter_rate is None or avg_intra_rate is None
+        ):
+            raise ValueError(
+                "If use_avg_hoprates is True, avg_inter_rate and "
+                "avg_intra_rate must also be provided"
+            )
+        if use_avg_hoprates and mol_id_dict is None:
+            raise ValueError(
+                "If use_avg_hoprates is True, a molecule dictionary "
+                "(mol_id_dict) must also be provided"
+            )
+        self.n = len(chromo_list)
+        self.box = np.asarray(box)
+        self.mol_id_dict = mol_id_dict
+        self.centers = np.array([chromo.center for chromo in chromo_list])
+        self.species = np.array([chromo.species for chromo in chromo_list])
+
+        sources = []
+        indices = []
+        images = []
+        tis = []
+        delta_es = []
+        for i, chromo in enumerate(chromo_list):
+            for k, (j, img) in enumerate(chromo.neighbors):
+                ti = chromo.neighbors_ti[k] if chromo.neighbors_ti else None
+                if ti is None and not use_avg_hoprates:
+                    continue
+                sources.append(i)
+                indices.append(j)
+                images.append(img)
+                tis.append(ti)
+                delta_es.append(
+                    chromo.neighbors_delta_e[k] if ti is not None else None
+                )
+
+        sources = np.array(sources, dtype=int)
+        counts = np.bincount(sources, minlength=self.n)
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+        self.indices = np.array(indices, dtype=int)
+        self.images = np.array(images, dtype=int).reshape(-1, 3)
+
+        if use_avg_hoprates:
+            same_mol = np.array(
+                [mol_id_dict[i] == mol_id_dict[j] for i, j in zip(
+                    sources, self.indices
+                )],
+                dtype=bool
+            )
+            rates = np.where(same_mol, avg_intra_rate, avg_inter_rate)
+        else:
+            lambdas = np.array(
+                [chromo_list[i].reorganization_energy for i in sources]
+            )
+            if use_vrh:
+                vrhs = np.array(
+                    [chromo_list[i].vrh_delocalization for i in sources]
+                )
+                neighbor_pos = (
+                    self.centers[self.indices].reshape(-1, 3)
+                    + self.images * box
+                )
+                # Chromophore separation needs converting to m
+                seps = np.linalg.norm(
+                    self.centers[sources].reshape(-1, 3) - neighbor_pos, axis=1
+                ) * 1e-10
+            else:
+                vrhs = 1.0
+                seps = 0.0
+            rates = hf.get_hop_rates(
+                lambdas,
+                np.array(tis, dtype=float),
+                np.array(delta_es, dtype=float),
+                hopping_prefactor,
+                temp,
+                use_vrh=use_vrh,
+                rij=seps,
+                vrh=vrhs,
+                boltz=boltz,
+            )
+        self.rates = np.asarray(rates, dtype=float)
+        self.total_rates = np.bincount(
+            sources, weights=self.rates, minlength=self.n
+        )
+        # Cumulative rates within each row, used to pick hops by their share
+        # of the total rate. Summed row by row to avoid losing precision.
+        self.cum_rates = np.empty_like(self.rates)
+        for start, stop in zip(self.indptr[:-1], self.indptr[1:]):
+            self.cum_rates[start:stop] = np.cumsum(self.rates[start:stop])
+
+    def get_rates(self, i):
+        """Get the hops out of a chromophore.
+
+        Parameters
+        ----------
+        i : int
+            The index of the chromophore.
+
+        Returns
+        -------
+        n_inds : numpy.ndarray of int
+            The indices of the neighbors which can be hopped to.
+        rel_imgs : numpy.ndarray of int, shape (N, 3)
+            The relative images of these neighbors.
+        hop_rates : numpy.ndarray of float
+            The hop rates to these neighbors in inverse seconds.
+        """
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return (
+            self.indices[start:stop],
+            self.images[start:stop],
+            self.rates[start:stop],
+        )
+
+    def get_cum_rates(self, i):
+        """Get the cumulative rates of the hops out of a chromophore.
+
+        Parameters
+        ----------
+        i : int
+            The index of the chromophore.
+
+        Returns
+        -------
+        numpy.ndarray of float
+            The cumulative hop rates in inverse seconds, in the same order as
+            the hops returned by `get_rates`.
+        """
+        return self.cum_rates[self.indptr[i] : self.indptr[i + 1]]
+
+    def get_edge(self, i, j, rel_image):
+        """Get the index of the edge for a hop.
+
+        Parameters
+        ----------
+        i : int
+            The index of the chromophore hopped from.
+        j : int
+            The index of the chromophore hopped to.
+        rel_image : numpy.ndarray
+            The relative image of the destination chromophore.
+
+        Returns
+        -------
+        int
+            The index of the edge, or None if there is no such edge.
+        """
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        match = (self.indices[start:stop] == j) & np.all(
+            self.images[start:stop] == rel_image, axis=1
+        )
+        if not np.any(match):
+            return None
+        return start + np.argmax(match)
+
+    def new_history(self):
+        """Get an empty hop history.
+
+        Returns
+        -------
+        numpy.ndarray of int32
+            A counter for the number of hops along each edge.
+        """
+        return np.zeros(len(self.indices), dtype=np.int32)
+
+    def to_csr(self, counts):
+        """Convert edge counts to a sparse matrix of hops between chromophores.
+
+        Parameters
+        ----------
+        counts : numpy.ndarray of int
+            The number of hops along each edge (see `new_history`).
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix, shape (n x n)
+            The number of hops from chromophore i to chromophore j.
+        """
+        history = csr_matrix(
+            (counts, self.indices, self.indptr),
+            shape=(self.n, self.n),
+            copy=True,
+        )
+        history.sum_duplicates()
+        history.eliminate_zeros()
+        return history
+
+    def to_shared_memory(self):
+        """Copy the graph arrays into shared memory blocks.
+
+        Other processes can then use the graph without it being pickled and
+        copied into each of them (see `attach_hop_graph`). The caller owns the
+        blocks and must close and unlink them when they are no longer needed.
+
+        Returns
+        -------
+        spec : dict
+            The information needed to attach to the shared graph.
+        blocks : list of multiprocessing.shared_memory.SharedMemory
+            The shared memory blocks holding the graph arrays.
+        """
+        spec = {"n": self.n, "box": self.box, "arrays": {}}
+        blocks = []
+        try:
+            for key in _shared_arrays:
+                array = getattr(self, key)
+                # Zero-size blocks are not allowed
+                block = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1)
+                )
+                blocks.append(block)
+                shared = np.ndarray(
+                    array.shape, dtype=array.dtype, buffer=block.buf
+                )
+                shared[...] = array
+                spec["arrays"][key] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            # Don't leave the blocks made so far behind
+            _release_blocks(blocks)
+            raise
+        return spec, blocks
+
+
+# HopGraph arrays placed in shared memory for the KMC worker processes
+_shared_arrays = (
+    "indptr",
+    "indices",
+    "images",
+    "rates",
+    "cum_rates",
+    "total_rates",
+    "centers",
+    "species",
+)
+
+
+def attach_hop_graph(spec):
+    """Get a hop graph whose arrays live in shared memory.
+
+    The arrays are used in place (zero-copy). The attached graph has no
+    `mol_id_dict` as it is only needed to compute the rates.
+
+    Parameters
+    ----------
+    spec : dict
+        The shared graph information returned by `HopGraph.to_shared_memory`.
+
+    Returns
+    -------
+    hop_graph : HopGraph
+        The graph backed by the shared memory.
+    blocks : list of multiprocessing.shared_memory.SharedMemory
+        The attached shared memory blocks. These must be kept alive while the
+        graph is used.
+    """
+    hop_graph = HopGraph.__new__(HopGraph)
+    hop_graph.n = spec["n"]
+    hop_graph.box = spec["box"]
+    hop_graph.mol_id_dict = None
+    blocks = []
+    for key, (name, shape, dtype) in spec["arrays"].items():
+        block = shared_memory.SharedMemory(name=name)
+        setattr(
+            hop_graph, key, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        )
+        blocks.append(block)
+    return hop_graph, blocks
 
 
 def run_single_kmc(
@@ -366,6 +849,9 @@ def run_single_kmc(
     seed=None,
     send_end=None,
     verbose=1,
+    hop_graph=None,
+    kmc_engine="frm",
+    shared_history=False,
 ):
     """Run a single KMC simulation process.
 
@@ -387,23 +873,39 @@ def run_single_kmc(
     cpu_rank : int, default None
         The cpu rank of this particular run.
     seed : int, default None
-        A seed for the random processes.
+        The seed of the carriers' random streams (see `get_carrier_rng`), so
+        each carrier gets the same results as it would from `run_jobs`. If
+        None is given, fresh entropy is used.
     send_end : multiprocessing.connection.Connection, default None
         The "send" connection object returned by `multiprocessing.Pipe` to which
         the result will be sent. If None is given, the function will return the
         result.
     verbose : int, default 0
         The verbosity level of output.
+    hop_graph : HopGraph, default None
+        Precomputed hop rates shared by all carriers. If None is given, it is
+        built from `chromo_list` using the rate options in `carrier_kwargs`.
+    kmc_engine : str, default "frm"
+        The algorithm used to pick each hop, "frm" (first reaction method) or
+        "bkl" (rejection-free BKL/Gillespie method). See `Carrier`.
+    shared_history : bool, default False
+        Whether to record the hops of all carriers into one edge counter per
+        carrier type instead of giving each carrier its own history. If True,
+        the histories of the carriers are None and the combined histories are
+        returned alongside them.
 
     Returns
     -------
-    list of Carrier
+    list of Carrier or (list of Carrier, dict)
         if send_end is None (this function is being run on its own), the
         carrier_list is returned. Otherwise it is assumed this function is being
         as part of a multiprocessing run and nothing is returned.
+        If `shared_history` is True, a dict mapping "hole_history" and
+        "electron_history" to the edge counts of all carriers (or None if the
+        history is not recorded) is returned (or sent) with the carrier_list.
     """
-    if seed is not None:
-        np.random.seed(seed)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
 
     if cpu_rank is not None:
         # If we're running on multiple cpus, don't print to std out
@@ -416,34 +918,33 @@ def run_single_kmc(
 
     v_print(f"Found {len(jobs):d} jobs to run", verbose, filename=filename)
 
-    try:
-        use_avg_hoprates = carrier_kwargs["use_avg_hoprates"]
-    except KeyError:
-        use_avg_hoprates = False
-
-    if use_avg_hoprates:
-        # Chosen to split hopping by inter-intra molecular hops, so get
-        # molecule data
-        mol_id_dict = get_molecule_ids(snap, chromo_list)
-        # molidDict is a dictionary where the keys are the chromoids, and
-        # the vals are the molids
+    box = snap.configuration.box[:3]
+    if hop_graph is None:
+        hop_graph = get_hop_graph(chromo_list, snap, temp, carrier_kwargs)
+    mol_id_dict = hop_graph.mol_id_dict
+
+    record_history = carrier_kwargs.get("record_history", True)
+    if shared_history and record_history:
+        histories = {
+            "hole": hop_graph.new_history(),
+            "electron": hop_graph.new_history(),
+        }
     else:
-        mol_id_dict = None
+        histories = {"hole": None, "electron": None}
+
+    candidates = {
+        "hole": np.flatnonzero(hop_graph.species == "donor"),
+        "electron": np.flatnonzero(hop_graph.species == "acceptor"),
+    }
     t0 = time.perf_counter()
     carrier_list = []
-    box = snap.configuration.box[:3]
     for i_job, [carrier_no, lifetime, ctype] in enumerate(jobs):
         v_print(f"starting job {i_job}", verbose, filename=filename)
         t1 = time.perf_counter()
+        rng = get_carrier_rng(seed, ctype, carrier_no, lifetime)
         # Find a random position to start the carrier in
-        while True:
-            i = np.random.randint(0, len(chromo_list) - 1)
-            i_chromo = chromo_list[i]
-            if (ctype == "electron") and (i_chromo.species != "acceptor"):
-                continue
-            elif (ctype == "hole") and (i_chromo.species != "donor"):
-                continue
-            break
+        chromos = candidates[ctype]
+        i_chromo = chromo_list[chromos[int(rng.random() * len(chromos))]]
         # Create the carrier instance
         i_carrier = Carrier(
             i_chromo,
@@ -453,6 +954,10 @@ def run_single_kmc(
             temp,
             len(chromo_list),
             mol_id_dict=mol_id_dict,
+            hop_graph=hop_graph,
+            history=histories[ctype],
+            kmc_engine=kmc_engine,
+            rng=rng,
             **carrier_kwargs,
         )
         continue_sim = True
@@ -460,6 +965,20 @@ def run_single_kmc(
             continue_sim = i_carrier.calculate_hop(chromo_list, verbose=verbose)
         # Now the carrier has finished hopping, let's calculate its vitals
         i_carrier.update_displacement()
+        if shared_history:
+            # The hops were recorded in the shared history
+            i_carrier.hole_history = None
+            i_carrier.electron_history = None
+        else:
+            # Only keep the edges this carrier used
+            if i_carrier.hole_history is not None:
+                i_carrier.hole_history = hop_graph.to_csr(
+                    i_carrier.hole_history
+                )
+            if i_carrier.electron_history is not None:
+                i_carrier.electron_history = hop_graph.to_csr(
+                    i_carrier.electron_history
+                )
 
         t2 = time.perf_counter()
         elapsed_time = float(t2) - float(t1)
@@ -477,10 +996,315 @@ def run_single_kmc(
     t3 = time.perf_counter()
     elapsed_time = float(t3) - float(t0)
     time_str = hf.time_units(elapsed_time)
+    if shared_history:
+        result = (
+            carrier_list,
+            {
+                "hole_history": histories["hole"],
+                "electron_history": histories["electron"],
+            },
+        )
+    else:
+        result = carrier_list
     if send_end is not None:
-        send_end.send(carrier_list)
+        send_end.send(result)
     else:
-        return carrier_list
+        return result
+
+
+def run_lockstep_kmc(
+    jobs,
+    hop_graph,
+    hop_limit=None,
+    record_history=True,
+    seed=None,
+    send_end=None,
+    kmc_engine="bkl",
+    histories=None,
+):
+    """Run many independent carriers at once as arrays.
+
+    Carriers do not interact, so rather than simulating them one at a time
+    the state of every carrier (current chromophore, image, time and number of
+    hops) is held in arrays and all active carriers are advanced together each
+    step using the precomputed rates in `hop_graph`. A carrier stops once its
+    next hop would exceed its lifetime (or `hop_limit`). As in `Carrier`, a
+    hop with no outgoing rate takes 1e99 s, so a trapped carrier only keeps
+    making (dummy) hops if `hop_limit` is given.
+
+    Parameters
+    ----------
+    jobs : list of (int, float, str)
+        List of parameters for the KMC job: the carrier index, lifetime, and
+        species ("electron" or "hole").
+    hop_graph : HopGraph
+        Precomputed hop rates.
+    hop_limit : int, default None
+       A maximum number of hops used to kill the KMC run. If None is given,
+       the carriers run until their lifetime is reached.
+    record_history : bool, default True
+        Whether to record the number of hops along each edge of the hop graph.
+    seed : int, default None
+        The seed of the carriers' random streams (see `get_carrier_rng`). If
+        None is given, fresh entropy is used.
+    send_end : multiprocessing.connection.Connection, default None
+        The "send" connection object returned by `multiprocessing.Pipe` to which
+        the result will be sent. If None is given, the function will return the
+        result.
+    kmc_engine : str, default "bkl"
+        The algorithm used to pick each hop, "frm" (first reaction method) or
+        "bkl" (rejection-free BKL/Gillespie method). See `Carrier`.
+    histories : dict of numpy.ndarray, default None
+        Edge counters (see `HopGraph.new_history`) for "hole" and "electron"
+        into which the hops are accumulated. If None is given and
+        `record_history` is True, new counters are used.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        if send_end is None, the per-carrier results are returned with keys:
+        'id', 'c_type', 'lifetime', 'current_time', 'n_hops', 'image',
+        'initial_chromo', 'current_chromo', 'displacement', 'hole_history',
+        'electron_history'.
+        The chromophores are given by their index. The histories are the number
+        of hops of all carriers along each edge of `hop_graph` (see
+        `HopGraph.to_csr`), or None if `record_history` is False.
+    """
+    if kmc_engine not in kmc_engines:
+        raise ValueError(
+            f"kmc_engine must be one of {kmc_engines}, not {kmc_engine}"
+        )
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    n_carriers = len(jobs)
+    ids = np.array([job[0] for job in jobs], dtype=int)
+    lifetimes = np.array([job[1] for job in jobs], dtype=float)
+    c_types = np.array([job[2] for job in jobs], dtype="<U8")
+
+    # Each carrier draws from its own stream. The buffer must be able to hold
+    # the random numbers for one hop out of the chromophore with most edges.
+    streams = _CarrierStreams(
+        [
+            get_carrier_rng(seed, c_type, carrier_no, lifetime)
+            for carrier_no, lifetime, c_type in jobs
+        ],
+        width=max(256, np.diff(hop_graph.indptr).max(initial=0)),
+    )
+    all_carriers = np.arange(n_carriers)
+
+    # Find a random position to start each carrier in
+    x = streams.random(all_carriers)
+    start = np.empty(n_carriers, dtype=int)
+    for c_type, species in [("hole", "donor"), ("electron", "acceptor")]:
+        is_type = c_types == c_type
+        chromos = np.flatnonzero(hop_graph.species == species)
+        start[is_type] = chromos[(x[is_type] * len(chromos)).astype(int)]
+
+    if not record_history:
+        histories = {"hole": None, "electron": None}
+    elif histories is None:
+        histories = {
+            "hole": hop_graph.new_history(),
+            "electron": hop_graph.new_history(),
+        }
+
+    current = start.copy()
+    image = np.zeros((n_carriers, 3), dtype=int)
+    times = np.zeros(n_carriers)
+    n_hops = np.zeros(n_carriers, dtype=int)
+
+    if kmc_engine == "bkl":
+        # Normalizing the cumulative rates in each row and offsetting them by
+        # the row index gives one sorted array which all carriers can search
+        # at once
+        counts = np.diff(hop_graph.indptr)
+        row_totals = np.repeat(hop_graph.total_rates, counts)
+        row_keys = np.repeat(np.arange(hop_graph.n), counts).astype(float)
+        nonzero = row_totals > 0
+        row_keys[nonzero] += hop_graph.cum_rates[nonzero] / row_totals[nonzero]
+
+    active = all_carriers
+    while len(active) > 0:
+        if hop_limit is not None:
+            # Terminate if the next hop would be more than the hop limit
+            active = active[n_hops[active] + 1 <= hop_limit]
+
+        chromos = current[active]
+        random = partial(streams.random, active)
+        if kmc_engine == "bkl":
+            edges, taus = _pick_hops_bkl(hop_graph, chromos, row_keys, random)
+        else:
+            edges, taus = _pick_hops_frm(hop_graph, chromos, random)
+
+        if hop_limit is None:
+            # Ensure that the next hop does not put the carrier over its
+            # lifetime
+            hopping = (times[active] + taus) <= lifetimes[active]
+            active = active[hopping]
+            edges = edges[hopping]
+            taus = taus[hopping]
+
+        # Trapped carriers (edge -1) make a dummy hop to where they are
+        moving = edges >= 0
+        movers = active[moving]
+        edges = edges[moving]
+        current[movers] = hop_graph.indices[edges]
+        image[movers] += hop_graph.images[edges]
+        times[active] += taus
+        n_hops[active] += 1
+        if record_history:
+            is_hole = c_types[movers] == "hole"
+            np.add.at(histories["hole"], edges[is_hole], 1)
+            np.add.at(histories["electron"], edges[~is_hole], 1)
+
+    displacement = np.linalg.norm(
+        hop_graph.centers[current]
+        - hop_graph.centers[start]
+        + image * hop_graph.box,
+        axis=1
+    )
+    results = {
+        "id": ids,
+        "c_type": c_types,
+        "lifetime": lifetimes,
+        "current_time": times,
+        "n_hops": n_hops,
+        "image": image,
+        "initial_chromo": start,
+        "current_chromo": current,
+        "displacement": displacement,
+        "hole_history": histories["hole"],
+        "electron_history": histories["electron"],
+    }
+    if send_end is not None:
+        send_end.send(results)
+    else:
+        return results
+
+
+class _CarrierStreams:
+    """Random streams of many carriers which can be drawn from all at once.
+
+    Each carrier's generator is drawn from in blocks which are buffered, so
+    the carriers can be advanced together while every carrier still consumes
+    its own stream in order, no matter which other carriers it runs with.
+
+    Parameters
+    ----------
+    rngs : list of numpy.random.Generator
+        The random stream of each carrier.
+    width : int, default 256
+        The number of random numbers buffered for each carrier. No more than
+        this many can be drawn by a carrier at once.
+    """
+
+    def __init__(self, rngs, width=256):
+        self.rngs = rngs
+        self.width = width
+        self.buffer = np.empty((len(rngs), width))
+        # Start with empty buffers
+        self.pos = np.full(len(rngs), width)
+
+    def random(self, carriers, counts=1):
+        """Draw random floats in [0, 1) from the streams of some carriers.
+
+        Parameters
+        ----------
+        carriers : numpy.ndarray of int
+            The unique indices of the carriers drawing numbers.
+        counts : int or numpy.ndarray of int, default 1
+            The number of floats each carrier draws.
+
+        Returns
+        -------
+        numpy.ndarray of float
+            The floats of each carrier in turn.
+        """
+        counts = np.broadcast_to(counts, carriers.shape)
+        # Move the unused numbers to the front and top up the buffers which
+        # are running out
+        for i in carriers[self.pos[carriers] + counts > self.width]:
+            n_left = self.width - self.pos[i]
+            self.buffer[i, :n_left] = self.buffer[i, self.pos[i]:]
+            self.buffer[i, n_left:] = self.rngs[i].random(self.width - n_left)
+            self.pos[i] = 0
+        offsets = np.cumsum(counts) - counts
+        cols = np.repeat(self.pos[carriers] - offsets, counts) + np.arange(
+            counts.sum()
+        )
+        x = self.buffer[np.repeat(carriers, counts), cols]
+        self.pos[carriers] += counts
+        return x
+
+
+def _pick_hops_bkl(hop_graph, chromos, row_keys, random):
+    """Pick one hop out of each chromophore using the BKL method.
+
+    `random(counts)` must return `counts` random floats for each chromophore.
+    Returns the edge index and time of each hop. As in `hf.get_bkl_event`, if
+    there is no outgoing rate the edge is -1 and the time is 1e99.
+    """
+    totals = hop_graph.total_rates[chromos]
+    x = random(2).reshape(-1, 2).T
+    trapped = totals == 0
+    with np.errstate(divide="ignore"):
+        # 1 - x is in (0, 1], so the logarithm is always finite
+        taus = -np.log(1 - x[0]) / totals
+    taus[trapped] = 1e99
+    edges = np.searchsorted(row_keys, chromos + x[1], side="right")
+    # Guard against round off at the ends of each row
+    edges = np.clip(
+        edges, hop_graph.indptr[chromos], hop_graph.indptr[chromos + 1] - 1
+    )
+    edges[trapped] = -1
+    return edges, taus
+
+
+def _pick_hops_frm(hop_graph, chromos, random):
+    """Pick one hop out of each chromophore using the first reaction method.
+
+    `random(counts)` must return `counts` random floats for each chromophore.
+    Returns the edge index and time of each hop. As in `hf.get_event_taus`,
+    an edge with a rate of zero takes 1e99 s, and if there are no edges the
+    edge is -1 and the time is 1e99.
+    """
+    starts = hop_graph.indptr[chromos]
+    degrees = hop_graph.indptr[chromos + 1] - starts
+    edges = np.full(len(chromos), -1)
+    taus = np.full(len(chromos), 1e99)
+
+    has_hops = degrees > 0
+    if not np.any(has_hops):
+        return edges, taus
+    # One random number for each outgoing edge
+    x = random(degrees)
+    starts = starts[has_hops]
+    degrees = degrees[has_hops]
+    # Gather the outgoing edges of every chromophore into one flat array
+    offsets = np.cumsum(degrees) - degrees
+    segments = np.repeat(np.arange(len(degrees)), degrees)
+    all_edges = np.repeat(starts - offsets, degrees) + np.arange(degrees.sum())
+    rates = hop_graph.rates[all_edges]
+    nonzero = rates != 0
+    all_taus = np.full(len(all_edges), 1e99)
+    all_taus[nonzero] = -np.log(1 - x[nonzero]) / rates[nonzero]
+    # Sort by segment, then by time: the first of each segment is the quickest
+    order = np.lexsort((all_taus, segments))[offsets]
+    edges[has_hops] = all_edges[order]
+    taus[has_hops] = all_taus[order]
+    return edges, taus
+
+
+def _merge_results(results_list):
+    """Merge the per-carrier results of several runs, summing the histories."""
+    results = {}
+    for key in results_list[0]:
+        if key.endswith("history"):
+            results[key] = _merge_histories([r[key] for r in results_list])
+        else:
+            results[key] = np.concatenate([r[key] for r in results_list])
+    return results
 
 
 def snap_molecule_indices(snap):
@@ -538,7 +1362,77 @@ def get_molecule_ids(snap, chromo_list):
     return chromo_mol_id
 
 
-def get_jobslist(sim_times, n_holes=0, n_elec=0, nprocs=None, seed=None):
+def get_hop_graph(chromo_list, snap, temp, carrier_kwargs={}):
+    """Build the hop graph using the rate options of the carriers.
+
+    Parameters
+    ----------
+    chromo_list : list of Chromphore
+        The chromophores in the simulation.
+    snap : gsd.hoomd.Snapshot
+        The simulation snapshot.
+    temp : float
+        The simulation temperature in Kelvin.
+    carrier_kwargs : dict, default {}
+        The keyword arguments for the Carrier instances. Only the options which
+        affect the hop rates are used.
+
+    Returns
+    -------
+    HopGraph
+    """
+    graph_kwargs = {
+        key: val for key, val in carrier_kwargs.items() if key in _rate_kwargs
+    }
+    if graph_kwargs.get("use_avg_hoprates", False):
+        # Chosen to split hopping by inter-intra molecular hops, so get
+        # molecule data
+        mol_id_dict = get_molecule_ids(snap, chromo_list)
+        # molidDict is a dictionary where the keys are the chromoids, and
+        # the vals are the molids
+    else:
+        mol_id_dict = None
+    box = snap.configuration.box[:3]
+    return HopGraph(
+        chromo_list, box, temp, mol_id_dict=mol_id_dict, **graph_kwargs
+    )
+
+
+def get_carrier_rng(seed, c_type, carrier_no, lifetime):
+    """Get the random stream of a carrier.
+
+    The stream is keyed by the run seed and the carrier's job, so a carrier
+    gets the same random numbers however the jobs are split between workers,
+    and a single carrier can be rerun on its own.
+
+    Parameters
+    ----------
+    seed : int
+        The seed of the KMC run.
+    c_type : str
+        The carrier species, "electron" or "hole".
+    carrier_no : int
+        The carrier index.
+    lifetime : float
+        The carrier lifetime in seconds.
+
+    Returns
+    -------
+    numpy.random.Generator
+        A Philox generator for the carrier.
+    """
+    key = [
+        seed,
+        ["hole", "electron"].index(c_type),
+        carrier_no,
+        int(np.float64(lifetime).view(np.uint64)),
+    ]
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence(key)))
+
+
+def get_jobslist(
+    sim_times, n_holes=0, n_elec=0, nprocs=None, seed=None, batch_size=None
+):
     """Create a random list of KMC jobs.
 
     Parameters
@@ -554,11 +1448,15 @@ def get_jobslist(sim_times, n_holes=0, n_elec=0, nprocs=None, seed=None):
         multiprocessing will not be used.
     seed : int, default None
         A seed for the random processes.
+    batch_size : int, default None
+        If given, the jobs are cut into batches of this many carriers (for a
+        scheduler that hands out batches as processes become free) instead of
+        one chunk per process.
 
     Returns
     -------
-    list of (int, float, str)
-        Randomized list of parameters for the KMC job: the carrier index, its
+    list of list of (int, float, str)
+        Randomized lists of parameters for the KMC jobs: the carrier index, its
         lifetime, and its species ("electron" or "hole").
     """
     # Get the random seed now for all the child processes
@@ -579,10 +1477,270 @@ def get_jobslist(sim_times, n_holes=0, n_elec=0, nprocs=None, seed=None):
         for carrier_no in range(n_elec):
             carriers.append((carrier_no, lifetime, "electron"))
     np.random.shuffle(carriers)
-    step = math.ceil(len(carriers) / nprocs)
+    if batch_size is not None:
+        step = batch_size
+    else:
+        step = max(1, math.ceil(len(carriers) / nprocs))
     jobs_list = [carriers[i : i + step] for i in range(0, len(carriers), step)]
     return jobs_list
 
+
+def _history_to_csr(counts, hop_graph):
+    if counts is None:
+        return None
+    return hop_graph.to_csr(counts)
+
+
+def _merge_histories(histories):
+    """Sum the edge counts of several workers, skipping missing ones."""
+    histories = [h for h in histories if h is not None]
+    if not histories:
+        return None
+    return np.sum(histories, axis=0, dtype=np.int64)
+
+
+def combine_results(results, hop_graph, temp):
+    """Convert the per-carrier result arrays into the combined data format.
+
+    Parameters
+    ----------
+    results : dict of numpy.ndarray
+        Per-carrier results as returned by `run_lockstep_kmc`. The histories are
+        given as edge counts.
+    hop_graph : HopGraph
+        The hop graph used in the simulation.
+    temp : float
+        The simulation temperature in Kelvin.
+
+    Returns
+    -------
+    dict
+        The carrier data with the same keys used by `kmc_analyze`: 'id',
+        'image', 'initial_position', 'current_position', 'temp', 'lifetime',
+        'current_time', 'hole_history', 'electron_history', 'c_type', 'n_hops',
+        'box', 'displacement'.
+    """
+    n_carriers = len(results["id"])
+    return {
+        "id": list(results["id"]),
+        "image": list(results["image"]),
+        "initial_position": list(hop_graph.centers[results["initial_chromo"]]),
+        "current_position": list(hop_graph.centers[results["current_chromo"]]),
+        "temp": [temp] * n_carriers,
+        "lifetime": list(results["lifetime"]),
+        "current_time": list(results["current_time"]),
+        "hole_history": _history_to_csr(results["hole_history"], hop_graph),
+        "electron_history": _history_to_csr(
+            results["electron_history"], hop_graph
+        ),
+        "c_type": list(results["c_type"]),
+        "n_hops": list(results["n_hops"]),
+        "box": [hop_graph.box] * n_carriers,
+        "displacement": list(results["displacement"]),
+    }
+
+
+# The per-carrier columns of the KMC results (see run_lockstep_kmc)
+_carrier_columns = (
+    "id",
+    "c_type",
+    "lifetime",
+    "current_time",
+    "n_hops",
+    "image",
+    "initial_chromo",
+    "current_chromo",
+    "displacement",
+)
+
+# The columns of the combined carrier data used by kmc_analyze
+_combined_columns = (
+    "id",
+    "image",
+    "initial_position",
+    "current_position",
+    "temp",
+    "lifetime",
+    "current_time",
+    "hole_history",
+    "electron_history",
+    "c_type",
+    "n_hops",
+    "box",
+    "displacement",
+)
+
+
+def _savez(filename, **arrays):
+    """Save arrays to an npz file which only appears once it is complete."""
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+def init_kmc_output(kmc_directory, hop_graph, temp):
+    """Start the output of a KMC run.
+
+    The carrier results are written to the "carriers" directory inside
+    `kmc_directory`. Any results of a previous run there are removed and the
+    parts of the hop graph needed to analyze the results are written.
+
+    Parameters
+    ----------
+    kmc_directory : path
+        The path to the directory where the KMC results will be saved.
+    hop_graph : HopGraph
+        The hop graph used in the simulation.
+    temp : float
+        The simulation temperature in Kelvin.
+    """
+    carrier_dir = os.path.join(kmc_directory, "carriers")
+    os.makedirs(carrier_dir, exist_ok=True)
+    old_files = glob.glob(os.path.join(carrier_dir, "batch_*.npz"))
+    old_files.append(os.path.join(carrier_dir, "histories.npz"))
+    for filename in old_files:
+        if os.path.exists(filename):
+            os.remove(filename)
+    _savez(
+        os.path.join(carrier_dir, "graph.npz"),
+        indptr=hop_graph.indptr,
+        indices=hop_graph.indices,
+        centers=hop_graph.centers,
+        box=hop_graph.box,
+        temp=temp,
+    )
+
+
+def write_kmc_batch(kmc_directory, i, results):
+    """Write the per-carrier results of a batch of KMC jobs.
+
+    Each column is stored as a separate array in "carriers/batch_<i>.npz", so
+    the results can be read while the run continues and only the columns
+    needed have to be loaded (see `load_kmc_results`).
+
+    Parameters
+    ----------
+    kmc_directory : path
+        The path to the directory where the KMC results will be saved.
+    i : int
+        The index of the batch.
+    results : dict of numpy.ndarray
+        The per-carrier results of the batch (see `run_lockstep_kmc`).
+    """
+    _savez(
+        os.path.join(kmc_directory, "carriers", f"batch_{i:05d}.npz"),
+        **{key: results[key] for key in _carrier_columns},
+    )
+
+
+def write_kmc_histories(kmc_directory, histories):
+    """Write the hop histories of a KMC run.
+
+    Parameters
+    ----------
+    kmc_directory : path
+        The path to the directory where the KMC results will be saved.
+    histories : dict of numpy.ndarray
+        The number of hops along each edge of the hop graph for
+        "hole_history" and "electron_history". Histories which are None are
+        not written.
+    """
+    _savez(
+        os.path.join(kmc_directory, "carriers", "histories.npz"),
+        **{key: val for key, val in histories.items() if val is not None},
+    )
+
+
+def load_kmc_results(kmc_directory, columns=None, c_type=None):
+    """Load the carrier results written by `run_kmc`.
+
+    Only the requested columns are read, so for example the mean squared
+    displacements (see `kmc_analyze.get_times_msds`) can be found using
+    ``columns=["displacement", "current_time", "lifetime", "n_hops"]``. The
+    results of a run which is still going can also be loaded; the histories
+    are only available once the run has finished.
+
+    Parameters
+    ----------
+    kmc_directory : path
+        The path to the directory where the KMC results were saved.
+    columns : list of str, default None
+        The columns to load. Any of the per-carrier columns returned by
+        `run_lockstep_kmc` or the combined data columns used by `kmc_analyze`
+        can be given. If None is given, the combined data columns are loaded.
+    c_type : str, default None
+        If "hole" or "electron" is given, only the results of that carrier
+        type are loaded. The histories always hold the hops of their carrier
+        type.
+
+    Returns
+    -------
+    dict
+        The columns as numpy arrays, or as scipy.sparse.csr_matrix for the
+        histories (None if they weren't recorded or aren't written yet).
+        "box" and "temp" are read-only views of a single value.
+    """
+    carrier_dir = os.path.join(kmc_directory, "carriers")
+    if columns is None:
+        columns = _combined_columns
+    derived = {
+        "initial_position": "initial_chromo",
+        "current_position": "current_chromo",
+    }
+    needed = {derived.get(col, col) for col in columns}
+    needed &= set(_carrier_columns)
+    needed.add("id")
+    for col in columns:
+        if col not in _carrier_columns + _combined_columns:
+            raise ValueError(f"Unknown KMC result column {col}")
+
+    with np.load(os.path.join(carrier_dir, "graph.npz")) as graph:
+        graph = dict(graph)
+    loaded = defaultdict(list)
+    for filename in sorted(glob.glob(os.path.join(carrier_dir, "batch_*.npz"))):
+        with np.load(filename) as batch:
+            keep = slice(None)
+            if c_type is not None:
+                keep = batch["c_type"] == c_type
+            for key in needed:
+                loaded[key].append(batch[key][keep])
+    loaded = {key: np.concatenate(val) for key, val in loaded.items()}
+    n_carriers = len(loaded.get("id", []))
+
+    histories = {}
+    history_file = os.path.join(carrier_dir, "histories.npz")
+    if os.path.exists(history_file):
+        with np.load(history_file) as f:
+            histories = dict(f)
+    n_chromos = len(graph["indptr"]) - 1
+
+    data = {}
+    for col in columns:
+        if col in derived:
+            if n_carriers == 0:
+                data[col] = np.empty((0, 3))
+            else:
+                data[col] = graph["centers"][loaded[derived[col]]]
+        elif col == "box":
+            data[col] = np.broadcast_to(graph["box"], (n_carriers, 3))
+        elif col == "temp":
+            data[col] = np.broadcast_to(graph["temp"], (n_carriers,))
+        elif col.endswith("history"):
+            data[col] = None
+            if col in histories:
+                history = csr_matrix(
+                    (histories[col], graph["indices"], graph["indptr"]),
+                    shape=(n_chromos, n_chromos),
+                )
+                history.sum_duplicates()
+                history.eliminate_zeros()
+                data[col] = history
+        else:
+            data[col] = loaded.get(col, np.empty(0))
+    return data
+
+
 def run_kmc(
     lifetimes,
     kmc_directory,
@@ -596,16 +1754,31 @@ def run_kmc(
     combine=True,
     carrier_kwargs={},
     verbose=1,
-    ): # pragma: no cover
+    kmc_engine="frm",
+    batch_size=16,
+    backend="process",
+):
     """Run KMC simulation using multiprocessing.
 
+    The hop graph is built once and placed in shared memory, which a pool of
+    worker processes attaches to without copying. The workers only need the
+    graph arrays (not the chromophores or snapshot) and send back compact
+    per-carrier result arrays.
+
+    The carriers are cut into small batches which are handed out to the
+    workers as they become free, so a few long-lived carriers do not hold up
+    the whole run. The results of each batch are written to `kmc_directory`
+    as it finishes (see `write_kmc_batch` and `load_kmc_results`), so they
+    don't have to be held in memory and can be inspected during the run.
+
     Parameters
     ----------
     lifetimes : list of float
         The potential lifetimes of the carriers. A value from these will be
         randomly assigned to each run.
     kmc_directory : path
-        The path to the directory where the KMC results will be saved.
+        The path to the directory where the KMC results will be saved. Results
+        of a previous run in this directory are removed.
     chromo_list : list of Chromphore
         The chromophores in the simulation.
     snap : gsd.hoomd.Snapshot
@@ -617,81 +1790,369 @@ def run_kmc(
     n_elec : int, default 0
         The number of electrons to simulate.
     seed : int, default 42
-        A seed for the random processes.
+        A seed for the random processes. Each carrier's random stream is keyed
+        by this seed and its job (see `get_carrier_rng`), so the results do
+        not depend on `nprocs`, `batch_size` or `backend`. If None is given,
+        fresh entropy is used.
     nprocs : int, default None
-        The number of processes in a multiprocessing run. If None is given,
-        multiprocessing will not be used.
+        The number of worker processes (or threads) used by the "process" and
+        "thread" backends. If None is given, the number of CPUs is used.
     combine : bool, default True
-        Whether to combine the results into a dictionary or return a list of
-        Carriers.
+        Whether to load the results written to `kmc_directory` as the
+        dictionary used by `kmc_analyze` or return a list of Carriers.
     carrier_kwargs : dict, default {}
-        Additional keyword arguments to be passed to the carrier instances.
+        Additional keyword arguments for the carriers. The rate options are
+        used to build the hop graph (see `get_hop_graph`), and "hop_limit"
+        and "record_history" are also used.
     verbose : int, default 0
         The verbosity level of output.
+    kmc_engine : str, default "frm"
+        The algorithm used to pick each hop, "frm" (first reaction method) or
+        "bkl" (rejection-free BKL/Gillespie method). See `Carrier`. If
+        "lockstep" is given, each process advances all of its carriers at once
+        as arrays using the BKL method (see `run_lockstep_kmc`).
+    batch_size : int, default 16
+        The number of carriers a worker takes from the queue at a time.
+        Smaller batches balance the load better, larger batches have less
+        overhead (and lockstep has more carriers to advance at once).
+    backend : str, default "process"
+        How the batches are run: "serial" runs them one after another in this
+        process, which avoids the cost of starting workers for small runs;
+        "process" uses a pool of `nprocs` worker processes; and "thread" uses
+        a pool of `nprocs` threads sharing the hop graph.
 
     Returns
     -------
     dict or list of Carriers
-        if combine is True, returns dict; otherwise returns list of Carriers.
-        Dict keys are Carrier attributes:
-        'id', 'image', 'initial_position', 'current_position', 'lambda_ij',
-        'hop_limit', 'temp', 'lifetime', 'current_time', 'hole_history',
-        'electron_history', 'c_type', 'n_hops', 'box', 'displacement',
-        'mol_id_dict', 'use_avg_hoprates', 'avg_intra_rate', 'avg_inter_rate',
-        'use_koopmans', 'boltz', 'use_vrh', 'hopping_prefactor'
+        if combine is True, returns the dict loaded by `load_kmc_results`;
+        otherwise returns list of Carriers in job order, holding the final
+        state of each carrier. If there are no carriers, nothing is run or
+        written and an empty dict or list is returned.
+
+    Notes
+    -----
+    This is a breaking change from earlier versions, which built both
+    results from the Carriers:
+
+    - The hops of all carriers are recorded together, so the
+      `hole_history` and `electron_history` of each returned Carrier are
+      None. The histories of all carriers are in the dict from
+      `load_kmc_results`, as before.
+    - The combined dict only has the columns used by `kmc_analyze` (see
+      `load_kmc_results`), as numpy arrays rather than lists. The Carrier
+      attributes which are the same for every carrier ("avg_inter_rate",
+      "avg_intra_rate", "boltz", "hop_limit", "hopping_prefactor",
+      "lambda_ij", "mol_id_dict", "use_avg_hoprates", "use_koopmans",
+      "use_vrh" and "vrh_delocalization") are no longer in it. They follow
+      from the `carrier_kwargs` given here.
     """
+    if kmc_engine not in kmc_engines + ("lockstep",):
+        raise ValueError(
+            f"kmc_engine must be one of {kmc_engines + ('lockstep',)}, not "
+            f"{kmc_engine}"
+        )
+    if backend not in kmc_backends:
+        raise ValueError(
+            f"backend must be one of {kmc_backends}, not {backend}"
+        )
+    if nprocs is None:
+        nprocs = mp.cpu_count()
+    if nprocs < 1:
+        raise ValueError(f"nprocs must be at least 1, not {nprocs}")
     jobs_list = get_jobslist(
-        lifetimes, n_holes=n_holes, n_elec=n_elec, seed=seed
+        lifetimes,
+        n_holes=n_holes,
+        n_elec=n_elec,
+        nprocs=nprocs,
+        seed=seed,
+        batch_size=batch_size,
     )
-    running_jobs = []
-    pipes = []
-
-    for cpu_rank, jobs in enumerate(jobs_list):
-        child_seed = np.random.randint(0, 2 ** 32)
-
-        recv_end, send_end = mp.Pipe(False)
-        p = mp.Process(
-            target=run_single_kmc,
-            args=(jobs, kmc_directory, chromo_list, snap, temp),
-            kwargs={
-                "carrier_kwargs": carrier_kwargs,
-                "seed": child_seed,
-                "send_end": send_end,
-                "verbose": verbose,
-                "cpu_rank": cpu_rank,
-            },
+    if not jobs_list:
+        return {} if combine else []
+    # The hop rates are static, so compute them once and share them with all
+    # of the processes
+    hop_graph = get_hop_graph(chromo_list, snap, temp, carrier_kwargs)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    hop_limit = carrier_kwargs.get("hop_limit")
+    record_history = carrier_kwargs.get("record_history", True)
+    args = [
+        (
+            i,
+            jobs,
+            kmc_engine,
+            hop_limit,
+            record_history,
+            seed,
         )
-        running_jobs.append(p)
-        pipes.append(recv_end)
-
-    for p in running_jobs:
-        p.start()
+        for i, jobs in enumerate(jobs_list)
+    ]
+    histories = {"hole_history": None, "electron_history": None}
+    if record_history:
+        histories = {
+            key: np.zeros(len(hop_graph.indices), dtype=np.int64)
+            for key in histories
+        }
+
+    init_kmc_output(kmc_directory, hop_graph, temp)
+
+    nprocs = max(1, min(nprocs, len(jobs_list)))
+    results_list = [None] * len(jobs_list)
+    with ExitStack() as stack:
+        # Each batch is sent to the next free worker and the results are
+        # merged in whatever order they finish
+        if backend == "process":
+            spec, blocks = hop_graph.to_shared_memory()
+            stack.callback(_release_blocks, blocks)
+            pool = stack.enter_context(
+                mp.Pool(
+                    processes=nprocs,
+                    initializer=_init_kmc_worker,
+                    initargs=(spec,),
+                )
+            )
+            batches = pool.imap_unordered(_kmc_worker, args)
+        elif backend == "thread":
+            pool = stack.enter_context(ThreadPool(processes=nprocs))
+            batches = pool.imap_unordered(partial(_run_batch, hop_graph), args)
+        else:
+            batches = map(partial(_run_batch, hop_graph), args)
+
+        for n_done, (i, results) in enumerate(batches, start=1):
+            for key in histories:
+                counts = results.pop(key)
+                if counts is not None:
+                    edges, n_hops = counts
+                    histories[key][edges] += n_hops
+            write_kmc_batch(kmc_directory, i, results)
+            if not combine:
+                results_list[i] = results
+            v_print(
+                f"{n_done}/{len(jobs_list)} KMC batches completed",
+                verbose,
+                v_level=1,
+            )
 
-    carriers_lists = [x.recv() for x in pipes]
+    write_kmc_histories(kmc_directory, histories)
+    v_print("All KMC jobs completed!", verbose)
+    if not combine:
+        # Keep the carriers in job order so the output doesn't depend on timing
+        results = _merge_results(results_list)
+        # The lockstep engine picks hops using the BKL method
+        if kmc_engine == "lockstep":
+            kmc_engine = "bkl"
+        return _get_carriers(
+            results,
+            chromo_list,
+            snap,
+            temp,
+            hop_graph,
+            dict(carrier_kwargs, kmc_engine=kmc_engine),
+        )
 
-    carriers = [item for sublist in carriers_lists for item in sublist]
     # Now combine the carrier data
-    v_print("All KMC jobs completed!", verbose)
-    if combine:
-        v_print("Combining outputs...", verbose)
-
-        combined_data = {}
-        for carrier in carriers:
-            d = carrier.__dict__
-            for key, val in d.items():
-                if key in ["initial_chromo", "current_chromo"]:
-                    val = val.center
-                    key = key.split("_")[0] + "_position"
-                if key not in ["hole_history", "electron_history"]:
-                    val = [val]
-                if key not in combined_data:
-                    combined_data[key] = val
-                else:
-                    try:
-                        combined_data[key] += val
-                    except TypeError:
-                        # catch errors trying to add None and None
-                        combined_data[key] = val
-        return combined_data
+    v_print("Combining outputs...", verbose)
+    return load_kmc_results(kmc_directory)
+
+
+def _get_carriers(results, chromo_list, snap, temp, hop_graph, carrier_kwargs):
+    """Make Carriers in the final state of each carrier in the results."""
+    box = snap.configuration.box[:3]
+    # The histories were recorded together
+    carrier_kwargs = dict(carrier_kwargs, record_history=False)
+    carriers = []
+    for k, carrier_no in enumerate(results["id"]):
+        carrier = Carrier(
+            chromo_list[results["initial_chromo"][k]],
+            results["lifetime"][k],
+            int(carrier_no),
+            box,
+            temp,
+            len(chromo_list),
+            mol_id_dict=hop_graph.mol_id_dict,
+            hop_graph=hop_graph,
+            **carrier_kwargs,
+        )
+        carrier.current_chromo = chromo_list[results["current_chromo"][k]]
+        carrier.image = results["image"][k].copy()
+        carrier.current_time = results["current_time"][k]
+        carrier.n_hops = int(results["n_hops"][k])
+        carrier.displacement = results["displacement"][k]
+        carriers.append(carrier)
     return carriers
 
+
+# The hop graph attached by each KMC worker process
+_worker_graph = None
+_worker_blocks = None
+
+
+def _init_kmc_worker(spec):
+    """Attach the KMC worker process to the shared hop graph."""
+    global _worker_graph, _worker_blocks
+    _worker_graph, _worker_blocks = attach_hop_graph(spec)
+
+
+def _release_blocks(blocks):
+    """Close and free the shared memory blocks of a hop graph."""
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def _kmc_worker(args):
+    """Run a batch of KMC jobs on the shared hop graph."""
+    return _run_batch(_worker_graph, args)
+
+
+def _run_batch(hop_graph, args):
+    """Run a batch of KMC jobs.
+
+    The histories are sent back as the visited edges and their counts, which
+    is much smaller than the full edge arrays for a small batch.
+    """
+    i, jobs, kmc_engine, hop_limit, record_history, seed = args
+    results = run_jobs(
+        jobs,
+        hop_graph,
+        kmc_engine=kmc_engine,
+        hop_limit=hop_limit,
+        record_history=record_history,
+        seed=seed,
+    )
+    for key in ["hole_history", "electron_history"]:
+        history = results[key]
+        if history is not None:
+            edges = np.flatnonzero(history)
+            results[key] = (edges, history[edges])
+    return i, results
+
+
+def run_jobs(
+    jobs,
+    hop_graph,
+    kmc_engine="frm",
+    hop_limit=None,
+    record_history=True,
+    seed=None,
+):
+    """Run a list of KMC jobs using only the hop graph arrays.
+
+    Parameters
+    ----------
+    jobs : list of (int, float, str)
+        List of parameters for the KMC job: the carrier index, lifetime, and
+        species ("electron" or "hole").
+    hop_graph : HopGraph
+        Precomputed hop rates.
+    kmc_engine : str, default "frm"
+        "frm" or "bkl" run the carriers one after another using that method
+        to pick each hop (see `Carrier`). "lockstep" advances all of the
+        carriers at once using the BKL method.
+    hop_limit : int, default None
+       A maximum number of hops used to kill the KMC run.
+    record_history : bool, default True
+        Whether to record the number of hops along each edge of the hop graph.
+    seed : int, default None
+        The seed of the carriers' random streams (see `get_carrier_rng`). If
+        None is given, fresh entropy is used.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        The per-carrier results and the histories. See `run_lockstep_kmc`.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    if kmc_engine == "lockstep":
+        return run_lockstep_kmc(
+            jobs,
+            hop_graph,
+            hop_limit=hop_limit,
+            record_history=record_history,
+            seed=seed,
+        )
+
+    histories = {"hole": None, "electron": None}
+    if record_history:
+        histories = {
+            "hole": hop_graph.new_history(),
+            "electron": hop_graph.new_history(),
+        }
+    candidates = {
+        "hole": np.flatnonzero(hop_graph.species == "donor"),
+        "electron": np.flatnonzero(hop_graph.species == "acceptor"),
+    }
+    columns = defaultdict(list)
+    for carrier_no, lifetime, c_type in jobs:
+        rng = get_carrier_rng(seed, c_type, carrier_no, lifetime)
+        # Find a random position to start the carrier in
+        chromos = candidates[c_type]
+        start = chromos[int(rng.random() * len(chromos))]
+        current, image, current_time, n_hops = _run_carrier(
+            start,
+            lifetime,
+            hop_graph,
+            kmc_engine,
+            hop_limit,
+            histories[c_type],
+            rng,
+        )
+        columns["id"].append(carrier_no)
+        columns["c_type"].append(c_type)
+        columns["lifetime"].append(lifetime)
+        columns["current_time"].append(current_time)
+        columns["n_hops"].append(n_hops)
+        columns["image"].append(image)
+        columns["initial_chromo"].append(start)
+        columns["current_chromo"].append(current)
+
+    results = {key: np.array(val) for key, val in columns.items()}
+    results["c_type"] = results["c_type"].astype("<U8")
+    results["image"] = results["image"].reshape(-1, 3)
+    results["displacement"] = np.linalg.norm(
+        hop_graph.centers[results["current_chromo"]].reshape(-1, 3)
+        - hop_graph.centers[results["initial_chromo"]].reshape(-1, 3)
+        + results["image"] * hop_graph.box,
+        axis=1
+    )
+    results["hole_history"] = histories["hole"]
+    results["electron_history"] = histories["electron"]
+    return results
+
+
+def _run_carrier(
+    start, lifetime, hop_graph, kmc_engine, hop_limit, history, rng
+):
+    """Hop a single carrier until it reaches its lifetime or hop limit.
+
+    Returns the final chromophore, image, time and number of hops.
+    """
+    current = start
+    image = np.zeros(3, dtype=int)
+    current_time = 0.0
+    n_hops = 0
+    while hop_limit is None or n_hops + 1 <= hop_limit:
+        edge_start = hop_graph.indptr[current]
+        if kmc_engine == "bkl":
+            i_hop, hop_time = hf.get_bkl_event(
+                hop_graph.get_cum_rates(current), rng
+            )
+        else:
+            n_inds, rel_imgs, hop_rates = hop_graph.get_rates(current)
+            hop_times = hf.get_event_taus(hop_rates, rng)
+            i_hop = np.argmin(hop_times) if len(hop_times) > 0 else None
+            hop_time = hop_times[i_hop] if i_hop is not None else 1e99
+        # Stop if trapped or if the hop would put the carrier over its lifetime
+        if i_hop is None:
+            break
+        if hop_limit is None and current_time + hop_time > lifetime:
+            break
+        edge = edge_start + i_hop
+        current = hop_graph.indices[edge]
+        image += hop_graph.images[edge]
+        current_time += hop_time
+        n_hops += 1
+        if history is not None:
+            history[edge] += 1
+    return current, image, current_time, n_hops
@@ -6,7 +6,11 @@ import numpy as np
 
 from morphct.chromophores import Chromophore, set_neighbors_voronoi
 from morphct.execute_qcc import (
-    singles_homolumo, dimer_homolumo, set_energyvalues
+    QCCGeometry,
+    SnapshotIndex,
+    screen_pairs,
+    singles_dimer_homolumo,
+    set_energyvalues,
 )
 from morphct.mobility_kmc import run_kmc
 from morphct import kmc_analyze
@@ -37,13 +41,27 @@ class System():  # pragma: no cover
         The system snapshot with lengths scaled to Angstroms.
     conversion_dict : dict
         A dictionary to map atom types to an ele.element.
+    snap_index : morphct.execute_qcc.SnapshotIndex
+        The unwrapped positions, elements, and bonds of the snapshot used to
+        write the QCC inputs.
     chromophores : list of Chromophore
         List of chromphores in the simulation.
     outpath : path
         The path to a directory where output files will be saved.
-    qcc_pairs : list of ((int, int), str)
-        QCC input for the pairs. Each list item contains a tuple of the pair
-        indices and the QCC input string.
+    qcc_pairs : morphct.execute_qcc.QCCPairs
+        QCC input for the pairs. Each item contains a tuple of the pair
+        indices and the QCC input geometry, which is written when it is
+        accessed.
+    skipped_pairs : list of (int, int)
+        Pairs which were screened out of the QCC calculations because their
+        chromophores are too far apart to couple, or whose calculation
+        failed. Their transfer integral is set to zero.
+    max_contact : float
+        The largest closest contact of the calculated pairs (see
+        `compute_energies`), or None if the pairs weren't screened.
+    qcc_failures : list of (tuple, str)
+        The indices of the chromophores and pairs whose QCC calculation failed
+        or didn't converge in `compute_energies`, and the reason.
 
     Methods
     -------
@@ -82,6 +100,8 @@ class System():  # pragma: no cover
 
         self.snap = snap
         self.conversion_dict = conversion_dict
+        # Positions, elements, and bonds used to write all of the QCC inputs
+        self.snap_index = SnapshotIndex(snap, conversion_dict)
         if not os.path.exists(outpath):
             os.makedirs(outpath)
         self.outpath = outpath
@@ -89,6 +109,9 @@ class System():  # pragma: no cover
         self._carrier_data = None
         self._comp = None
         self.qcc_pairs = None
+        self.skipped_pairs = []
+        self.max_contact = None
+        self.qcc_failures = []
         self._dinds = []
         self._ainds = []
 
@@ -124,6 +147,7 @@ class System():  # pragma: no cover
                     ind,
                     species,
                     self.conversion_dict,
+                    snap_index=self.snap_index,
                     **chromophore_kwargs
                 )
             )
@@ -132,7 +156,13 @@ class System():  # pragma: no cover
         else:
             self._dinds += indices
 
-    def compute_energies(self, dcut=None):
+    def compute_energies(
+        self,
+        dcut=None,
+        max_contact=None,
+        ti_method="splitting",
+        qcc_kwargs=None,
+    ):
         """Compute the energies of the chromophores in the system.
 
         Parameters
@@ -141,31 +171,130 @@ class System():  # pragma: no cover
             The distance cutoff for chromophore neighbors. If None is provided,
             the cutoff will be set to half the smallest box length of the
             snapshot.
+        max_contact : float, default None
+            If given, pairs whose closest heavy atoms are further apart than
+            this (in Angstroms) aren't calculated and their transfer integral
+            is set to zero (see `morphct.execute_qcc.screen_pairs`). The
+            screened pairs are kept and used by `set_energies`. If None is
+            given, all pairs are calculated.
+        ti_method : str, default "splitting"
+            How the transfer integrals are calculated. "splitting" runs an SCF
+            of each pair and uses the splitting of its energy levels, and
+            "projection" projects the orbitals of the chromophores onto the
+            Fock matrix of the pair without an SCF (see
+            `morphct.execute_qcc.dimer_projection`). "surrogate" calculates a
+            sample of the pairs and predicts the rest from their geometry
+            (see `morphct.execute_qcc.dimer_surrogate`). The pair results are
+            written to a different file for each method. Pass the same value
+            to `set_energies`.
+        qcc_kwargs : dict, default None
+            Options of how the calculations are run, passed to
+            `morphct.execute_qcc.singles_dimer_homolumo`. They don't change
+            which inputs are calculated, only how and whether they are run
+            again. For example:
+
+            - "cache": a `morphct.execute_qcc.QCCCache` (or the path to one)
+              of results from previous runs.
+            - "resume": whether to keep the energies already written to the
+              output files (default False). Each line has a fingerprint of
+              its input, so energies of other inputs (e.g., from another frame
+              written to the same outpath) are calculated again. The lines
+              are ``i e0 e1 e2 e3 # <fingerprint>`` for the singles and
+              ``i j e0 e1 e2 e3 # <fingerprint>`` for the pairs, in the order
+              the calculations finish; earlier versions wrote the singles
+              without the index column and neither file had a fingerprint.
+            - "executor": a `morphct.execute_qcc.QCCExecutor` to run the
+              calculations in. Pass the same executor when computing the
+              energies of several systems so the workers are only started
+              once, or to set a time limit and the retries of each
+              calculation. Otherwise "nprocs" and "threads_per_proc" size the
+              workers started for this system (see
+              `morphct.execute_qcc.get_qcc_threads`).
+            - "warm_start": whether to start each pair calculation from the
+              density matrices of its chromophores.
+            - "dedup_tol": the RMSD in Angstroms under which inputs which are
+              the same up to a rigid-body motion are only calculated once
+              (see `morphct.execute_qcc.find_duplicates`).
+            - "surrogate_kwargs": options of
+              `morphct.execute_qcc.dimer_surrogate`, if `ti_method` is
+              "surrogate".
+
+            If None is given, the calculations are run in a new pool of
+            workers without a cache.
         """
         if dcut is None:
             dcut = min(self.snap.configuration.box[:3]/2)
         self.qcc_pairs = set_neighbors_voronoi(
-            self.chromophores, self.snap, self.conversion_dict, d_cut=dcut
+            self.chromophores,
+            self.snap,
+            self.conversion_dict,
+            d_cut=dcut,
+            snap_index=self.snap_index,
         )
         print(f"There are {len(self.qcc_pairs)} chromophore pairs")
+        self._screen_pairs(max_contact)
 
         s_filename = os.path.join(self.outpath, "singles_energies.txt")
-        d_filename = os.path.join(self.outpath, "dimer_energies.txt")
+        d_filename = self._dimer_filename(ti_method)
 
         t0 = time.perf_counter()
-        print("Starting singles energy calculation...")
-        data = singles_homolumo(self.chromophores, s_filename)
+        print("Starting singles and dimer energy calculation...")
+        data, dimer_data = singles_dimer_homolumo(
+            self.chromophores,
+            self.qcc_pairs,
+            s_filename,
+            d_filename,
+            ti_method=ti_method,
+            failures=self.qcc_failures,
+            **(qcc_kwargs or {}),
+        )
         t1 = time.perf_counter()
-        print(f"Finished in {t1-t0:.2f} s. Output written to {s_filename}.")
-
-        print("Starting dimer energy calculation...")
-        dimer_data = dimer_homolumo(
-            self.qcc_pairs, self.chromophores, d_filename
+        print(
+            f"Finished in {t1-t0:.2f} s. Output written to {s_filename} and "
+            f"{d_filename}."
         )
-        t2 = time.perf_counter()
-        print(f"Finished in {t2-t1:.2f} s. Output written to {d_filename}.")
+        self._check_failures(data, dimer_data)
+
+    def _check_failures(self, data, dimer_data):
+        for inds, reason in self.qcc_failures:
+            print(f"QCC calculation of {inds} failed: {reason}")
+        failed_pairs = [
+            pair for pair, energies in dimer_data
+            if not np.all(np.isfinite(energies))
+        ]
+        if failed_pairs:
+            print(
+                f"Setting the transfer integral of {len(failed_pairs)} failed "
+                "pairs to zero"
+            )
+            self.skipped_pairs += failed_pairs
+        failed = np.flatnonzero(~np.all(np.isfinite(data), axis=1))
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"The energies of chromophores {failed.tolist()} couldn't be "
+                "calculated. Run compute_energies again with resume=True in "
+                "qcc_kwargs to only retry them."
+            )
+
+    def _screen_pairs(self, max_contact):
+        self.skipped_pairs = []
+        self.max_contact = max_contact
+        self.qcc_failures = []
+        if max_contact is not None:
+            self.qcc_pairs, self.skipped_pairs = screen_pairs(
+                self.qcc_pairs, max_contact
+            )
+            print(
+                f"Skipping {len(self.skipped_pairs)} pairs with no heavy atoms "
+                f"within {max_contact} Angstroms"
+            )
+
+    def _dimer_filename(self, ti_method):
+        if ti_method in ("projection", "surrogate"):
+            return os.path.join(self.outpath, f"dimer_{ti_method}.txt")
+        return os.path.join(self.outpath, "dimer_energies.txt")
 
-    def set_energies(self, dcut=None):
+    def set_energies(self, dcut=None, max_contact=None, ti_method="splitting"):
         """Set the computed energies.
 
         Parameters
@@ -174,23 +303,53 @@ class System():  # pragma: no cover
             The distance cutoff for chromophore neighbors. If None is provided,
             the cutoff will be set to half the smallest box length of the
             snapshot.
+        max_contact : float, default None
+            The screening distance passed to `compute_energies`. Only needed
+            if the pairs haven't been found yet in this session; otherwise
+            the pairs skipped by `compute_energies` are used.
+        ti_method : str, default "splitting"
+            The method passed to `compute_energies`.
+
+        Raises
+        ------
+        ValueError
+            If `max_contact` is given and isn't the screening distance the
+            pairs were screened with.
         """
-        if self.qcc_pairs is None:
+        if self.qcc_pairs is not None:
+            if max_contact is not None and max_contact != self.max_contact:
+                raise ValueError(
+                    f"The pairs were screened with max_contact="
+                    f"{self.max_contact} in compute_energies, not "
+                    f"{max_contact}."
+                )
+        else:
             if dcut is None:
                 dcut = min(self.snap.configuration.box[:3]/2)
             self.qcc_pairs = set_neighbors_voronoi(
-                self.chromophores, self.snap, self.conversion_dict, d_cut=dcut
+                self.chromophores,
+                self.snap,
+                self.conversion_dict,
+                d_cut=dcut,
+                snap_index=self.snap_index,
             )
+            self._screen_pairs(max_contact)
 
         s_filename = os.path.join(self.outpath, "singles_energies.txt")
-        d_filename = os.path.join(self.outpath, "dimer_energies.txt")
+        d_filename = self._dimer_filename(ti_method)
 
         if not (os.path.isfile(s_filename) and os.path.isfile(d_filename)):
             raise FileNotFoundError(
                 f"Expected to find {s_filename} and {d_filename}, but didn't."
             )
 
-        set_energyvalues(self.chromophores, s_filename, d_filename)
+        set_energyvalues(
+            self.chromophores,
+            s_filename,
+            d_filename,
+            self.skipped_pairs,
+            ti_method,
+        )
         print("Energies set.")
 
     def run_kmc(
@@ -201,7 +360,10 @@ class System():  # pragma: no cover
         n_elec=0,
         seed=42,
         carrier_kwargs={},
-        verbose=0
+        verbose=0,
+        kmc_engine="frm",
+        nprocs=None,
+        backend="process",
     ):
         """Run the KMC simulation.
 
@@ -222,6 +384,18 @@ class System():  # pragma: no cover
             Additional keyword arguments to be passed to the carrier instances.
         verbose : int, default 0
             The verbosity level of output.
+        kmc_engine : str, default "frm"
+            The algorithm used to pick each hop, "frm" (first reaction method)
+            or "bkl" (rejection-free BKL/Gillespie method). See
+            `morphct.mobility_kmc.Carrier`. If "lockstep" is given, carriers
+            are advanced together as arrays (see
+            `morphct.mobility_kmc.run_lockstep_kmc`).
+        nprocs : int, default None
+            The number of worker processes or threads. If None is given, the
+            number of CPUs is used.
+        backend : str, default "process"
+            How the KMC jobs are run: "serial", "process" (a process pool), or
+            "thread" (a thread pool). See `morphct.mobility_kmc.run_kmc`.
         """
         kmc_dir = os.path.join(self.outpath, "kmc")
         if not os.path.exists(kmc_dir):
@@ -236,7 +410,10 @@ class System():  # pragma: no cover
             n_elec=n_elec,
             seed=seed,
             carrier_kwargs=carrier_kwargs,
-            verbose=verbose
+            verbose=verbose,
+            kmc_engine=kmc_engine,
+            nprocs=nprocs,
+            backend=backend,
         )
 
         self._carrier_data = data
@@ -264,13 +441,12 @@ class System():  # pragma: no cover
             qcc_input = self.chromophores[i].qcc_input
         else:
             qcc_input = self.qcc_pairs[i][1]
+        if isinstance(qcc_input, str):
+            qcc_input = QCCGeometry.from_string(qcc_input)
         comp = mb.Compound()
-        for line in qcc_input.split(";")[:-1]:
-            atom, x, y, z = line.split()
-            xyz = np.array([x,y,z], dtype=float)
+        for atom, xyz in zip(qcc_input.symbols, qcc_input.positions):
             # Angstrom -> nm
-            xyz /= 10
-            comp.add(mb.Particle(name=atom, pos=xyz))
+            comp.add(mb.Particle(name=atom, pos=xyz / 10))
         comp.visualize().show()
 
     def visualize_system(self):
@@ -6,6 +6,39 @@ test_dir = os.path.dirname(__file__)
 
 
 class BaseTest:
+    @pytest.fixture
+    def serial_executor(self):
+        """Get a class of QCC executors which run the tasks in this process.
+
+        Without `get_energies` each task is run like in a worker. Otherwise
+        each task gets ``get_energies(i)``, with the given failure and
+        cacheable flag, and nothing is calculated.
+        """
+        from morphct.execute_qcc import _indexed_worker
+
+        class SerialExecutor:
+            def __init__(
+                self, get_energies=None, failure=None, cacheable=False
+            ):
+                self.get_energies = get_energies
+                self.failure = failure
+                self.cacheable = cacheable
+                self.started = []
+
+            def imap_unordered(self, tasks):
+                for task in tasks:
+                    self.started.append(task[0])
+                    if self.get_energies is None:
+                        yield _indexed_worker(task)
+                        continue
+                    energies = self.get_energies(task[0])
+                    yield (
+                        task[0], None, energies, None, self.failure,
+                        self.cacheable
+                    )
+
+        return SerialExecutor
+
     @pytest.fixture
     def p3ht_snap(self):
         import gsd.hoomd
@@ -17,6 +17,7 @@ class TestChromophores(BaseTest):
 
     def test_init_chromophore(self, p3ht_snap):
         from morphct.chromophores import Chromophore, conversion_dict
+        from morphct.execute_qcc import QCCGeometry
 
         atom_ids = np.array([1, 0, 4, 3, 2, 5, 6, 7, 8, 9, 10])
         chromo = Chromophore(0, p3ht_snap, atom_ids, "donor", conversion_dict)
@@ -31,10 +32,10 @@ class TestChromophores(BaseTest):
         assert chromo.id == 0
         assert np.array_equal(chromo.image, np.array([0, 0, 0]))
         assert chromo.n_atoms == 11
-        assert len(chromo.qcc_input) == 1649
-        assert isinstance(chromo.qcc_input, str)
+        assert isinstance(chromo.qcc_input, QCCGeometry)
+        assert len(str(chromo.qcc_input)) == 1649
         assert (
-            chromo.qcc_input.split(";")[0]
+            str(chromo.qcc_input).split(";")[0]
             == "C 0.5295219754255722 0.9320423792455799 1.655608689036562"
         )
         assert chromo.reorganization_energy == 0.3064
@@ -72,7 +73,7 @@ class TestChromophores(BaseTest):
         assert len(qcc_pairs) == 181
         assert pair == (0, 1)
         assert (
-            qcc_input.split(";")[0]
+            str(qcc_input).split(";")[0]
             == "C -3.7486698030653614 -0.26928230395247255 -1.6724275287954669"
         )
 
@@ -1,4 +1,6 @@
 import numpy as np
+import pytest
+
 from base_test import BaseTest
 
 
@@ -50,3 +52,714 @@ class TestEQCC(BaseTest):
         assert chromo.lumo_1 == 0.8652349542720108
         assert chromo.neighbors_delta_e[0] == -0.016112646653095197
         assert chromo.neighbors_ti[0] == 0.2456720694088973
+
+    def test_screen_pairs(
+        self,
+        tmpdir,
+        p3ht_snap,
+        p3ht_chromo_list,
+        p3ht_chromo_list_neighbors,
+        p3ht_sfilename,
+        p3ht_dfilename,
+    ):
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import (
+            get_pair_descriptors, screen_pairs, set_energyvalues
+        )
+
+        box = p3ht_snap.configuration.box[:3]
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict, d_cut=min(box) / 2
+        )
+        contacts, alignments = get_pair_descriptors(qcc_pairs)
+        assert contacts.shape == alignments.shape == (181,)
+        assert np.all((alignments >= 0) & (alignments <= 1 + 1e-12))
+        # The contacts are the same as in the pair inputs
+        for n in [0, 50, 100]:
+            (i, j), qcc_input = qcc_pairs[n]
+            n_i = p3ht_chromo_list[i].n_atoms
+            n_j = p3ht_chromo_list[j].n_atoms
+            heavy = qcc_input.numbers > 1
+            pos_i = qcc_input.positions[:n_i][heavy[:n_i]]
+            pos_j = qcc_input.positions[n_i : n_i + n_j][heavy[n_i : n_i + n_j]]
+            dists = np.linalg.norm(pos_i[:, None] - pos_j[None], axis=-1)
+            assert np.isclose(contacts[n], dists.min())
+
+        kept_pairs, skipped_pairs = screen_pairs(qcc_pairs, max_contact=10)
+        assert len(kept_pairs) + len(skipped_pairs) == len(qcc_pairs)
+        assert kept_pairs.writer is qcc_pairs.writer
+        assert np.all(get_pair_descriptors(kept_pairs)[0] <= 10)
+        assert (0, 1) in kept_pairs.pairs
+
+        # Skipped pairs get a transfer integral of zero
+        d_filename = str(tmpdir.join("dimer_energies.txt"))
+        with open(p3ht_dfilename) as f, open(d_filename, "w") as g:
+            g.writelines(line for line in f if not line.startswith("0 1 "))
+        set_energyvalues(
+            p3ht_chromo_list_neighbors, p3ht_sfilename, d_filename, [(0, 1)]
+        )
+        chromo = p3ht_chromo_list_neighbors[0]
+        assert chromo.neighbors_delta_e[0] == -0.016112646653095197
+        assert chromo.neighbors_ti[0] == 0
+
+    def test_qcc_cache(self, tmpdir, p3ht_chromo_list):
+        from morphct.execute_qcc import QCCCache, singles_homolumo
+
+        chromo = p3ht_chromo_list[0]
+        cache = QCCCache(tmpdir.join("qcc.db"), max_entries=2)
+        data = singles_homolumo([chromo], cache=cache)
+        assert len(cache) == 1
+
+        key = cache.get_key(chromo.qcc_input)
+        assert np.array_equal(cache.get([key])[0], data[0])
+        assert cache.get(["missing"]) == [None]
+        # Tiny differences in the positions give the same key
+        shifted = chromo.qcc_input.replace(";", "000001;", 1)
+        assert cache.get_key(shifted) == key
+        assert cache.get_key(chromo.qcc_input, charge=1) != key
+
+        # The cached result is used without running the calculation
+        cache.put({key: np.zeros(4)})
+        data = singles_homolumo([chromo], cache=tmpdir.join("qcc.db"))
+        assert np.array_equal(data, np.zeros((1, 4)))
+
+        # The least recently used results are evicted
+        cache.put({"a": np.ones(4)})
+        cache.put({"b": np.ones(4)})
+        assert len(cache) == 2
+        assert cache.get([key]) == [None]
+
+        # Replaced results aren't counted again
+        cache.put({"b": np.full(4, 2.0), "c": np.ones(4)})
+        assert cache._n_results == len(cache) == 2
+        assert cache.get(["a"]) == [None]
+        assert np.array_equal(cache.get(["b"])[0], np.full(4, 2.0))
+
+        # The connection is reused until the cache is closed
+        con = cache._connect()
+        assert cache._connect() is con
+        cache.close()
+        assert cache._connect() is not con
+        assert len(cache) == 2
+
+    def test_resume(self, tmpdir, p3ht_qcc_pairs, p3ht_chromo_list):
+        from morphct.execute_qcc import (
+            _dimer_args,
+            _get_fingerprint,
+            dimer_homolumo,
+            get_dimerdata,
+            get_singlesdata,
+            singles_homolumo,
+        )
+
+        s_filename = str(tmpdir.join("singles_energies.txt"))
+        data = singles_homolumo(p3ht_chromo_list[:2], s_filename)
+        assert np.array_equal(get_singlesdata(s_filename), data)
+
+        # Only the missing chromophore is calculated and a line which wasn't
+        # completely written is ignored
+        chromo = p3ht_chromo_list[1]
+        fingerprint = _get_fingerprint(chromo.qcc_input, chromo.charge)
+        with open(s_filename, "w") as f:
+            f.write(f"1 1.0 2.0 3.0 4.0 # {fingerprint}\n0 -9.0 -8.5")
+        resumed = singles_homolumo(
+            p3ht_chromo_list[:2], s_filename, resume=True
+        )
+        assert np.allclose(resumed[0], data[0])
+        assert np.array_equal(resumed[1], [1.0, 2.0, 3.0, 4.0])
+        assert np.array_equal(get_singlesdata(s_filename), resumed)
+
+        # A line whose input has changed (e.g., from another frame) or which
+        # has no fingerprint is calculated again
+        with open(s_filename, "w") as f:
+            f.write("0 -9.0 -8.5 0.0 1.0 # 0123456789abcdef\n")
+            f.write("1 1.0 2.0 3.0 4.0\n")
+        resumed = singles_homolumo(
+            p3ht_chromo_list[:2], s_filename, resume=True
+        )
+        assert np.allclose(resumed, data)
+
+        # Pairs which aren't being calculated are dropped from the file
+        pairs, args = _dimer_args(p3ht_qcc_pairs[:1], p3ht_chromo_list)
+        fingerprint = _get_fingerprint(*args[0])
+        d_filename = str(tmpdir.join("dimer_energies.txt"))
+        with open(d_filename, "w") as f:
+            f.write("5 6 1.0 2.0 3.0 4.0\n")
+            f.write(f"0 1 -8.0 -7.0 0.0 1.0 # {fingerprint}\n")
+        dimer_data = dimer_homolumo(
+            p3ht_qcc_pairs[:1], p3ht_chromo_list, d_filename, resume=True
+        )
+        assert dimer_data[0][0] == (0, 1)
+        assert np.array_equal(dimer_data[0][1], [-8.0, -7.0, 0.0, 1.0])
+        assert [pair for pair, en in get_dimerdata(d_filename)] == [(0, 1)]
+
+        # Singles files must have every chromophore index once
+        with open(s_filename, "w") as f:
+            f.write("0 -9.0 -8.5 0.0 1.0\n2 -9.0 -8.5 0.0 1.0\n")
+        with pytest.raises(ValueError, match="Missing indices: \\[1\\]"):
+            get_singlesdata(s_filename)
+
+    def test_qcc_pairs(
+        self, tmpdir, p3ht_snap, p3ht_chromo_list, p3ht_qcc_pairs
+    ):
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import QCCCache, QCCPairs, dimer_homolumo
+
+        box = p3ht_snap.configuration.box[:3]
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict, d_cut=min(box) / 2
+        )
+        assert isinstance(qcc_pairs, QCCPairs)
+        assert len(qcc_pairs.pairs) == len(qcc_pairs.images) == 181
+        pair, qcc_input = qcc_pairs[0]
+        assert pair == p3ht_qcc_pairs[0][0]
+        assert qcc_input.to_string() == p3ht_qcc_pairs[0][1]
+
+        # The workers write the input and check the cache
+        qcc_pairs.pairs = qcc_pairs.pairs[:1]
+        qcc_pairs.images = qcc_pairs.images[:1]
+        cache = QCCCache(tmpdir.join("qcc.db"))
+        dimer_data = dimer_homolumo(qcc_pairs, p3ht_chromo_list, cache=cache)
+        assert dimer_data[0][0] == (0, 1)
+        assert np.allclose(
+            dimer_data[0][1],
+            np.array([-8.70917208, -8.21756382, -0.26434042, 0.35184321]),
+        )
+        assert len(cache) == 1
+        key = cache.get_key(qcc_input)
+        cache.put({key: np.zeros(4)})
+        dimer_data = dimer_homolumo(qcc_pairs, p3ht_chromo_list, cache=cache)
+        assert np.array_equal(dimer_data[0][1], np.zeros(4))
+
+    def test_qcc_executor(self, p3ht_qcc_pairs, p3ht_chromo_list):
+        from morphct.execute_qcc import (
+            QCCExecutor, dimer_homolumo, singles_homolumo
+        )
+
+        with QCCExecutor(nprocs=2) as executor:
+            data = singles_homolumo(p3ht_chromo_list[:2], executor=executor)
+            dimer_data = dimer_homolumo(
+                p3ht_qcc_pairs[:1], p3ht_chromo_list, executor=executor
+            )
+        assert np.allclose(
+            data[0], [-9.01337182, -8.5404688, 0.17193304, 0.86523495]
+        )
+        assert np.allclose(
+            dimer_data[0][1],
+            [-8.70917208, -8.21756382, -0.26434042, 0.35184321],
+        )
+        with pytest.raises(ValueError):
+            singles_homolumo(p3ht_chromo_list[:1], executor=executor)
+
+    def test_singles_dimer_homolumo(
+        self, tmpdir, serial_executor, p3ht_qcc_pairs, p3ht_chromo_list
+    ):
+        from morphct.execute_qcc import (
+            get_dimerdata, get_singlesdata, singles_dimer_homolumo
+        )
+
+        executor = serial_executor()
+        s_filename = str(tmpdir.join("singles_energies.txt"))
+        d_filename = str(tmpdir.join("dimer_energies.txt"))
+        data, dimer_data = singles_dimer_homolumo(
+            p3ht_chromo_list[:2],
+            p3ht_qcc_pairs[:1],
+            s_filename,
+            d_filename,
+            executor=executor,
+        )
+        # The larger pair input is started before the singles
+        assert executor.started == [2, 0, 1]
+        assert np.allclose(
+            data[0], [-9.01337182, -8.5404688, 0.17193304, 0.86523495]
+        )
+        assert dimer_data[0][0] == (0, 1)
+        assert np.allclose(
+            dimer_data[0][1],
+            [-8.70917208, -8.21756382, -0.26434042, 0.35184321],
+        )
+        assert np.array_equal(get_singlesdata(s_filename), data)
+        assert get_dimerdata(d_filename)[0][0] == (0, 1)
+
+    def test_warm_start(self, p3ht_snap, p3ht_chromo_list):
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import (
+            _pair_dm0, dimer_homolumo, singles_homolumo
+        )
+
+        box = p3ht_snap.configuration.box[:3]
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict, d_cut=min(box) / 2
+        )
+        qcc_pairs.pairs = qcc_pairs.pairs[:1]
+        qcc_pairs.images = qcc_pairs.images[:1]
+
+        dms = {}
+        singles_homolumo(p3ht_chromo_list[:2], nprocs=1, dms=dms)
+        assert sorted(dms) == [0, 1]
+        # MINDO3 has 4 orbitals for each C and S and 1 for each H
+        assert dms[0].shape == (60, 60)
+        # The trace is the number of valence electrons
+        assert np.isclose(np.trace(dms[0]), 62)
+
+        # The guess has the orbitals of each atom in the pair input
+        writer = qcc_pairs.writer
+        (i, j), qcc_input = qcc_pairs[0]
+        dm0 = writer.get_dm0_task(i, j, dms[i], dms[j])()
+        n_ao = np.sum(np.where(qcc_input.numbers > 2, 4, 1))
+        assert dm0.shape == (n_ao, n_ao)
+
+        dimer_data = dimer_homolumo(
+            qcc_pairs, p3ht_chromo_list, nprocs=1, dms=dms
+        )
+        assert np.allclose(
+            dimer_data[0][1],
+            [-8.70917208, -8.21756382, -0.26434042, 0.35184321],
+            atol=1e-2,
+        )
+
+    def test_dimer_projection(self, tmpdir, p3ht_snap, p3ht_chromo_list):
+        from morphct import transfer_integrals as ti
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import (
+            QCCCache, dimer_homolumo, dimer_projection, singles_homolumo
+        )
+
+        box = p3ht_snap.configuration.box[:3]
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict, d_cut=min(box) / 2
+        )
+        qcc_pairs.pairs = qcc_pairs.pairs[:3:2]
+        qcc_pairs.images = qcc_pairs.images[:3:2]
+
+        dms = {}
+        data = singles_homolumo(p3ht_chromo_list[:4], nprocs=1, dms=dms)
+        cache = QCCCache(tmpdir.join("qcc.db"))
+        dimer_data = dimer_projection(
+            qcc_pairs, p3ht_chromo_list, nprocs=1, dms=dms, cache=cache
+        )
+        assert [pair for pair, values in dimer_data] == [(0, 1), (0, 3)]
+        assert np.isclose(abs(dimer_data[0][1][0]), 0.2307, atol=1e-3)
+        # Distant pairs have no transfer integral
+        assert np.allclose(dimer_data[1][1][:2], 0, atol=1e-4)
+
+        # The bonded pair agrees with the splitting of a pair SCF within
+        # 0.03 eV
+        pair = qcc_pairs.select([True, False])
+        (_, (homo_1, homo, lumo, lumo_1)), = dimer_homolumo(
+            pair, p3ht_chromo_list, nprocs=1
+        )
+        j_homo = ti.calculate_ti(homo - homo_1, data[1, 1] - data[0, 1])
+        assert abs(abs(dimer_data[0][1][0]) - j_homo) < 0.03
+
+        # Results from new monomer orbitals are cached separately
+        assert len(cache) == 2
+        dimer_projection(qcc_pairs, p3ht_chromo_list, nprocs=1, cache=cache)
+        assert len(cache) == 4
+
+        with pytest.raises(ValueError):
+            dimer_projection(list(qcc_pairs), p3ht_chromo_list)
+
+    def test_dimer_surrogate(
+        self,
+        tmpdir,
+        monkeypatch,
+        serial_executor,
+        p3ht_snap,
+        p3ht_chromo_list,
+        p3ht_sfilename,
+    ):
+        from morphct import execute_qcc
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import (
+            dimer_surrogate, get_dimerdata, get_singlesdata
+        )
+
+        box = p3ht_snap.configuration.box[:3]
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict, d_cut=min(box) / 2
+        )
+        qcc_pairs = qcc_pairs.select(np.arange(len(qcc_pairs)) < 8)
+        singles_data = get_singlesdata(p3ht_sfilename)
+        filename = str(tmpdir.join("dimer_surrogate.txt"))
+        predicted = []
+        dimer_data = dimer_surrogate(
+            qcc_pairs,
+            p3ht_chromo_list,
+            singles_data,
+            filename,
+            train_fraction=0.5,
+            max_rounds=0,
+            nprocs=1,
+            predicted=predicted,
+        )
+        assert [pair for pair, energies in dimer_data] == qcc_pairs.pairs
+        assert len(predicted) == 4
+        # The predicted splittings are never smaller than the difference of
+        # the energies of the chromophores
+        for (i, j), (homo_1, homo, lumo, lumo_1) in dimer_data:
+            if (i, j) in predicted:
+                de = singles_data[j, 1] - singles_data[i, 1]
+                assert homo - homo_1 >= abs(de) - 1e-12
+        assert sorted(pair for pair, energies in get_dimerdata(filename)) == (
+            sorted(qcc_pairs.pairs)
+        )
+
+        # A finished file is used as is
+        resumed = dimer_surrogate(
+            qcc_pairs, p3ht_chromo_list, singles_data, filename, resume=True
+        )
+        for (pair, energies), (_, resumed_energies) in zip(dimer_data, resumed):
+            assert np.allclose(energies, resumed_energies)
+
+        # The model is never trained on more than max_train pairs
+        n_train = []
+
+        class GaussianProcess(execute_qcc._GaussianProcess):
+            def __init__(self, x, y):
+                n_train.append(len(y))
+                super().__init__(x, y)
+
+        monkeypatch.setattr(execute_qcc, "_GaussianProcess", GaussianProcess)
+        dimer_surrogate(
+            qcc_pairs,
+            p3ht_chromo_list,
+            singles_data,
+            train_fraction=0.5,
+            max_std=0.0,
+            max_rounds=1,
+            max_train=3,
+            executor=serial_executor(
+                lambda i: np.array([-9.0, -8.0, -1.0, 0.0]) + i / 100
+            ),
+        )
+        # The HOMO and LUMO models are trained once on 3 of the 4 sampled
+        # pairs, then the other 4 are calculated
+        assert n_train == [3, 3]
+
+    def test_gaussian_process(self):
+        from morphct.execute_qcc import _GaussianProcess
+
+        rng = np.random.default_rng(0)
+        x = rng.uniform(0, 10, (30, 2)) * [1, 100]
+        y = np.sin(x[:, 0]) + x[:, 1] / 1000 + rng.normal(0, 0.01, 30)
+        gp = _GaussianProcess(x, y)
+
+        # The closed form of the posterior with the fitted hyperparameters
+        z = (y - y.mean()) / y.std()
+
+        def kernel(a, b, theta):
+            a = (a - x.mean(axis=0)) / x.std(axis=0) / np.exp(theta[:-1])
+            b = (b - x.mean(axis=0)) / x.std(axis=0) / np.exp(theta[:-1])
+            d2 = np.sum((a[:, None] - b[None]) ** 2, axis=2)
+            return np.exp(-0.5 * d2)
+
+        def covariance(theta):
+            return kernel(x, x, theta) + np.exp(theta[-1]) * np.eye(len(x))
+
+        k_inv = np.linalg.inv(covariance(gp.theta))
+        x_test = rng.uniform(0, 10, (20, 2)) * [1, 100]
+        k = kernel(x_test, x, gp.theta)
+        mean = k @ k_inv @ z * y.std() + y.mean()
+        var = 1 + np.exp(gp.theta[-1]) - np.einsum("ij,jk,ik->i", k, k_inv, k)
+        # The standard deviation is scaled by the leave-one-out errors
+        loo = (k_inv @ z) / np.sqrt(np.diag(k_inv))
+        scale = max(1.0, np.sqrt(np.mean(loo ** 2)))
+        std = np.sqrt(var) * scale * y.std()
+
+        pred_mean, pred_std = gp.predict(x_test)
+        assert np.allclose(pred_mean, mean)
+        assert np.allclose(pred_std, std)
+        # The fit is close to the noise-free function
+        assert np.allclose(
+            pred_mean, np.sin(x_test[:, 0]) + x_test[:, 1] / 1000, atol=0.1
+        )
+
+        # The hyperparameters are a minimum of the negative log marginal
+        # likelihood within the bounds
+        def nll(theta):
+            cov = covariance(theta)
+            return 0.5 * z @ np.linalg.solve(cov, z) + 0.5 * (
+                np.linalg.slogdet(cov)[1]
+            )
+
+        best = nll(gp.theta)
+        assert np.isclose(best, gp._nll(gp.theta))
+        bounds = [(-3, 3)] * 2 + [(-9, 0)]
+        for n, (low, high) in enumerate(bounds):
+            for step in (-0.1, 0.1):
+                theta = gp.theta.copy()
+                theta[n] = np.clip(theta[n] + step, low, high)
+                assert nll(theta) >= best - 1e-6
+
+    def test_qcc_failures(self, tmpdir, serial_executor, p3ht_chromo_list):
+        import copy
+        import functools
+        import os
+        import signal
+        import time
+        from morphct.execute_qcc import (
+            QCCCache, QCCExecutor, singles_homolumo
+        )
+
+        tasks = [
+            # The worker is killed
+            (0, functools.partial(os._exit, 1), 0, None, None, False, None),
+            (1, functools.partial(time.sleep, 10), 0, None, None, False, None),
+            (2, functools.partial(int, "x"), 0, None, None, False, None),
+        ]
+        with QCCExecutor(nprocs=1, timeout=0.05) as executor:
+            results = {
+                result[0]: result for result in executor.imap_unordered(tasks)
+            }
+            # The restarted worker keeps going
+            results[3] = next(executor.imap_unordered([(3, *tasks[2][1:])]))
+        assert results[0][4] == "the worker was lost"
+        assert results[1][4] == "timed out after 0.05 s"
+        assert results[2][4].startswith("ValueError")
+        assert results[3][4].startswith("ValueError")
+        assert all(result[2] is None for result in results.values())
+
+        # A worker which doesn't return (it waits for a signal which never
+        # comes, so the time limit can't stop it) is killed, and the other
+        # worker keeps going
+        hang = functools.partial(signal.sigwait, {signal.SIGUSR1})
+        tasks = [
+            (0, hang, 0, None, None, False, None),
+            (1, functools.partial(int, "x"), 0, None, None, False, None),
+        ]
+        with QCCExecutor(nprocs=2, timeout=0.05, max_restarts=1) as executor:
+            workers = list(executor._pool._pool)
+            results = {
+                result[0]: result for result in executor.imap_unordered(tasks)
+            }
+            for worker in workers:
+                worker.join(timeout=1)
+            assert [worker.exitcode for worker in workers].count(None) == 1
+        assert results[0][4] == "the worker was lost"
+        assert results[1][4].startswith("ValueError")
+
+        # Workers which keep being lost stop the run
+        with QCCExecutor(nprocs=2, timeout=0.05, max_restarts=1) as executor:
+            with pytest.raises(RuntimeError):
+                list(
+                    executor.imap_unordered(
+                        [(i, *tasks[0][1:]) for i in range(3)]
+                    )
+                )
+
+        # An odd number of electrons fails without stopping the others
+        chromo = copy.copy(p3ht_chromo_list[1])
+        chromo.charge = 1
+        filename = str(tmpdir.join("singles_energies.txt"))
+        failures = []
+        data = singles_homolumo(
+            [p3ht_chromo_list[0], chromo],
+            filename,
+            nprocs=1,
+            failures=failures,
+        )
+        assert np.all(np.isfinite(data[0]))
+        assert np.all(np.isnan(data[1]))
+        assert [inds for inds, reason in failures] == [(1,)]
+        assert np.loadtxt(filename, ndmin=2)[:, 0].tolist() == [0]
+
+        # Failed and retried results aren't cached
+        cache = QCCCache(tmpdir.join("qcc.db"))
+        for failure, cacheable in [
+            ("not converged after 3 attempts", False),
+            (None, False),
+        ]:
+            singles_homolumo(
+                p3ht_chromo_list[:1],
+                cache=cache,
+                executor=serial_executor(
+                    lambda i: np.arange(4.0), failure, cacheable
+                ),
+            )
+            assert len(cache) == 0
+        singles_homolumo(
+            p3ht_chromo_list[:1],
+            cache=cache,
+            executor=serial_executor(lambda i: np.arange(4.0), None, True),
+        )
+        assert len(cache) == 1
+
+    def test_get_qcc_threads(self, monkeypatch):
+        import os
+        import pyscf
+        from threadpoolctl import threadpool_info
+        from morphct.execute_qcc import QCCExecutor, get_qcc_threads
+
+        monkeypatch.setattr("multiprocessing.cpu_count", lambda: 8)
+        # Small inputs use processes and large ones use threads
+        assert get_qcc_threads(n_basis=120) == (8, 1)
+        assert get_qcc_threads(n_basis=600) == (4, 2)
+        assert get_qcc_threads(n_basis=5000) == (1, 8)
+        assert get_qcc_threads(nprocs=2) == (2, 4)
+        assert get_qcc_threads(threads_per_proc=4) == (2, 4)
+        assert get_qcc_threads(3, 2) == (3, 2)
+
+        monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+        executor = QCCExecutor(nprocs=1, threads_per_proc=2)
+        try:
+            assert executor.threads_per_proc == 2
+            assert executor._pool.apply(pyscf.lib.num_threads) == 2
+            blas = [
+                lib for lib in executor._pool.apply(threadpool_info)
+                if lib["user_api"] == "blas"
+            ]
+            # Some OpenBLAS builds use no more threads than there are CPUs
+            assert blas
+            assert all(lib["num_threads"] <= 2 for lib in blas)
+            # A worker which the pool restarts gets the same limits
+            executor._pool.apply_async(os._exit, (1,))
+            env = executor._pool.apply(os.getenv, ("OMP_NUM_THREADS",))
+            assert env == "2"
+            assert executor._pool.apply(pyscf.lib.num_threads) == 2
+        finally:
+            # The lost task would keep close from returning
+            executor._pool.terminate()
+            executor._pool.join()
+        assert "OMP_NUM_THREADS" not in os.environ
+
+    def test_qcc_geometry(self, p3ht_chromo_list):
+        from morphct.execute_qcc import QCCCache, QCCGeometry, get_homolumo
+
+        qcc_input = p3ht_chromo_list[0].qcc_input
+        geometry = QCCGeometry.from_string(qcc_input)
+        assert len(geometry) == 27
+        assert geometry.numbers.dtype == np.uint8
+        assert geometry.symbols[:3] == ["C", "C", "S"]
+        assert geometry.to_string() == qcc_input
+
+        # The string and arrays give the same energies and cache key
+        assert np.array_equal(
+            get_homolumo(geometry), get_homolumo(qcc_input)
+        )
+        cache = QCCCache(":memory:")
+        assert cache.get_key(geometry) == cache.get_key(qcc_input)
+
+    def test_find_duplicates(self, p3ht_chromo_list):
+        import copy
+        from morphct.execute_qcc import (
+            QCCGeometry, find_duplicates, get_homolumo, singles_homolumo
+        )
+
+        geometry = QCCGeometry.from_string(p3ht_chromo_list[0].qcc_input)
+        # A rotation with a reflection, and a shift
+        rotation = np.array([[0, -1, 0], [1, 0, 0], [0, 0, -1]])
+        moved = QCCGeometry(
+            geometry.numbers, geometry.positions @ rotation.T + 5
+        )
+        other = QCCGeometry.from_string(p3ht_chromo_list[1].qcc_input)
+        reps, rotations = find_duplicates([geometry, other, moved])
+        assert np.array_equal(reps, [0, 1, 0])
+        assert np.allclose(rotations[2], rotation)
+        reps, rotations = find_duplicates(
+            [geometry, other, moved], labels=[0, 0, 1]
+        )
+        assert np.array_equal(reps, [0, 1, 2])
+
+        chromo = copy.copy(p3ht_chromo_list[0])
+        chromo.qcc_input = moved
+        chromo_list = [p3ht_chromo_list[0], chromo]
+        dms = {}
+        data = singles_homolumo(chromo_list, nprocs=1, dms=dms, dedup_tol=0.01)
+        assert np.array_equal(data[0], data[1])
+        # The density matrix is rotated into the frame of the duplicate
+        energies, dm = get_homolumo(moved, return_dm=True)
+        assert np.allclose(dms[1], dm, atol=1e-3)
+
+    def test_dedup_pairs(
+        self, monkeypatch, serial_executor, p3ht_snap, p3ht_chromo_list
+    ):
+        from morphct import execute_qcc
+        from morphct.chromophores import set_neighbors_voronoi, conversion_dict
+        from morphct.execute_qcc import _dimer_args, _run_qcc_dedup
+
+        executor = serial_executor(lambda i: np.full(4, float(i)))
+        built = []
+        get_geometry = execute_qcc._get_geometry
+
+        def record_geometry(qcc_input):
+            built.append(qcc_input)
+            return get_geometry(qcc_input)
+
+        monkeypatch.setattr(execute_qcc, "_get_geometry", record_geometry)
+        qcc_pairs = set_neighbors_voronoi(
+            p3ht_chromo_list, p3ht_snap, conversion_dict
+        )
+        qcc_pairs = qcc_pairs.select(np.arange(len(qcc_pairs)) < 3)
+        pairs, args = _dimer_args(qcc_pairs, p3ht_chromo_list)
+        # Only pairs which may be duplicates are written to be compared
+        data = _run_qcc_dedup(args, 0.01, executor=executor)
+        assert built == []
+        assert len({en[0] for en in data}) == 3
+
+        data = _run_qcc_dedup(args + args[:1], 0.01, executor=executor)
+        assert len(built) == 2
+        assert np.array_equal(data[0], data[3])
+
+    def test_snapshot_index(self, p3ht_snap):
+        from morphct.chromophores import conversion_dict
+        from morphct.execute_qcc import SnapshotIndex
+
+        snap_index = SnapshotIndex(p3ht_snap, conversion_dict)
+        box = p3ht_snap.configuration.box[:3]
+        assert np.array_equal(
+            snap_index.unwrapped_pos,
+            p3ht_snap.particles.position + p3ht_snap.particles.image * box,
+        )
+
+        atom_ids = np.array([1, 0, 4, 3, 2, 5, 6, 7, 8, 9, 10])
+        inside, outside, bond_ids = snap_index.get_boundary_bonds(atom_ids)
+        assert np.all(np.diff(bond_ids) > 0)
+        bonds = [
+            (i, j) for i, j in p3ht_snap.bonds.group
+            if (i in atom_ids) != (j in atom_ids)
+        ]
+        assert len(inside) == len(bonds)
+        for (i, j), a, b in zip(bonds, inside, outside):
+            assert {i, j} == {a, b}
+            assert a in atom_ids
+        assert snap_index.get_symbols(atom_ids[:3]) == ["C", "C", "S"]
+
+    def test_capped_fragment(self, p3ht_snap):
+        import copy
+        from morphct.chromophores import Chromophore, conversion_dict
+        from morphct.execute_qcc import (
+            CappedFragment, SnapshotIndex, write_qcc_pair_input
+        )
+
+        snap_index = SnapshotIndex(p3ht_snap, conversion_dict)
+        # Chromophores made of a thiophene ring and its bonded side chain
+        chromo_i = Chromophore(
+            0, p3ht_snap, np.arange(5), "donor", snap_index=snap_index
+        )
+        chromo_j = Chromophore(
+            1, p3ht_snap, np.arange(5, 11), "donor", snap_index=snap_index
+        )
+        fragment = chromo_i.qcc_fragment
+        assert isinstance(fragment, CappedFragment)
+        assert fragment.n_atoms == 5
+        assert len(fragment.numbers) == len(fragment.positions)
+        assert np.all(fragment.numbers[fragment.n_atoms:] == 1)
+        assert len(fragment.cap_bonds) == len(fragment.cap_partners)
+
+        j_shift = np.zeros(3)
+        qcc_input = write_qcc_pair_input(p3ht_snap, chromo_i, chromo_j, j_shift)
+        # Copies don't keep the snapshot index, so the fragments are made from
+        # the bonds
+        chromo_i, chromo_j = copy.copy(chromo_i), copy.copy(chromo_j)
+        assert chromo_i.qcc_fragment is None
+        no_fragments = write_qcc_pair_input(
+            p3ht_snap, chromo_i, chromo_j, j_shift, conversion_dict
+        )
+        assert np.array_equal(qcc_input.numbers, no_fragments.numbers)
+        assert np.array_equal(qcc_input.positions, no_fragments.positions)
+        # The caps on the bond between the chromophores are dropped
+        n_single_atoms = sum(
+            len(chromo.qcc_input) for chromo in [chromo_i, chromo_j]
+        )
+        assert len(qcc_input) == n_single_atoms - 2
@@ -136,3 +136,79 @@ class TestHelperFunctions(BaseTest):
         assert get_event_tau(
             rate, slowest=slowest, fastest=fastest, max_attempts=max_attempts
         ) == pytest.approx(0.519899395, 1e-8)
+
+    def test_get_hop_rates(self):
+        from morphct.helper_functions import get_hop_rate, get_hop_rates
+
+        lamda = 0.3064
+        tis = np.array([0, 0.2456720694088973, 0.0013270585750558073])
+        deltas = np.array(
+            [0.06218457533310762, 0.016112646653095197, -0.021286665397703075]
+        )
+        rijs = np.array([1e-9, 2e-9, 3.659072209672184e-09])
+        factor = 1
+        temp = 300
+
+        rates = get_hop_rates(lamda, tis, deltas, factor, temp)
+        assert rates[0] == 0
+        assert np.allclose(
+            rates,
+            [get_hop_rate(lamda, t, d, factor, temp) for t, d in zip(tis, deltas)]
+        )
+
+        rates = get_hop_rates(
+            lamda,
+            tis,
+            deltas,
+            factor,
+            temp,
+            use_vrh=True,
+            rij=rijs,
+            vrh=2e-10,
+            boltz=True,
+        )
+        assert np.allclose(
+            rates,
+            [
+                get_hop_rate(
+                    lamda,
+                    t,
+                    d,
+                    factor,
+                    temp,
+                    use_vrh=True,
+                    rij=r,
+                    vrh=2e-10,
+                    boltz=True,
+                )
+                for t, d, r in zip(tis, deltas, rijs)
+            ]
+        )
+
+    def test_get_event_taus(self):
+        from morphct.helper_functions import get_event_tau, get_event_taus
+
+        rates = np.array([10, 0, 1e3, 5])
+
+        np.random.seed(42)
+        taus = get_event_taus(rates)
+        np.random.seed(42)
+        expected = [get_event_tau(rate) for rate in rates]
+
+        assert taus[1] == 1e99
+        assert np.allclose(taus, expected)
+
+    def test_get_bkl_event(self):
+        from morphct.helper_functions import get_bkl_event
+
+        assert get_bkl_event(np.array([])) == (None, 1e99)
+        assert get_bkl_event(np.array([0.0, 0.0])) == (None, 1e99)
+
+        np.random.seed(42)
+        rates = np.array([1.0, 0.0, 3.0])
+        cum_rates = np.cumsum(rates)
+        picks = [get_bkl_event(cum_rates)[0] for i in range(4000)]
+
+        # Zero rate events are never picked
+        assert 1 not in picks
+        assert picks.count(2) / len(picks) == pytest.approx(0.75, abs=0.03)
@@ -13,6 +13,16 @@ class TestKMC(BaseTest):
         assert len(holes["id"]) == 20
         assert len(elecs["id"]) == 0
 
+        # Arrays (e.g., from load_kmc_results) are kept as arrays
+        data = {
+            "id": np.arange(3),
+            "c_type": np.array(["hole", "electron", "hole"]),
+            "hole_history": None,
+        }
+        holes, elecs = split_carriers(data)
+        assert np.array_equal(holes["id"], [0, 2])
+        assert isinstance(elecs["id"], np.ndarray)
+
     def test_msds_mobility(self, p3ht_combined_carriers):
         from scipy.stats import linregress
         from morphct.kmc_analyze import calc_mobility, get_times_msds
@@ -64,6 +64,13 @@ class TestKMC(BaseTest):
         assert len(jobs) == n
         assert jobs[0][0] == (9, 1e-13, 'electron')
 
+        jobs = get_jobslist(
+            lts, n_holes=10, n_elec=10, seed=42, batch_size=3
+        )
+        assert len(jobs) == 14
+        assert all(len(batch) == 3 for batch in jobs[:-1])
+        assert len(jobs[-1]) == 1
+
     def test_runsinglekmc(self, tmpdir, p3ht_chromo_list_energies, p3ht_snap):
         from morphct.mobility_kmc import run_single_kmc
 
@@ -75,7 +82,7 @@ class TestKMC(BaseTest):
                 jobs, tmpdir, chromo_list, p3ht_snap, 300, seed=42
                 )[0]
 
-        assert carrier.n_hops == 212
+        assert carrier.n_hops == 476
         assert carrier.current_chromo.id == 14
 
         c_kwargs = {
@@ -93,8 +100,8 @@ class TestKMC(BaseTest):
                 carrier_kwargs=c_kwargs
                 )[0]
 
-        assert carrier.n_hops == 1553
-        assert carrier.current_chromo.id == 19
+        assert carrier.n_hops == 1382
+        assert carrier.current_chromo.id == 12
 
         jobs = [[0, 1e-11, 'hole']]
         c_kwargs = {
@@ -113,5 +120,430 @@ class TestKMC(BaseTest):
                 carrier_kwargs=c_kwargs
                 )[0]
 
-        assert carrier.n_hops == 975
-        assert carrier.current_chromo.id == 11
+        assert carrier.n_hops == 1284
+        assert carrier.current_chromo.id == 8
+
+    def test_hop_graph(self, p3ht_chromo_list_energies):
+        from morphct.mobility_kmc import Carrier, HopGraph
+
+        chromo_list = p3ht_chromo_list_energies
+        n = len(chromo_list)
+        box = np.array([85.18963, 85.18963, 85.18963])
+        graph = HopGraph(chromo_list, box, 300, boltz=True, use_vrh=True)
+
+        assert len(graph.indptr) == n + 1
+        assert graph.indptr[-1] == len(graph.indices) == len(graph.rates)
+        assert np.allclose(
+            graph.total_rates, np.add.reduceat(graph.rates, graph.indptr[:-1])
+        )
+
+        carrier = Carrier(
+            chromo_list[0], 1e-13, 0, box, 300, n, boltz=True, use_vrh=True
+        )
+        n_inds, rel_imgs, rates = carrier._get_neighbor_rates(chromo_list)
+        g_inds, g_imgs, g_rates = graph.get_rates(0)
+
+        assert np.array_equal(n_inds, g_inds)
+        assert np.array_equal(rel_imgs, g_imgs)
+        assert np.allclose(rates, g_rates)
+
+    def test_kmc_engines(self, tmpdir, p3ht_chromo_list_energies, p3ht_snap):
+        from morphct.mobility_kmc import Carrier, run_single_kmc
+
+        chromo_list = p3ht_chromo_list_energies
+        box = np.array([85.18963, 85.18963, 85.18963])
+
+        with pytest.raises(ValueError):
+            Carrier(
+                chromo_list[0],
+                1e-13,
+                0,
+                box,
+                300,
+                len(chromo_list),
+                kmc_engine="bad_engine",
+            )
+
+        jobs = [[i, 1e-12, "hole"] for i in range(20)]
+        frm = run_single_kmc(
+            jobs, tmpdir, chromo_list, p3ht_snap, 300, seed=42, verbose=0
+        )
+        bkl = run_single_kmc(
+            jobs,
+            tmpdir,
+            chromo_list,
+            p3ht_snap,
+            300,
+            seed=42,
+            verbose=0,
+            kmc_engine="bkl",
+        )
+
+        frm_hops = np.mean([carrier.n_hops for carrier in frm])
+        bkl_hops = np.mean([carrier.n_hops for carrier in bkl])
+        assert all(carrier.current_time <= 1e-12 for carrier in bkl)
+        assert bkl_hops == pytest.approx(frm_hops, rel=0.25)
+
+    def test_run_lockstep_kmc(self, p3ht_chromo_list_energies, p3ht_snap):
+        from morphct.mobility_kmc import get_hop_graph, run_lockstep_kmc
+
+        chromo_list = p3ht_chromo_list_energies
+        hop_graph = get_hop_graph(chromo_list, p3ht_snap, 300)
+        jobs = [[i, lt, "hole"] for i in range(50) for lt in [1e-13, 1e-12]]
+
+        results = run_lockstep_kmc(jobs, hop_graph, seed=42)
+
+        assert len(results["id"]) == 100
+        assert np.all(results["current_time"] <= results["lifetime"])
+        assert np.all(hop_graph.species[results["current_chromo"]] == "donor")
+        long_lived = results["lifetime"] == 1e-12
+        assert np.mean(results["n_hops"][long_lived]) > np.mean(
+            results["n_hops"][~long_lived]
+        )
+
+        results = run_lockstep_kmc(jobs, hop_graph, hop_limit=5, seed=42)
+        assert np.all(results["n_hops"] == 5)
+
+    def test_lockstep_zero_rates(self, p3ht_chromo_list_energies, p3ht_snap):
+        import copy
+        from morphct.mobility_kmc import get_hop_graph, run_lockstep_kmc
+
+        chromo_list = p3ht_chromo_list_energies
+        hop_graph = copy.copy(get_hop_graph(chromo_list, p3ht_snap, 300))
+        hop_graph.rates = np.zeros_like(hop_graph.rates)
+        hop_graph.cum_rates = np.zeros_like(hop_graph.cum_rates)
+        hop_graph.total_rates = np.zeros_like(hop_graph.total_rates)
+        jobs = [[i, 1e-12, "hole"] for i in range(5)]
+
+        for kmc_engine in ["frm", "bkl"]:
+            # Hops out of a zero-rate row take 1e99 s, as in Carrier
+            results = run_lockstep_kmc(
+                jobs, hop_graph, seed=42, kmc_engine=kmc_engine
+            )
+            assert np.all(results["n_hops"] == 0)
+            assert np.all(results["current_time"] == 0)
+
+            results = run_lockstep_kmc(
+                jobs, hop_graph, hop_limit=1, seed=42, kmc_engine=kmc_engine
+            )
+            assert np.all(results["n_hops"] == 1)
+            assert np.all(results["current_time"] == 1e99)
+            start = results["initial_chromo"]
+            if kmc_engine == "frm":
+                # The first edge is taken, like argmin of the equal times
+                assert np.array_equal(
+                    results["current_chromo"],
+                    hop_graph.indices[hop_graph.indptr[start]],
+                )
+                assert results["hole_history"].sum() == 5
+            else:
+                # No hop can be picked, so the carriers stay where they are
+                assert np.array_equal(results["current_chromo"], start)
+                assert results["hole_history"].sum() == 0
+
+    def test_history(self, tmpdir, p3ht_chromo_list_energies, p3ht_snap):
+        from morphct.mobility_kmc import (
+            get_hop_graph, run_lockstep_kmc, run_single_kmc
+        )
+
+        chromo_list = p3ht_chromo_list_energies
+        hop_graph = get_hop_graph(chromo_list, p3ht_snap, 300)
+        jobs = [[i, 1e-12, "hole"] for i in range(5)]
+
+        carriers = run_single_kmc(
+            jobs, tmpdir, chromo_list, p3ht_snap, 300, seed=42, verbose=0
+        )
+        for carrier in carriers:
+            assert carrier.hole_history.sum() == carrier.n_hops
+            assert carrier.electron_history is None
+
+        carriers, histories = run_single_kmc(
+            jobs,
+            tmpdir,
+            chromo_list,
+            p3ht_snap,
+            300,
+            seed=42,
+            verbose=0,
+            hop_graph=hop_graph,
+            shared_history=True,
+        )
+        assert all(carrier.hole_history is None for carrier in carriers)
+        assert histories["hole_history"].dtype == np.int32
+        assert histories["hole_history"].sum() == sum(
+            carrier.n_hops for carrier in carriers
+        )
+        assert histories["electron_history"].sum() == 0
+
+        results = run_lockstep_kmc(jobs, hop_graph, seed=42)
+        history = hop_graph.to_csr(results["hole_history"])
+        assert history.shape == (len(chromo_list), len(chromo_list))
+        assert history.sum() == results["n_hops"].sum()
+
+        results = run_lockstep_kmc(jobs, hop_graph, record_history=False)
+        assert results["hole_history"] is None
+
+    def test_shared_hop_graph(
+        self, monkeypatch, p3ht_chromo_list_energies, p3ht_snap
+    ):
+        from multiprocessing import shared_memory
+        from morphct import mobility_kmc
+        from morphct.mobility_kmc import (
+            attach_hop_graph, get_hop_graph, run_jobs
+        )
+
+        chromo_list = p3ht_chromo_list_energies
+        hop_graph = get_hop_graph(chromo_list, p3ht_snap, 300)
+        spec, blocks = hop_graph.to_shared_memory()
+        try:
+            shared_graph, shared_blocks = attach_hop_graph(spec)
+            assert shared_graph.n == hop_graph.n
+            assert np.array_equal(shared_graph.indices, hop_graph.indices)
+            assert np.array_equal(shared_graph.rates, hop_graph.rates)
+            assert np.array_equal(shared_graph.species, hop_graph.species)
+
+            jobs = [[i, 1e-12, "hole"] for i in range(5)]
+            for kmc_engine in ["frm", "bkl", "lockstep"]:
+                results = run_jobs(
+                    jobs, shared_graph, kmc_engine=kmc_engine, seed=42
+                )
+                assert np.array_equal(results["id"], np.arange(5))
+                assert np.all(results["current_time"] <= 1e-12)
+                assert results["hole_history"].sum() == results["n_hops"].sum()
+            for block in shared_blocks:
+                block.close()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        # Blocks made before a failure are freed
+        names = []
+        SharedMemory = shared_memory.SharedMemory
+
+        def fail_second(*args, **kwargs):
+            if names:
+                raise OSError("no space left")
+            block = SharedMemory(*args, **kwargs)
+            names.append(block.name)
+            return block
+
+        monkeypatch.setattr(
+            mobility_kmc.shared_memory, "SharedMemory", fail_second
+        )
+        with pytest.raises(OSError, match="no space left"):
+            hop_graph.to_shared_memory()
+        monkeypatch.undo()
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=names[0])
+
+    def test_run_kmc_backends(
+        self, tmpdir, p3ht_chromo_list_energies, p3ht_snap
+    ):
+        from morphct.mobility_kmc import load_kmc_results, run_kmc
+
+        chromo_list = p3ht_chromo_list_energies
+        for backend in ["serial", "thread"]:
+            results = run_kmc(
+                [1e-13, 1e-12],
+                tmpdir,
+                chromo_list,
+                p3ht_snap,
+                300,
+                n_holes=5,
+                nprocs=2,
+                combine=False,
+                verbose=0,
+                batch_size=3,
+                backend=backend,
+            )
+            assert len(results) == 10
+            n_hops = sum(carrier.n_hops for carrier in results)
+            data = load_kmc_results(tmpdir, columns=["hole_history"])
+            assert data["hole_history"].sum() == n_hops
+
+        # No carriers means no pool and no batches
+        for combine, empty in [(False, []), (True, {})]:
+            results = run_kmc(
+                [1e-13], tmpdir, chromo_list, p3ht_snap, 300, combine=combine
+            )
+            assert results == empty
+
+        with pytest.raises(ValueError):
+            run_kmc(
+                [1e-13],
+                tmpdir,
+                chromo_list,
+                p3ht_snap,
+                300,
+                n_holes=1,
+                backend="mpi",
+            )
+
+    def test_run_kmc_process(
+        self, tmpdir, monkeypatch, p3ht_chromo_list_energies, p3ht_snap
+    ):
+        from multiprocessing import shared_memory
+        from morphct import mobility_kmc
+        from morphct.mobility_kmc import HopGraph, load_kmc_results, run_kmc
+
+        names = []
+        to_shared_memory = HopGraph.to_shared_memory
+
+        def record_blocks(self):
+            spec, blocks = to_shared_memory(self)
+            names.extend(block.name for block in blocks)
+            return spec, blocks
+
+        monkeypatch.setattr(HopGraph, "to_shared_memory", record_blocks)
+
+        def assert_unlinked():
+            assert names
+            for name in names:
+                with pytest.raises(FileNotFoundError):
+                    shared_memory.SharedMemory(name=name)
+            names.clear()
+
+        chromo_list = p3ht_chromo_list_energies
+        kwargs = dict(
+            n_holes=5, seed=42, verbose=0, batch_size=3, combine=False
+        )
+        serial_dir = tmpdir.mkdir("serial")
+        serial = run_kmc(
+            [1e-13, 1e-12],
+            serial_dir,
+            chromo_list,
+            p3ht_snap,
+            300,
+            backend="serial",
+            **kwargs,
+        )
+        process_dir = tmpdir.mkdir("process")
+        process = run_kmc(
+            [1e-13, 1e-12],
+            process_dir,
+            chromo_list,
+            p3ht_snap,
+            300,
+            nprocs=2,
+            backend="process",
+            **kwargs,
+        )
+        assert_unlinked()
+
+        # The workers give the same carriers and histories as the serial run
+        for attr in ["id", "n_hops", "current_time", "displacement"]:
+            assert [getattr(c, attr) for c in process] == (
+                [getattr(c, attr) for c in serial]
+            )
+        serial_history = load_kmc_results(serial_dir)["hole_history"]
+        process_history = load_kmc_results(process_dir)["hole_history"]
+        assert (serial_history != process_history).nnz == 0
+
+        # The shared memory is freed if the run fails
+        def fail(*args):
+            raise RuntimeError("disk full")
+
+        monkeypatch.setattr(mobility_kmc, "write_kmc_batch", fail)
+        with pytest.raises(RuntimeError, match="disk full"):
+            run_kmc(
+                [1e-13],
+                process_dir,
+                chromo_list,
+                p3ht_snap,
+                300,
+                n_holes=2,
+                nprocs=2,
+                verbose=0,
+                backend="process",
+            )
+        assert_unlinked()
+
+    def test_carrier_rng(self, tmpdir, p3ht_chromo_list_energies, p3ht_snap):
+        from morphct.mobility_kmc import (
+            get_carrier_rng, get_hop_graph, run_jobs, run_single_kmc
+        )
+
+        x = get_carrier_rng(42, "hole", 3, 1e-12).random(3)
+        assert np.array_equal(x, get_carrier_rng(42, "hole", 3, 1e-12).random(3))
+        assert not np.array_equal(
+            x, get_carrier_rng(42, "hole", 3, 1e-13).random(3)
+        )
+        assert not np.array_equal(
+            x, get_carrier_rng(42, "electron", 3, 1e-12).random(3)
+        )
+
+        # A carrier gives the same result whichever jobs it is run with
+        hop_graph = get_hop_graph(p3ht_chromo_list_energies, p3ht_snap, 300)
+        jobs = [[i, lt, "hole"] for i in range(5) for lt in [1e-13, 1e-12]]
+        for kmc_engine in ["frm", "bkl", "lockstep"]:
+            results = run_jobs(jobs, hop_graph, kmc_engine=kmc_engine, seed=7)
+            single = run_jobs(
+                jobs[7:8], hop_graph, kmc_engine=kmc_engine, seed=7
+            )
+            assert results["n_hops"][7] == single["n_hops"][0]
+            assert results["current_time"][7] == single["current_time"][0]
+            assert results["current_chromo"][7] == single["current_chromo"][0]
+
+        # Carriers use the same random streams
+        for kmc_engine in ["frm", "bkl"]:
+            results = run_jobs(jobs, hop_graph, kmc_engine=kmc_engine, seed=7)
+            carriers = run_single_kmc(
+                jobs,
+                tmpdir,
+                p3ht_chromo_list_energies,
+                p3ht_snap,
+                300,
+                seed=7,
+                verbose=0,
+                hop_graph=hop_graph,
+                kmc_engine=kmc_engine,
+            )
+            assert [c.n_hops for c in carriers] == results["n_hops"].tolist()
+            assert [c.current_time for c in carriers] == (
+                results["current_time"].tolist()
+            )
+
+    def test_kmc_output(self, tmpdir, p3ht_chromo_list_energies, p3ht_snap):
+        from morphct.mobility_kmc import load_kmc_results, run_kmc
+
+        chromo_list = p3ht_chromo_list_energies
+        kwargs = dict(n_holes=5, verbose=0, batch_size=3, backend="serial")
+        results = run_kmc(
+            [1e-13, 1e-12],
+            tmpdir,
+            chromo_list,
+            p3ht_snap,
+            300,
+            combine=False,
+            **kwargs,
+        )
+        data = run_kmc(
+            [1e-13, 1e-12], tmpdir, chromo_list, p3ht_snap, 300, **kwargs
+        )
+        assert len(tmpdir.join("carriers").listdir("batch_*.npz")) == 4
+        # combine=False returns the Carriers
+        assert all(carrier.hole_history is None for carrier in results)
+        assert [carrier.c_type for carrier in results] == ["hole"] * 10
+        n_hops = [carrier.n_hops for carrier in results]
+        assert np.array_equal(data["n_hops"], n_hops)
+        assert np.allclose(
+            data["current_position"],
+            [carrier.current_chromo.center for carrier in results],
+        )
+        assert np.allclose(
+            data["displacement"],
+            [carrier.displacement for carrier in results],
+        )
+        assert data["hole_history"].sum() == sum(n_hops)
+        assert data["electron_history"].sum() == 0
+        assert np.all(data["temp"] == 300)
+
+        data = load_kmc_results(
+            tmpdir, columns=["lifetime", "n_hops"], c_type="electron"
+        )
+        assert list(data) == ["lifetime", "n_hops"]
+        assert len(data["n_hops"]) == 0
+
+        with pytest.raises(ValueError):
+            load_kmc_results(tmpdir, columns=["mol_id_dict"])